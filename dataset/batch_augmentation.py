@@ -0,0 +1,345 @@
+"""A module that contains batched detection augmentation on tensors.
+
+It replaces the per-sample albumentations pipeline of flips,
+`RandomResizedCrop`, `RandomBrightnessContrast` and `Normalize`
+with `BboxParams(min_area, min_visibility)`. DataLoader workers only decode
+images and collate them with `collate_uint8_detection_batch`, and
+the whole uint8 batch is augmented with a few tensor operations
+on the training device.
+"""
+
+
+import math
+from typing import Optional, Sequence, Tuple, Union
+
+import torch
+from torch import FloatTensor, IntTensor, Tensor
+import torch.nn.functional as F
+
+from rcnn.rcnn_utils import ragged_to_padded
+
+
+class BatchDetectionAugmentation:
+    """Batched flips, random resized crops, brightness and contrast.
+
+    Every image gets its own random parameters like with
+    per-sample augmentation. Crops and flips of the whole batch are one
+    bilinear `grid_sample` and brightness, contrast and normalization
+    are fused into one affine transform of the sampled pixels.
+    """
+
+    def __init__(
+        self,
+        size: Tuple[int, int],
+        mean: Sequence[float],
+        std: Sequence[float],
+        hflip_p: float = 0.5,
+        vflip_p: float = 0.5,
+        scale: Tuple[float, float] = (0.08, 1.0),
+        ratio: Tuple[float, float] = (0.75, 1.3333333333333333),
+        brightness_limit: float = 0.2,
+        contrast_limit: float = 0.2,
+        brightness_contrast_p: float = 0.5,
+        min_area: float = 0.0,
+        min_visibility: float = 0.0,
+        n_crop_attempts: int = 10
+    ) -> None:
+        """Initialize `BatchDetectionAugmentation`.
+
+        Default parameters are the albumentations' ones.
+
+        Parameters
+        ----------
+        size : Tuple[int, int]
+            A height and a width of output images.
+        mean : Sequence[float]
+            Normalization mean of channels for images in [0, 1] range.
+        std : Sequence[float]
+            Normalization standard deviation of channels for images
+            in [0, 1] range.
+        hflip_p : float, optional
+            A probability of a horizontal flip. By default is 0.5.
+        vflip_p : float, optional
+            A probability of a vertical flip. By default is 0.5.
+        scale : Tuple[float, float], optional
+            A range of a crop area relative to an image area.
+            By default is (0.08, 1.0).
+        ratio : Tuple[float, float], optional
+            A range of a crop aspect ratio. By default is (3/4, 4/3).
+        brightness_limit : float, optional
+            A maximum brightness shift relative to 255. By default is 0.2.
+        contrast_limit : float, optional
+            A maximum contrast factor change. By default is 0.2.
+        brightness_contrast_p : float, optional
+            A probability of a brightness and contrast change.
+            By default is 0.5.
+        min_area : float, optional
+            A minimum area of a kept box in output pixels.
+            By default is 0.0.
+        min_visibility : float, optional
+            A minimum fraction of a box area that must stay in a crop
+            to keep the box. By default is 0.0.
+        n_crop_attempts : int, optional
+            A number of attempts to sample a crop that fits into an image
+            before the central crop is taken. By default is 10.
+        """
+        self.size = size
+        self.mean = torch.as_tensor(mean, dtype=torch.float32)
+        self.std = torch.as_tensor(std, dtype=torch.float32)
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.scale = scale
+        self.ratio = ratio
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.brightness_contrast_p = brightness_contrast_p
+        self.min_area = min_area
+        self.min_visibility = min_visibility
+        self.n_crop_attempts = n_crop_attempts
+
+    def _uniform(
+        self, shape: Tuple[int, ...], low: float, high: float,
+        device: torch.device
+    ) -> FloatTensor:
+        return torch.empty(shape, device=device).uniform_(low, high)
+
+    def sample_crops(self, image_sizes: IntTensor) -> FloatTensor:
+        """Sample random resized crops of images.
+
+        Parameters
+        ----------
+        image_sizes : IntTensor
+            Heights and widths of images with shape `(b, 2)`.
+
+        Returns
+        -------
+        FloatTensor
+            Integer crops with shape `(b, 4)` in format
+            `(x0, y0, crop_w, crop_h)`.
+        """
+        device = image_sizes.device
+        img_h, img_w = image_sizes.float().unbind(dim=1)
+        shape = (image_sizes.shape[0], self.n_crop_attempts)
+        area = (img_h * img_w)[:, None] * self._uniform(
+            shape, *self.scale, device)
+        aspect = torch.exp(self._uniform(
+            shape, math.log(self.ratio[0]), math.log(self.ratio[1]), device))
+        crop_w = torch.round(torch.sqrt(area * aspect))
+        crop_h = torch.round(torch.sqrt(area / aspect))
+        fits = ((crop_w > 0) & (crop_w <= img_w[:, None]) &
+                (crop_h > 0) & (crop_h <= img_h[:, None]))
+
+        # Take the first attempt that fits
+        first = fits.int().argmax(dim=1, keepdim=True)
+        crop_w = crop_w.gather(1, first).squeeze(1)
+        crop_h = crop_h.gather(1, first).squeeze(1)
+        x0 = torch.floor(torch.rand_like(img_w) * (img_w - crop_w + 1))
+        y0 = torch.floor(torch.rand_like(img_h) * (img_h - crop_h + 1))
+
+        # Otherwise take the central crop with a clamped aspect ratio
+        in_ratio = img_w / img_h
+        center_w = torch.where(
+            in_ratio > self.ratio[1],
+            torch.round(img_h * self.ratio[1]), img_w)
+        center_h = torch.where(
+            in_ratio < self.ratio[0],
+            torch.round(img_w / self.ratio[0]), img_h)
+        fitted = fits.any(dim=1)
+        crop_w = torch.where(fitted, crop_w, center_w)
+        crop_h = torch.where(fitted, crop_h, center_h)
+        x0 = torch.where(
+            fitted, x0, torch.div(img_w - center_w, 2, rounding_mode='floor'))
+        y0 = torch.where(
+            fitted, y0, torch.div(img_h - center_h, 2, rounding_mode='floor'))
+        return torch.stack((x0, y0, crop_w, crop_h), dim=1)
+
+    def _sample_coords(
+        self, start: FloatTensor, length: FloatTensor, out_size: int,
+        flip: Tensor, in_size: int
+    ) -> FloatTensor:
+        # Centers of output pixels in input pixels like in cv2.resize
+        steps = torch.arange(out_size, device=start.device) + 0.5
+        coords = (start[:, None] + steps * (length / out_size)[:, None] -
+                  0.5)
+        coords = torch.where(flip[:, None], coords.flip(1), coords)
+        # Clamping replicates crop borders like resizing of a cropped image
+        coords = torch.minimum(
+            torch.maximum(coords, start[:, None]),
+            (start + length)[:, None] - 1)
+        return coords / max(in_size - 1, 1) * 2 - 1
+
+    def transform_images(
+        self,
+        images: Tensor,
+        crops: FloatTensor,
+        hflips: Tensor,
+        vflips: Tensor
+    ) -> FloatTensor:
+        """Crop, resize, flip, change brightness and contrast and normalize.
+
+        Parameters
+        ----------
+        images : Tensor
+            Uint8 images padded to one size with shape `(b, c, h, w)`.
+        crops : FloatTensor
+            Crops inside the images with shape `(b, 4)` in format
+            `(x0, y0, crop_w, crop_h)`.
+        hflips : Tensor
+            Bool horizontal flip flags with shape `(b,)`.
+        vflips : Tensor
+            Bool vertical flip flags with shape `(b,)`.
+
+        Returns
+        -------
+        FloatTensor
+            Normalized images with shape `(b, c, out_h, out_w)`.
+        """
+        b_size, _, in_h, in_w = images.shape
+        out_h, out_w = self.size
+        x0, y0, crop_w, crop_h = crops.unbind(dim=1)
+        grid_x = self._sample_coords(x0, crop_w, out_w, hflips, in_w)
+        grid_y = self._sample_coords(y0, crop_h, out_h, vflips, in_h)
+        grid = torch.stack(
+            (grid_x[:, None, :].expand(-1, out_h, -1),
+             grid_y[:, :, None].expand(-1, -1, out_w)), dim=3)
+        images = F.grid_sample(
+            images.float(), grid, mode='bilinear', padding_mode='border',
+            align_corners=True)
+
+        # Brightness and contrast of uint8 pixels with clipping
+        change = torch.rand(b_size, device=images.device) < (
+            self.brightness_contrast_p)
+        alpha = torch.where(change, 1 + self._uniform(
+            (b_size,), -self.contrast_limit, self.contrast_limit,
+            images.device), 1.0)
+        beta = torch.where(change, 255 * self._uniform(
+            (b_size,), -self.brightness_limit, self.brightness_limit,
+            images.device), 0.0)
+        images = torch.clamp(
+            images * alpha[:, None, None, None] + beta[:, None, None, None],
+            0, 255)
+
+        # Normalization of [0, 255] pixels is one multiply-add
+        mean = self.mean.to(images.device)[:, None, None]
+        std = self.std.to(images.device)[:, None, None]
+        return torch.addcmul(-mean / std, images, 1 / (255 * std))
+
+    def transform_bboxes(
+        self,
+        bboxes: FloatTensor,
+        b_idxs: IntTensor,
+        crops: FloatTensor,
+        hflips: Tensor,
+        vflips: Tensor
+    ) -> Tuple[FloatTensor, Tensor]:
+        """Transform boxes like images and filter them.
+
+        Parameters
+        ----------
+        bboxes : FloatTensor
+            Boxes in "xyxy" format with shape `(n_obj, 4)`.
+        b_idxs : IntTensor
+            Batch indexes of the boxes with shape `(n_obj,)`.
+        crops : FloatTensor
+            Crops of images with shape `(b, 4)`.
+        hflips : Tensor
+            Bool horizontal flip flags of images with shape `(b,)`.
+        vflips : Tensor
+            Bool vertical flip flags of images with shape `(b,)`.
+
+        Returns
+        -------
+        Tuple[FloatTensor, Tensor]
+            The transformed boxes with shape `(n_obj, 4)` and a bool mask
+            of the kept ones with shape `(n_obj,)`.
+        """
+        out_h, out_w = self.size
+        x0, y0, crop_w, crop_h = crops[b_idxs].unbind(dim=1)
+        x1, y1, x2, y2 = bboxes.unbind(dim=1)
+        x1 = (x1 - x0) * (out_w / crop_w)
+        x2 = (x2 - x0) * (out_w / crop_w)
+        y1 = (y1 - y0) * (out_h / crop_h)
+        y2 = (y2 - y0) * (out_h / crop_h)
+        area = (x2 - x1) * (y2 - y1)
+
+        hflip = hflips[b_idxs]
+        vflip = vflips[b_idxs]
+        x1, x2 = (torch.where(hflip, out_w - x2, x1),
+                  torch.where(hflip, out_w - x1, x2))
+        y1, y2 = (torch.where(vflip, out_h - y2, y1),
+                  torch.where(vflip, out_h - y1, y2))
+        bboxes = torch.stack((x1.clamp(0, out_w), y1.clamp(0, out_h),
+                              x2.clamp(0, out_w), y2.clamp(0, out_h)), dim=1)
+
+        clipped_area = ((bboxes[:, 2] - bboxes[:, 0]) *
+                        (bboxes[:, 3] - bboxes[:, 1]))
+        keep = ((clipped_area > 0) & (clipped_area >= self.min_area) &
+                (clipped_area >= self.min_visibility * area))
+        return bboxes, keep
+
+    def __call__(
+        self,
+        images: Tensor,
+        image_sizes: IntTensor,
+        gt_boxes: FloatTensor,
+        gt_cls: FloatTensor,
+        gt_offsets: Optional[IntTensor] = None
+    ) -> Union[Tuple[FloatTensor, FloatTensor, FloatTensor],
+               Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor]]:
+        """Augment a batch from `collate_uint8_detection_batch`.
+
+        Parameters
+        ----------
+        images : Tensor
+            Uint8 images padded to one size with shape `(b, c, h, w)`.
+        image_sizes : IntTensor
+            Heights and widths of the images with shape `(b, 2)`.
+        gt_boxes : FloatTensor
+            Boxes with shape `(b, n_max_obj, 4)` padded with -1 or,
+            in the ragged mode, with shape `(n_obj, 4)`.
+        gt_cls : FloatTensor
+            Classes with shape `(b, n_max_obj)` or, in the ragged mode,
+            with shape `(n_obj,)`.
+        gt_offsets : Optional[IntTensor], optional
+            Offsets of images' objects with shape `(b + 1,)` that enable
+            the ragged mode.
+
+        Returns
+        -------
+        Union[Tuple[FloatTensor, FloatTensor, FloatTensor],
+              Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor]]
+            Normalized images with shape `(b, c, out_h, out_w)`
+            and kept boxes and classes in the same format as given
+            (with new offsets in the ragged mode).
+        """
+        b_size = images.shape[0]
+        device = images.device
+        crops = self.sample_crops(image_sizes)
+        hflips = torch.rand(b_size, device=device) < self.hflip_p
+        vflips = torch.rand(b_size, device=device) < self.vflip_p
+        images = self.transform_images(
+            images, crops, hflips, vflips)
+
+        if gt_offsets is None:
+            not_pad = (gt_boxes != -1).any(dim=2)
+            b_idxs = torch.nonzero(not_pad)[:, 0]
+            bboxes = gt_boxes[not_pad]
+            classes = gt_cls[not_pad]
+        else:
+            b_idxs = torch.repeat_interleave(
+                torch.arange(b_size, device=device), torch.diff(gt_offsets))
+            bboxes = gt_boxes
+            classes = gt_cls
+
+        bboxes, keep = self.transform_bboxes(
+            bboxes, b_idxs, crops, hflips, vflips)
+        bboxes = bboxes[keep]
+        classes = classes[keep]
+        offsets = torch.zeros(b_size + 1, dtype=torch.int64, device=device)
+        offsets[1:] = torch.cumsum(
+            torch.bincount(b_idxs[keep], minlength=b_size), dim=0)
+
+        if gt_offsets is not None:
+            return images, bboxes, classes, offsets
+        return (images, ragged_to_padded(bboxes, offsets),
+                ragged_to_padded(classes, offsets))
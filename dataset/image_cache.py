@@ -0,0 +1,204 @@
+"""A module that contains a store of decoded images.
+
+Images are kept as raw uint8 RGB arrays in one append-only data file
+with an index of their offsets and sizes. Both files are memory-mapped,
+so cached images are read without decoding and the pages are shared
+between DataLoader workers. The cache is filled lazily on the first access
+of an image or ahead of time by `dataset/scripts/build_image_cache.py`.
+"""
+
+
+import json
+import os
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _lock_file(f: BinaryIO) -> None:
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    else:
+        # The first byte serves as a mutex, it can be locked in an empty file
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f: BinaryIO) -> None:
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ImageCache:
+    """A memory-mapped store of decoded images of a dataset.
+
+    Images are identified by their indexes in the dataset. Images bigger
+    than `max_side` are downscaled before storing and their original
+    sizes are kept to scale annotations.
+    """
+
+    data_name = 'images.bin'
+    index_name = 'index.npy'
+    meta_name = 'meta.json'
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path],
+        n_images: int,
+        max_side: Optional[int] = None
+    ) -> None:
+        """Initialize `ImageCache`.
+
+        The cache is created if it does not exist yet.
+
+        Parameters
+        ----------
+        cache_dir : Union[str, Path]
+            A directory of the cache.
+        n_images : int
+            A number of images in the dataset.
+        max_side : Optional[int], optional
+            A maximum side of stored images. If not given then images
+            are stored in the original size.
+
+        Raises
+        ------
+        ValueError
+            The existing cache was made for another number of images
+            or another `max_side`.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.n_images = n_images
+        self.max_side = max_side
+        self.data_path = self.cache_dir / self.data_name
+        self.index_path = self.cache_dir / self.index_name
+
+        meta = {'n_images': n_images, 'max_side': max_side}
+        meta_path = self.cache_dir / self.meta_name
+        if meta_path.exists():
+            with open(meta_path) as f:
+                cached_meta = json.load(f)
+            if cached_meta != meta:
+                raise ValueError(
+                    f'The cache {self.cache_dir} was made with {cached_meta} '
+                    f'but {meta} is requested.')
+        else:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # A row contains an offset, a height and a width of the stored
+            # image and the original height and width. Offset -1 is a miss.
+            index = np.lib.format.open_memmap(
+                self.index_path, mode='w+', dtype=np.int64,
+                shape=(n_images, 5))
+            index[:] = -1
+            index.flush()
+            del index
+            self.data_path.touch()
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        self._index: Optional[np.memmap] = None
+        self._data: Optional[np.memmap] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Maps are reopened in worker processes instead of being copied
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_data'] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.n_images
+
+    @property
+    def index(self) -> np.memmap:
+        """The index with rows `(offset, h, w, orig_h, orig_w)`."""
+        if self._index is None:
+            self._index = np.load(self.index_path, mmap_mode='r+')
+        return self._index
+
+    def __contains__(self, idx: int) -> bool:
+        return bool(self.index[idx, 0] >= 0)
+
+    def get(self, idx: int) -> Optional[Tuple[NDArray, Tuple[int, int]]]:
+        """Get a cached image.
+
+        Parameters
+        ----------
+        idx : int
+            An index of the image.
+
+        Returns
+        -------
+        Optional[Tuple[NDArray, Tuple[int, int]]]
+            A copy of the image with shape `(h, w, 3)` and its original
+            height and width or `None` if the image is not cached.
+        """
+        offset, h, w, orig_h, orig_w = self.index[idx].tolist()
+        if offset < 0:
+            return None
+        end = offset + h * w * 3
+        # The data file grows while the cache is filled
+        if self._data is None or end > self._data.shape[0]:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        image = np.array(self._data[offset:end]).reshape(h, w, 3)
+        return image, (orig_h, orig_w)
+
+    def put(
+        self,
+        idx: int,
+        image: NDArray,
+        orig_size: Optional[Tuple[int, int]] = None
+    ) -> NDArray:
+        """Store an image.
+
+        Parameters
+        ----------
+        idx : int
+            An index of the image.
+        image : NDArray
+            The uint8 RGB image with shape `(h, w, 3)`.
+        orig_size : Optional[Tuple[int, int]], optional
+            An original height and width of the image if it is already
+            decoded at a reduced resolution. By default is the image's size.
+
+        Returns
+        -------
+        NDArray
+            The stored image that is downscaled if it is bigger
+            than `max_side`.
+        """
+        orig_h, orig_w = orig_size or image.shape[:2]
+        h, w = image.shape[:2]
+        if self.max_side is not None and max(h, w) > self.max_side:
+            scale = self.max_side / max(h, w)
+            new_size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            image = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        h, w = image.shape[:2]
+
+        # Appends of workers are serialized by the file lock
+        with open(self.data_path, 'ab') as f:
+            _lock_file(f)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(image.tobytes())
+                f.flush()
+            finally:
+                _unlock_file(f)
+
+        # The offset is written last, so the row is valid once it is set
+        self.index[idx, 1:] = (h, w, orig_h, orig_w)
+        self.index[idx, 0] = offset
+        return image
@@ -2,13 +2,150 @@
 
 
 from pathlib import Path
-from typing import Dict, List, Union, Callable, Any
+from typing import (
+    Dict, List, Union, Callable, Any, Sequence, Tuple, Optional)
 import json
 
+import numpy as np
+from numpy.typing import NDArray
 import torch
+from torch import FloatTensor, IntTensor, Tensor
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 
-from utils.image_utils import read_image
+from dataset.image_cache import ImageCache
+from utils.image_utils.image_functions import read_image
+
+
+INDEX_ARRAYS = ('bboxes', 'classes', 'obj_offsets', 'sets',
+                'names', 'name_offsets')
+
+
+def _encode_strings(strings: Sequence[str]) -> Tuple[NDArray, NDArray]:
+    """Pack strings into a flat utf-8 byte table with offsets.
+
+    Parameters
+    ----------
+    strings : Sequence[str]
+        The strings.
+
+    Returns
+    -------
+    Tuple[NDArray, NDArray]
+        The uint8 table and offsets with shape `(n + 1,)`. A string `i`
+        is `table[offsets[i]:offsets[i + 1]]`.
+    """
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    table = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return table, offsets
+
+
+def parse_coco_text_annotations(
+    annotation_path: Union[str, Path]
+) -> Tuple[Dict[str, NDArray], Dict[str, List[str]]]:
+    """Parse a coco text json annotation into flat arrays.
+
+    Parameters
+    ----------
+    annotation_path : Union[str, Path]
+        A path to the json annotation.
+
+    Returns
+    -------
+    Tuple[Dict[str, NDArray], Dict[str, List[str]]]
+        Arrays of all images: "bboxes" with shape `(n_obj, 4)`,
+        "classes" with shape `(n_obj,)` containing indexes
+        of class names, "obj_offsets" with shape `(n_img + 1,)`,
+        "sets" with shape `(n_img,)` containing indexes of set names
+        and the file names' table "names" with "name_offsets".
+        And the meta dict with "set_names" and "class_names".
+    """
+    with open(annotation_path) as f:
+        dset_anns = json.load(f)
+    imgs_to_anns = dset_anns['imgToAnns']
+    anns = dset_anns['anns']
+
+    set_names: Dict[str, int] = {}
+    class_names: Dict[str, int] = {}
+    bboxes = []
+    classes = []
+    n_objs = []
+    sets = []
+    file_names = []
+    for img_id, img_info in dset_anns['imgs'].items():
+        sets.append(set_names.setdefault(img_info['set'], len(set_names)))
+        file_names.append(img_info['file_name'])
+        anns_ids = imgs_to_anns[img_id]
+        n_objs.append(len(anns_ids))
+        for ann_id in map(str, anns_ids):
+            bboxes.append(anns[ann_id]['bbox'])
+            classes.append(class_names.setdefault(
+                anns[ann_id]['legibility'], len(class_names)))
+
+    obj_offsets = np.zeros(len(n_objs) + 1, dtype=np.int64)
+    np.cumsum(n_objs, out=obj_offsets[1:])
+    names, name_offsets = _encode_strings(file_names)
+    arrays = {
+        'bboxes': np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+        'classes': np.array(classes, dtype=np.int16),
+        'obj_offsets': obj_offsets,
+        'sets': np.array(sets, dtype=np.int8),
+        'names': names,
+        'name_offsets': name_offsets
+    }
+    meta = {'set_names': list(set_names), 'class_names': list(class_names)}
+    return arrays, meta
+
+
+def compile_annotation_index(
+    annotation_path: Union[str, Path], index_dir: Union[str, Path]
+) -> None:
+    """Compile a coco text json annotation into a memory-mappable index.
+
+    The index directory contains flat `.npy` arrays that are described
+    in `parse_coco_text_annotations` and "meta.json".
+    `TextDetectionCocoDataset` opens them with memory mapping, so it starts
+    without json parsing and DataLoader workers share the pages.
+
+    Parameters
+    ----------
+    annotation_path : Union[str, Path]
+        A path to the json annotation.
+    index_dir : Union[str, Path]
+        A directory to save the index.
+    """
+    arrays, meta = parse_coco_text_annotations(annotation_path)
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(index_dir / f'{name}.npy', array)
+    with open(index_dir / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def load_annotation_index(
+    index_dir: Union[str, Path]
+) -> Tuple[Dict[str, NDArray], Dict[str, List[str]]]:
+    """Open a compiled annotation index with memory mapping.
+
+    Parameters
+    ----------
+    index_dir : Union[str, Path]
+        A directory of the index made by `compile_annotation_index`.
+
+    Returns
+    -------
+    Tuple[Dict[str, NDArray], Dict[str, List[str]]]
+        The memory-mapped arrays and the meta dict.
+    """
+    index_dir = Path(index_dir)
+    arrays = {name: np.load(index_dir / f'{name}.npy', mmap_mode='r')
+              for name in INDEX_ARRAYS}
+    with open(index_dir / 'meta.json') as f:
+        meta = json.load(f)
+    return arrays, meta
 
 
 class TextDetectionCocoDataset(Dataset):
@@ -18,6 +155,22 @@ class TextDetectionCocoDataset(Dataset):
     image uint8 ndarray with shape `(H, W, C)`,
     ground truth bounding boxes list with shape `(n_obj, 4)`,
     corresponding ground truth classes list with shape `(n_obj,)`.
+
+    With transforms boxes and classes are tensors. By default they are
+    padded with -1 to the set's maximum number of objects, so the default
+    collate can stack them. With `pad=False` they are not padded
+    and batches are made with `collate_detection_batch`.
+
+    Annotations are kept in flat arrays. `annotation_path` can be
+    the json annotation or an index directory made
+    by `compile_annotation_index`. The index is memory-mapped, so
+    the dataset is created instantly and its annotations are shared
+    between DataLoader workers instead of being copied on write.
+
+    With `image_cache_dir` images are decoded once and then read
+    from an `ImageCache`. With `min_image_size` jpeg images are decoded
+    at 1/2, 1/4 or 1/8 resolution when it is not smaller than this size.
+    Boxes of downscaled images are scaled too.
     """
     def __init__(
         self,
@@ -25,56 +178,101 @@ class TextDetectionCocoDataset(Dataset):
         img_dir: Union[str, Path],
         dset_type: str,
         name2index: Dict[str, int],
-        transforms: Callable = None
+        transforms: Callable = None,
+        pad: bool = True,
+        image_cache_dir: Optional[Union[str, Path]] = None,
+        image_cache_max_side: Optional[int] = None,
+        min_image_size: Optional[Tuple[int, int]] = None
     ):
         if dset_type not in {'train', 'val', 'test'}:
             raise ValueError(
                 'Wrong set type received.'
                 'dset_type must be on of ("train", "val", "test")')
 
-        with open(annotation_path) as f:
-            json_dset = f.read()
-        dset_anns = json.loads(json_dset)
-
-        # Get images annotations for defined set
-        imgs_info = dict(filter(
-            lambda img_item: img_item[1]['set'] == dset_type,
-            dset_anns['imgs'].items()))
-        imgs_to_anns = dset_anns['imgToAnns']
-        anns = dset_anns['anns']
-
-        # Collect paths, bboxes and corresponding classes
-        dset_bboxes = []
-        dset_classes = []
-        self.img_pths = []
-        for img_id, img_info in imgs_info.items():
-
-            self.img_pths.append(
-                Path(img_dir) / dset_type / img_info['file_name'])
-            
-            anns_ids = list(map(str, imgs_to_anns[img_id]))
-            
-            sample_bboxes: List[List[float]] = []
-            sample_classes: List[int] = []
-            for ann_id in anns_ids:
-                sample_bboxes.append(anns[ann_id]['bbox'])
-                sample_classes.append(name2index[anns[ann_id]['legibility']])
-
-            dset_bboxes.append(sample_bboxes)
-            dset_classes.append(sample_classes)
-        self.bboxes = dset_bboxes
-        self.classes = dset_classes
+        if Path(annotation_path).is_dir():
+            arrays, meta = load_annotation_index(annotation_path)
+        else:
+            arrays, meta = parse_coco_text_annotations(annotation_path)
+        self.bboxes = arrays['bboxes']
+        self.obj_offsets = arrays['obj_offsets']
+        self.names = arrays['names']
+        self.name_offsets = arrays['name_offsets']
+        # Stored class indexes are converted lazily with this lookup
+        self.classes = arrays['classes']
+        self.class_names = meta['class_names']
+        self.class_lookup = np.array(
+            [name2index[name] for name in meta['class_names']],
+            dtype=np.int64)
+
+        # Get images of defined set
+        if dset_type in meta['set_names']:
+            self.img_idxs = np.flatnonzero(
+                arrays['sets'] == meta['set_names'].index(dset_type))
+        else:
+            self.img_idxs = np.zeros(0, dtype=np.int64)
+        self.img_dir = Path(img_dir) / dset_type
 
         self.transforms = transforms
+        self.pad = pad
+        self.min_image_size = min_image_size
+        if image_cache_dir is None:
+            self.image_cache = None
+        else:
+            self.image_cache = ImageCache(
+                image_cache_dir, len(self), image_cache_max_side)
 
-        # Calculate n_max_obj for padding
-        self.n_max_obj = 0
-        for img_anns_ids in imgs_to_anns.values():
-            if self.n_max_obj < len(img_anns_ids):
-                self.n_max_obj = len(img_anns_ids)
+        # Calculate n_max_obj of this set for padding
+        n_objs = np.diff(self.obj_offsets)[self.img_idxs]
+        self.n_max_obj = int(n_objs.max(initial=0))
 
     def __len__(self):
-        return len(self.img_pths)
+        return len(self.img_idxs)
+
+    def get_image_path(self, idx: int) -> Path:
+        """Get a path of a sample's image.
+
+        Parameters
+        ----------
+        idx : int
+            Index of the sample.
+
+        Returns
+        -------
+        Path
+            The image's path.
+        """
+        img_idx = self.img_idxs[idx]
+        file_name = self.names[
+            self.name_offsets[img_idx]:self.name_offsets[img_idx + 1]]
+        return self.img_dir / file_name.tobytes().decode()
+
+    def get_image(self, idx: int) -> Tuple[NDArray, Tuple[float, float]]:
+        """Get a sample's image through the image cache if it is given.
+
+        Parameters
+        ----------
+        idx : int
+            Index of the sample.
+
+        Returns
+        -------
+        Tuple[NDArray, Tuple[float, float]]
+            The image with shape `(h, w, c)` and x and y scale factors
+            of its boxes that are not 1 for downscaled images.
+        """
+        cached = None
+        if self.image_cache is not None:
+            cached = self.image_cache.get(idx)
+        if cached is None:
+            path = self.get_image_path(idx)
+            image, orig_size = read_image(
+                path, min_size=self.min_image_size, return_orig_size=True)
+            if self.image_cache is not None:
+                image = self.image_cache.put(idx, image, orig_size)
+        else:
+            image, orig_size = cached
+        orig_h, orig_w = orig_size
+        return image, (image.shape[1] / orig_w, image.shape[0] / orig_h)
 
     def __getitem__(
         self, idx: int
@@ -94,23 +292,186 @@ class TextDetectionCocoDataset(Dataset):
             bounding boxes list with shape `(n_obj, 4)`
             and classes list with shape `(n_obj,)`.
         """
-        image = read_image(self.img_pths[idx])  # ndarray
-        bboxes = self.bboxes[idx]  # list[list[float]]
-        classes = self.classes[idx]  # list[float]
+        img_idx = self.img_idxs[idx]
+        start, end = self.obj_offsets[img_idx:img_idx + 2]
+        image, (x_scale, y_scale) = self.get_image(idx)  # ndarray
+        bboxes = self.bboxes[start:end]
+        if x_scale != 1.0 or y_scale != 1.0:
+            bboxes = bboxes * np.array([x_scale, y_scale] * 2)
+        bboxes = bboxes.tolist()  # list[list[float]]
+        classes = self.class_lookup[
+            self.classes[start:end]].tolist()  # list[float]
 
         if self.transforms:
-            transformed = self.transforms(
-                image=image, bboxes=bboxes, classes=classes)
-            image = transformed['image']  # tensor
-            bboxes = transformed['bboxes']  # list[list[float]]
-            classes = transformed['classes']  # list[float]
-
-            # Pad values bboxes and classes after transforms
-            n_pad = self.n_max_obj - len(bboxes)
-            bboxes = torch.vstack(  # tensor
-                (torch.tensor(bboxes, dtype=torch.float32).view(size=(-1, 4)),
-                 torch.ones(n_pad, 4, dtype=torch.float32) * -1.0))
-            classes = torch.hstack(  # tensor
-                (torch.tensor(classes, dtype=torch.float32),
-                 torch.ones(n_pad, dtype=torch.float32) * -1.0))
+            return transform_sample(
+                self.transforms, image, bboxes, classes,
+                self.n_max_obj if self.pad else None)
         return (image, bboxes, classes)
+
+
+def transform_sample(
+    transforms: Callable,
+    image: NDArray,
+    bboxes: List[List[float]],
+    classes: List[float],
+    n_max_obj: Optional[int] = None
+) -> Tuple[Any, FloatTensor, FloatTensor]:
+    """Transform a detection sample and convert its targets to tensors.
+
+    Parameters
+    ----------
+    transforms : Callable
+        Albumentations-like transforms.
+    image : NDArray
+        An image with shape `(h, w, c)`.
+    bboxes : List[List[float]]
+        Bounding boxes with shape `(n_obj, 4)`.
+    classes : List[float]
+        Classes with shape `(n_obj,)`.
+    n_max_obj : Optional[int], optional
+        A number of objects to pad boxes and classes to with -1.
+        If not given then they are not padded.
+
+    Returns
+    -------
+    Tuple[Any, FloatTensor, FloatTensor]
+        The transformed image, boxes with shape `(n_obj, 4)`
+        and classes with shape `(n_obj,)`.
+    """
+    transformed = transforms(image=image, bboxes=bboxes, classes=classes)
+    image = transformed['image']  # tensor
+    bboxes = transformed['bboxes']  # list[list[float]]
+    classes = transformed['classes']  # list[float]
+
+    # Pad values bboxes and classes after transforms
+    n_pad = n_max_obj - len(bboxes) if n_max_obj is not None else 0
+    bboxes = torch.vstack(  # tensor
+        (torch.tensor(bboxes, dtype=torch.float32).view(size=(-1, 4)),
+         torch.ones(n_pad, 4, dtype=torch.float32) * -1.0))
+    classes = torch.hstack(  # tensor
+        (torch.tensor(classes, dtype=torch.float32),
+         torch.ones(n_pad, dtype=torch.float32) * -1.0))
+    return (image, bboxes, classes)
+
+
+def _collate_targets(
+    batch_bboxes: Sequence[Any],
+    batch_classes: Sequence[Any],
+    ragged: bool = False
+) -> Union[Tuple[FloatTensor, FloatTensor],
+           Tuple[FloatTensor, FloatTensor, IntTensor]]:
+    """Collate boxes and classes of samples with per-batch padding.
+
+    Parameters
+    ----------
+    batch_bboxes : Sequence[Any]
+        Boxes of samples with shapes `(n_obj, 4)`.
+    batch_classes : Sequence[Any]
+        Classes of samples with shapes `(n_obj,)`.
+    ragged : bool, optional
+        Whether to return flat boxes and classes with offsets.
+        By default is `False`.
+
+    Returns
+    -------
+    Union[Tuple[FloatTensor, FloatTensor],
+          Tuple[FloatTensor, FloatTensor, IntTensor]]
+        Boxes and classes that are described in `collate_detection_batch`.
+    """
+    bboxes = []
+    classes = []
+    for sample_bboxes, sample_classes in zip(batch_bboxes, batch_classes):
+        sample_bboxes = torch.as_tensor(
+            sample_bboxes, dtype=torch.float32).view(-1, 4)
+        sample_classes = torch.as_tensor(sample_classes, dtype=torch.float32)
+        # Drop padding of samples that are padded by the dataset
+        not_pad = (sample_bboxes != -1).any(dim=1)
+        bboxes.append(sample_bboxes[not_pad])
+        classes.append(sample_classes[not_pad])
+
+    if ragged:
+        n_objs = torch.tensor([len(sample_bboxes) for sample_bboxes in bboxes])
+        offsets = torch.cat(
+            (torch.zeros(1, dtype=torch.int64), torch.cumsum(n_objs, 0)))
+        return torch.cat(bboxes), torch.cat(classes), offsets
+    return (pad_sequence(bboxes, batch_first=True, padding_value=-1.0),
+            pad_sequence(classes, batch_first=True, padding_value=-1.0))
+
+
+def collate_detection_batch(
+    batch: Sequence[Tuple[FloatTensor, FloatTensor, FloatTensor]],
+    ragged: bool = False
+) -> Union[Tuple[FloatTensor, FloatTensor, FloatTensor],
+           Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor]]:
+    """Collate transformed detection samples with per-batch padding.
+
+    Boxes and classes are padded with -1 only to the batch's maximum
+    number of objects. Samples that are already padded are trimmed first.
+
+    Parameters
+    ----------
+    batch : Sequence[Tuple[FloatTensor, FloatTensor, FloatTensor]]
+        Samples that contain an image tensor with shape `(c, h, w)`,
+        boxes with shape `(n_obj, 4)` and classes with shape `(n_obj,)`.
+    ragged : bool, optional
+        Whether to return flat boxes and classes of all images
+        with offsets of every image instead of padding them.
+        By default is `False`.
+
+    Returns
+    -------
+    Union[Tuple[FloatTensor, FloatTensor, FloatTensor],
+          Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor]]
+        Images with shape `(b, c, h, w)`, boxes with shape
+        `(b, n_max_obj, 4)` and classes with shape `(b, n_max_obj)`.
+        In the ragged mode boxes have shape `(n_obj, 4)`, classes
+        have shape `(n_obj,)` and offsets with shape `(b + 1,)` are added.
+        Objects of an image `i` are `boxes[offsets[i]:offsets[i + 1]]`.
+    """
+    images = torch.stack([sample[0] for sample in batch])
+    return (images, *_collate_targets(
+        [sample[1] for sample in batch], [sample[2] for sample in batch],
+        ragged))
+
+
+def collate_uint8_detection_batch(
+    batch: Sequence[Tuple[NDArray, List[List[float]], List[float]]],
+    ragged: bool = False
+) -> Union[Tuple[Tensor, IntTensor, FloatTensor, FloatTensor],
+           Tuple[Tensor, IntTensor, FloatTensor, FloatTensor, IntTensor]]:
+    """Collate not transformed detection samples of different sizes.
+
+    Images stay uint8 and are padded with zeros to the batch's maximum
+    size, so they are transformed as a batch
+    with `dataset.batch_augmentation.BatchDetectionAugmentation`.
+
+    Parameters
+    ----------
+    batch : Sequence[Tuple[NDArray, List[List[float]], List[float]]]
+        Samples without transforms that contain an RGB uint8 image
+        with shape `(h, w, c)`, boxes with shape `(n_obj, 4)`
+        and classes with shape `(n_obj,)`.
+    ragged : bool, optional
+        Whether to return flat boxes and classes of all images
+        with offsets of every image instead of padding them.
+        By default is `False`.
+
+    Returns
+    -------
+    Union[Tuple[Tensor, IntTensor, FloatTensor, FloatTensor],
+          Tuple[Tensor, IntTensor, FloatTensor, FloatTensor, IntTensor]]
+        Images with shape `(b, c, max_h, max_w)`, their heights
+        and widths with shape `(b, 2)` and boxes, classes and offsets
+        like in `collate_detection_batch`.
+    """
+    image_sizes = torch.tensor(
+        [sample[0].shape[:2] for sample in batch], dtype=torch.int64)
+    max_h, max_w = image_sizes.max(dim=0).values.tolist()
+    images = torch.zeros(
+        (len(batch), batch[0][0].shape[2], max_h, max_w), dtype=torch.uint8)
+    for i, (image, _, _) in enumerate(batch):
+        images[i, :, :image.shape[0], :image.shape[1]] = (
+            torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1))
+    return (images, image_sizes, *_collate_targets(
+        [sample[1] for sample in batch], [sample[2] for sample in batch],
+        ragged))
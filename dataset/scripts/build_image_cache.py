@@ -0,0 +1,38 @@
+"""Script to fill decoded image caches of the coco text dataset ahead of time.
+
+Otherwise caches are filled lazily during the first training epoch.
+"""
+
+from pathlib import Path
+import sys
+
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).parents[2]))
+from dataset.object_detection_dataset import TextDetectionCocoDataset
+
+
+def main():
+    anns_pth = DSET_DIR / 'parsed_cocotext.json'
+    img_dir = DSET_DIR / 'images'
+    name2index = {'pad': -1, 'legible': 0, 'illegible': 1}
+
+    for dset_type in DSET_TYPES:
+        dset = TextDetectionCocoDataset(
+            annotation_path=anns_pth, img_dir=img_dir, dset_type=dset_type,
+            name2index=name2index, image_cache_dir=CACHE_DIR / dset_type,
+            image_cache_max_side=MAX_SIDE)
+
+        desc = f'Cache {dset_type} images'
+        for i in tqdm(range(len(dset)), desc=desc):
+            if i not in dset.image_cache:
+                dset.get_image(i)
+
+
+if __name__ == '__main__':
+    DSET_DIR = Path(__file__).parents[2] / 'data'
+    CACHE_DIR = DSET_DIR / 'image_cache'
+    DSET_TYPES = ('train', 'val')
+    # Images are stored in the original size if None
+    MAX_SIDE = None
+    main()
@@ -0,0 +1,39 @@
+"""Script to pack the coco text dataset into tar shards.
+
+`ShardedDetectionDataset` streams the shards with big sequential reads
+that suit network-mounted storage.
+"""
+
+from pathlib import Path
+import sys
+
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).parents[2]))
+from dataset.object_detection_dataset import TextDetectionCocoDataset
+from dataset.sharded_dataset import coco_shard_samples, write_shards
+
+
+def main():
+    anns_pth = DSET_DIR / 'parsed_cocotext.json'
+    img_dir = DSET_DIR / 'images'
+    name2index = {'pad': -1, 'legible': 0, 'illegible': 1}
+
+    for dset_type in DSET_TYPES:
+        dset = TextDetectionCocoDataset(
+            annotation_path=anns_pth, img_dir=img_dir, dset_type=dset_type,
+            name2index=name2index)
+        desc = f'Write {dset_type} shards'
+        shard_pths = write_shards(
+            tqdm(coco_shard_samples(dset), desc=desc, total=len(dset)),
+            SHARDS_DIR / dset_type, max_shard_size=MAX_SHARD_SIZE)
+        print(f'{len(dset)} {dset_type} samples are written '
+              f'to {len(shard_pths)} shards')
+
+
+if __name__ == '__main__':
+    DSET_DIR = Path(__file__).parents[2] / 'data'
+    SHARDS_DIR = DSET_DIR / 'shards'
+    DSET_TYPES = ('train', 'val')
+    MAX_SHARD_SIZE = 256 * 1024 ** 2
+    main()
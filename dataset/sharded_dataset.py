@@ -0,0 +1,322 @@
+"""A module that contains a sharded sequential detection dataset format.
+
+Samples are packed into big tar shards. A sample is a pair of members
+with a common key: `{key}.{ext}` with the original encoded image
+and `{key}.json` with its "bboxes" and "labels" names. Shards are read
+sequentially, so reads from network storage are big and sequential
+instead of random reads of small images. A list of shards with their
+sample counts is saved to "shards.json".
+"""
+
+
+from io import BytesIO
+import json
+from pathlib import Path
+import random
+import tarfile
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union)
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataset.object_detection_dataset import (
+    TextDetectionCocoDataset, transform_sample)
+from utils.cvat_utils.cvat_datasets import CvatObjectDetectionDataset
+from utils.data_utils.datasets import BaseObjectDetectionDataset
+from utils.image_utils.image_functions import decode_image
+
+
+ShardSample = Tuple[Path, List[List[float]], List[str]]
+
+
+def coco_shard_samples(
+    dset: TextDetectionCocoDataset
+) -> Iterator[ShardSample]:
+    """Get samples of a coco text dataset for `write_shards`.
+
+    Parameters
+    ----------
+    dset : TextDetectionCocoDataset
+        The dataset.
+
+    Yields
+    ------
+    ShardSample
+        An image path, bounding boxes and label names.
+    """
+    for idx, img_idx in enumerate(dset.img_idxs):
+        start, end = dset.obj_offsets[img_idx:img_idx + 2]
+        labels = [dset.class_names[cls] for cls in dset.classes[start:end]]
+        yield dset.get_image_path(idx), dset.bboxes[start:end].tolist(), labels
+
+
+def cvat_shard_samples(
+    dset: CvatObjectDetectionDataset,
+    img_dir: Optional[Union[str, Path]] = None
+) -> Iterator[ShardSample]:
+    """Get samples of a CVAT dataset for `write_shards`.
+
+    Parameters
+    ----------
+    dset : CvatObjectDetectionDataset
+        The dataset.
+    img_dir : Optional[Union[str, Path]], optional
+        A directory of the images. By default it is "images"
+        in the dataset's directory.
+
+    Yields
+    ------
+    ShardSample
+        An image path, bounding boxes and label names.
+    """
+    img_dir = Path(img_dir) if img_dir else dset.dset_pth / 'images'
+    for sample in dset.samples:
+        yield (img_dir / sample['name'], list(map(list, sample['bboxes'])),
+               sample['labels'])
+
+
+def base_shard_samples(
+    dset: BaseObjectDetectionDataset, set_name: str
+) -> Iterator[ShardSample]:
+    """Get samples of a subset of a custom dataset for `write_shards`.
+
+    Parameters
+    ----------
+    dset : BaseObjectDetectionDataset
+        The dataset.
+    set_name : str
+        A name of the subset.
+
+    Yields
+    ------
+    ShardSample
+        An image path, bounding boxes and label names.
+    """
+    for sample in dset[set_name]:
+        annots = sample.get_annotations()
+        bboxes = [[annot.x1, annot.y1, annot.x2, annot.y2]
+                  for annot in annots]
+        labels = [annot.label for annot in annots]
+        yield sample.get_image_path(), bboxes, labels
+
+
+def _add_tar_member(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, BytesIO(data))
+
+
+def write_shards(
+    samples: Iterable[ShardSample],
+    shards_dir: Union[str, Path],
+    max_shard_size: int = 256 * 1024 ** 2,
+    max_shard_samples: Optional[int] = None
+) -> List[Path]:
+    """Pack detection samples into tar shards.
+
+    Images are stored as they are encoded without re-encoding.
+
+    Parameters
+    ----------
+    samples : Iterable[ShardSample]
+        Samples that contain an image path, bounding boxes in "xyxy"
+        format and label names. They can be gotten
+        with `coco_shard_samples`, `cvat_shard_samples`
+        or `base_shard_samples`.
+    shards_dir : Union[str, Path]
+        A directory to save the shards.
+    max_shard_size : int, optional
+        A size of a shard in bytes after which a new shard is started.
+        By default is 256 MiB.
+    max_shard_samples : Optional[int], optional
+        A maximum number of samples in a shard.
+
+    Returns
+    -------
+    List[Path]
+        Paths of the written shards.
+    """
+    shards_dir = Path(shards_dir)
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    shard_counts: Dict[str, int] = {}
+    tar = None
+    shard_name = ''
+    shard_size = 0
+    for key, (img_pth, bboxes, labels) in enumerate(samples):
+        if tar is None or shard_size >= max_shard_size or (
+                max_shard_samples is not None and
+                shard_counts[shard_name] >= max_shard_samples):
+            if tar is not None:
+                tar.close()
+            shard_name = f'shard-{len(shard_counts):06d}.tar'
+            tar = tarfile.open(shards_dir / shard_name, 'w')
+            shard_counts[shard_name] = 0
+            shard_size = 0
+
+        img_pth = Path(img_pth)
+        image_data = img_pth.read_bytes()
+        ann_data = json.dumps({
+            'name': img_pth.name, 'bboxes': bboxes, 'labels': labels
+        }).encode()
+        _add_tar_member(
+            tar, f'{key:09d}{img_pth.suffix.lower()}', image_data)
+        _add_tar_member(tar, f'{key:09d}.json', ann_data)
+        shard_counts[shard_name] += 1
+        shard_size += len(image_data) + len(ann_data)
+    if tar is not None:
+        tar.close()
+
+    with open(shards_dir / 'shards.json', 'w') as f:
+        json.dump(shard_counts, f, indent=1)
+    return [shards_dir / shard_name for shard_name in shard_counts]
+
+
+def iterate_shard(
+    shard_pth: Union[str, Path]
+) -> Iterator[Tuple[bytes, Dict[str, Any]]]:
+    """Read samples of a shard sequentially.
+
+    Parameters
+    ----------
+    shard_pth : Union[str, Path]
+        A path to the shard.
+
+    Yields
+    ------
+    Tuple[bytes, Dict[str, Any]]
+        An encoded image and its annotation.
+    """
+    image_data = ann = None
+    key = None
+    with tarfile.open(shard_pth, 'r|') as tar:
+        for member in tar:
+            member_key, ext = member.name.split('.', 1)
+            if member_key != key:
+                image_data = ann = None
+                key = member_key
+            data = tar.extractfile(member).read()
+            if ext == 'json':
+                ann = json.loads(data)
+            else:
+                image_data = data
+            if image_data is not None and ann is not None:
+                yield image_data, ann
+                image_data = ann = None
+
+
+class ShardedDetectionDataset(IterableDataset):
+    """A streaming detection dataset over tar shards.
+
+    Every epoch shards are shuffled and split between DataLoader workers,
+    so there should be at least as many shards as workers. Samples
+    of a worker are additionally shuffled with a buffer of encoded images.
+
+    Samples are the same as `TextDetectionCocoDataset` ones with `pad=False`
+    and batches are made with `collate_detection_batch`. With
+    `min_image_size` jpeg images are decoded at a reduced resolution
+    like there.
+    """
+
+    def __init__(
+        self,
+        shards_dir: Union[str, Path],
+        name2index: Dict[str, int],
+        transforms: Callable = None,
+        shuffle: bool = True,
+        buffer_size: int = 1000,
+        seed: int = 0,
+        min_image_size: Optional[Tuple[int, int]] = None
+    ) -> None:
+        """Initialize `ShardedDetectionDataset`.
+
+        Parameters
+        ----------
+        shards_dir : Union[str, Path]
+            A directory with shards made by `write_shards`.
+        name2index : Dict[str, int]
+            Label name to class index converter.
+        transforms : Callable, optional
+            Albumentations-like transforms.
+        shuffle : bool, optional
+            Whether to shuffle shards and samples. By default is `True`.
+        buffer_size : int, optional
+            A number of samples in a shuffle buffer of a worker.
+            By default is 1000.
+        seed : int, optional
+            A seed of shuffling. It is combined with an epoch
+            that is set with `set_epoch`. By default is 0.
+        min_image_size : Optional[Tuple[int, int]], optional
+            A minimum needed height and width of images. Jpeg images
+            are decoded at 1/2, 1/4 or 1/8 resolution when it is not
+            smaller and their boxes are scaled.
+        """
+        shards_dir = Path(shards_dir)
+        with open(shards_dir / 'shards.json') as f:
+            shard_counts: Dict[str, int] = json.load(f)
+        self.shard_pths = [shards_dir / name for name in shard_counts]
+        self.n_samples = sum(shard_counts.values())
+        self.name2index = name2index
+        self.transforms = transforms
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.min_image_size = min_image_size
+        self.epoch = 0
+
+    def __len__(self) -> int:
+        return self.n_samples
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set an epoch to get a new order of samples.
+
+        Parameters
+        ----------
+        epoch : int
+            The epoch.
+        """
+        self.epoch = epoch
+
+    def _shuffle_buffer(
+        self, samples: Iterator[Any], rng: random.Random
+    ) -> Iterator[Any]:
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator[Any]:
+        shard_pths = list(self.shard_pths)
+        # The shard order is the same in all workers before splitting
+        rng = random.Random(self.seed * 1_000_003 + self.epoch)
+        if self.shuffle:
+            rng.shuffle(shard_pths)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shard_pths = shard_pths[worker_info.id::worker_info.num_workers]
+            rng = random.Random(rng.getrandbits(32) + worker_info.id)
+
+        samples = (sample for shard_pth in shard_pths
+                   for sample in iterate_shard(shard_pth))
+        if self.shuffle:
+            samples = self._shuffle_buffer(samples, rng)
+        for image_data, ann in samples:
+            image, (orig_h, orig_w) = decode_image(
+                image_data, min_size=self.min_image_size,
+                return_orig_size=True)
+            bboxes = ann['bboxes']
+            h, w = image.shape[:2]
+            if (h, w) != (orig_h, orig_w):
+                scale = np.array([w / orig_w, h / orig_h] * 2)
+                bboxes = (np.array(bboxes).reshape(-1, 4) * scale).tolist()
+            classes = [self.name2index[label] for label in ann['labels']]
+            if self.transforms:
+                yield transform_sample(self.transforms, image, bboxes, classes)
+            else:
+                yield image, bboxes, classes
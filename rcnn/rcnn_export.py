@@ -0,0 +1,213 @@
+"""A module that contains R-CNN export functions.
+
+An exported model is a self-contained TorchScript module that can be loaded
+and run with `rcnn.rcnn_runtime` without the training code.
+"""
+
+
+from pathlib import Path
+from typing import Tuple, Optional, Union
+
+import torch
+from torch import FloatTensor, IntTensor
+import torch.nn as nn
+
+from rcnn.rcnn_model import RCNN_Detector
+from rcnn.rcnn_utils import count_per_image
+
+
+class RCNN_InferenceModule(nn.Module):
+    """R-CNN inference graph with packed outputs.
+
+    Unlike `RCNN_Detector.inference` it does not return lists of tensors.
+    Predictions of the whole batch are packed into flat tensors
+    and per-image counts, so the graph can be traced and serialized.
+    """
+
+    def __init__(
+        self,
+        detector: RCNN_Detector,
+        conf_thresh: float = 0.5,
+        nms_thresh: float = 0.7,
+        pre_nms_top_k: Optional[int] = None,
+        post_nms_top_k: Optional[int] = None
+    ) -> None:
+        """Initialize `RCNN_InferenceModule`.
+
+        Parameters
+        ----------
+        detector : RCNN_Detector
+            A trained detector.
+        conf_thresh : float, optional
+            Object confidence threshold. By default is 0.5.
+        nms_thresh : float, optional
+            IoU NMS threshold. By default is 0.7.
+        pre_nms_top_k : Optional[int], optional
+            A maximum number of the most confident anchors per image
+            that are considered before NMS. By default is `None`
+            that means no limit.
+        post_nms_top_k : Optional[int], optional
+            A maximum number of proposals per image that are kept after NMS.
+            By default is `None` that means no limit.
+        """
+        super().__init__()
+        self.detector = detector
+        self.conf_thresh = conf_thresh
+        self.nms_thresh = nms_thresh
+        self.pre_nms_top_k = pre_nms_top_k
+        self.post_nms_top_k = post_nms_top_k
+
+    def forward(
+        self, images: FloatTensor
+    ) -> Tuple[FloatTensor, FloatTensor, IntTensor, IntTensor]:
+        """Predict bounding boxes for a batch of images.
+
+        Parameters
+        ----------
+        images : FloatTensor
+            A batch of the input images with shape `(b, 3, img_h, img_w)`.
+
+        Returns
+        -------
+        Tuple[FloatTensor, FloatTensor, IntTensor, IntTensor]
+            Bounding boxes of the whole batch with shape `(n_pred, 4)`,
+            corresponding class confidences with shape `(n_pred,)`,
+            class labels with shape `(n_pred,)`
+            and counts of predictions per image with shape `(b,)`.
+            Predictions are grouped by image.
+        """
+        feature_maps, proposals, _, pos_b_idxs = self.detector.rpn.inference(
+            images, conf_thresh=self.conf_thresh, nms_thresh=self.nms_thresh,
+            pre_nms_top_k=self.pre_nms_top_k,
+            post_nms_top_k=self.post_nms_top_k)
+
+        # RoIs with batch indexes instead of a list of tensors
+        rois = self.detector.get_rois(
+            images, feature_maps, proposals, pos_b_idxs)
+        cls_scores = self.detector.classifier.inference(feature_maps, rois)
+        cls_conf = self.detector.softmax(cls_scores)[:, :self.detector.n_cls]
+        scores, labels = cls_conf.max(dim=1)
+        counts = count_per_image(pos_b_idxs, images.shape[0])
+        return proposals, scores, labels, counts
+
+
+def export_torchscript(
+    detector: RCNN_Detector,
+    save_path: Union[Path, str],
+    input_size: Tuple[int, int],
+    conf_thresh: float = 0.5,
+    nms_thresh: float = 0.7,
+    pre_nms_top_k: Optional[int] = None,
+    post_nms_top_k: Optional[int] = None,
+    device: Union[torch.device, str] = 'cpu'
+) -> torch.jit.ScriptModule:
+    """Export a detector's inference graph as a TorchScript module.
+
+    The graph is traced, so thresholds and the input size are fixed
+    while a batch size and a number of predictions stay dynamic.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A trained detector.
+    save_path : Union[Path, str]
+        A path to save the exported module.
+    input_size : Tuple[int, int]
+        A size of input images.
+    conf_thresh : float, optional
+        Object confidence threshold. By default is 0.5.
+    nms_thresh : float, optional
+        IoU NMS threshold. By default is 0.7.
+    pre_nms_top_k : Optional[int], optional
+        A maximum number of the most confident anchors per image
+        that are considered before NMS. By default is `None`
+        that means no limit.
+    post_nms_top_k : Optional[int], optional
+        A maximum number of proposals per image that are kept after NMS.
+        By default is `None` that means no limit.
+    device : Union[torch.device, str], optional
+        A device to trace on. By default is `"cpu"`.
+
+    Returns
+    -------
+    torch.jit.ScriptModule
+        The exported module.
+    """
+    if isinstance(save_path, str):
+        save_path = Path(save_path)
+    inference_module = RCNN_InferenceModule(
+        detector, conf_thresh, nms_thresh, pre_nms_top_k, post_nms_top_k)
+    inference_module.to(device=device)
+    inference_module.eval()
+
+    example = torch.rand(2, 3, *input_size, device=device)
+    with torch.no_grad():
+        scripted = torch.jit.trace(
+            inference_module, example, check_trace=False)
+
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(scripted, str(save_path))
+    return scripted
+
+
+def export_onnx(
+    detector: RCNN_Detector,
+    save_path: Union[Path, str],
+    input_size: Tuple[int, int],
+    conf_thresh: float = 0.5,
+    nms_thresh: float = 0.7,
+    pre_nms_top_k: Optional[int] = None,
+    post_nms_top_k: Optional[int] = None,
+    opset_version: int = 17
+) -> None:
+    """Export a detector's inference graph to ONNX.
+
+    The exported graph contains the backbone, the proposal head,
+    anchors decoding, NMS and RoI pooling. Thresholds and the input size
+    are fixed while a batch size and a number of predictions stay dynamic.
+    It has one input "images" and four outputs "bboxes", "scores", "labels"
+    and "counts" like `RCNN_InferenceModule`.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A trained detector.
+    save_path : Union[Path, str]
+        A path to save the exported model.
+    input_size : Tuple[int, int]
+        A size of input images.
+    conf_thresh : float, optional
+        Object confidence threshold. By default is 0.5.
+    nms_thresh : float, optional
+        IoU NMS threshold. By default is 0.7.
+    pre_nms_top_k : Optional[int], optional
+        A maximum number of the most confident anchors per image
+        that are considered before NMS. By default is `None`
+        that means no limit.
+    post_nms_top_k : Optional[int], optional
+        A maximum number of proposals per image that are kept after NMS.
+        By default is `None` that means no limit.
+    opset_version : int, optional
+        ONNX opset version. By default is 17.
+    """
+    if isinstance(save_path, str):
+        save_path = Path(save_path)
+    inference_module = RCNN_InferenceModule(
+        detector, conf_thresh, nms_thresh, pre_nms_top_k, post_nms_top_k)
+    inference_module.to(device='cpu')
+    inference_module.eval()
+
+    example = torch.rand(2, 3, *input_size)
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        # The graph has data dependent shapes, so the tracing based
+        # exporter is used
+        torch.onnx.export(
+            inference_module, (example,), str(save_path), dynamo=False,
+            opset_version=opset_version, input_names=['images'],
+            output_names=['bboxes', 'scores', 'labels', 'counts'],
+            dynamic_axes={'images': {0: 'b'},
+                          'bboxes': {0: 'n_pred'},
+                          'scores': {0: 'n_pred'},
+                          'labels': {0: 'n_pred'},
+                          'counts': {0: 'b'}})
@@ -1,24 +1,171 @@
 """A module that contains RCNN model class."""
 
-from typing import Tuple, Iterable, List
+from typing import (
+    Tuple, Iterable, List, Optional, Union, Dict, Any, Iterator)
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from functools import partial
+from pathlib import Path
 
 import torch
 from torch import FloatTensor, IntTensor
 import torch.nn.functional as F
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import torchvision
 import torchvision.ops as ops
 
 from rcnn.rcnn_utils import (
     generate_anchors, get_required_anchors, generate_anchor_boxes,
-    project_bboxes)
+    project_bboxes, batched_nms_per_image, bboxes_to_rois, ragged_to_padded,
+    AnchorGridCache, ProposalSampler)
+
+
+def autocast(device: torch.device, enabled: bool = True) -> torch.autocast:
+    """Get an automatic mixed precision context for a given device.
+
+    Bfloat16 is used on CPU and float16 on other devices.
+
+    Parameters
+    ----------
+    device : torch.device
+        A device where computations are done.
+    enabled : bool, optional
+        Whether to enable autocast. By default is `True`.
+
+    Returns
+    -------
+    torch.autocast
+        The autocast context manager.
+    """
+    dtype = torch.bfloat16 if device.type == 'cpu' else torch.float16
+    return torch.autocast(device.type, dtype=dtype, enabled=enabled)
+
+
+@contextmanager
+def _keep_bn_stats(module: nn.Module) -> Iterator[None]:
+    """Keep running statistics of a module's batch norms unchanged.
+
+    A checkpointed stage is recomputed on backward in the training mode,
+    so without it batch norms would count every batch twice.
+
+    Parameters
+    ----------
+    module : nn.Module
+        A module with batch norms.
+    """
+    bns = [m for m in module.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    states = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(bns, states):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _freeze_batch_norms(module: nn.Module) -> None:
+    """Replace batch norms of a module with frozen ones in place.
+
+    Parameters
+    ----------
+    module : nn.Module
+        A module with batch norms.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, nn.BatchNorm2d):
+            frozen_bn = ops.FrozenBatchNorm2d(child.num_features, child.eps)
+            for buffer in ('weight', 'bias', 'running_mean', 'running_var'):
+                getattr(frozen_bn, buffer).copy_(
+                    getattr(child, buffer).detach())
+            setattr(module, name, frozen_bn)
+        else:
+            _freeze_batch_norms(child)
 
 
 class FeatureExtractor(nn.Module):
-    """Feature extractor backbone."""
+    """Feature extractor backbone.
+
+    It returns either the last ResNet stage's feature map
+    or a feature pyramid built over layer2-layer4.
+    """
 
-    def __init__(self, model_name: str, input_size: Tuple[int, int]) -> None:
+    # Numbers of channels of the last ResNet stage
+    out_channels = {
+        'resnet18': 512,
+        'resnet34': 512,
+        'resnet50': 2048,
+        'resnet101': 2048,
+        'resnet152': 2048,
+    }
+    # The stem convolution, the max pooling and layer2-layer4
+    # halve a spatial size
+    n_downsamples = 5
+    # Indexes of layer2-layer4 in the backbone and numbers of halvings
+    # of their outputs (levels' strides are 8, 16 and 32)
+    fpn_stages = (5, 6, 7)
+    fpn_levels = (3, 4, 5)
+    # Indexes of layer1-layer4 in the backbone
+    residual_stages = (4, 5, 6, 7)
+    # A maximum number of frozen stages (the stem and layer1-layer4)
+    max_frozen_stages = 5
+
+    def __init__(
+        self,
+        model_name: str,
+        input_size: Tuple[int, int],
+        pretrained: bool = True,
+        fpn: bool = False,
+        fpn_channels: int = 256,
+        channels_last: bool = False,
+        checkpointing: bool = False,
+        frozen_stages: int = 0,
+        frozen_bn: bool = False
+    ) -> None:
+        """Initialize `FeatureExtractor`.
+
+        Parameters
+        ----------
+        model_name : str
+            A name of a backbone model. A resnet family is supported.
+        input_size : Tuple[int, int]
+            A default size of input images.
+        pretrained : bool, optional
+            Whether to load ImageNet pretrained weights. It can be disabled
+            when weights are loaded from a checkpoint anyway.
+            By default is `True`.
+        fpn : bool, optional
+            Whether to return a feature pyramid of layer2-layer4 outputs
+            instead of the last stage's feature map. By default is `False`.
+        fpn_channels : int, optional
+            A number of channels of the pyramid levels. By default is 256.
+        channels_last : bool, optional
+            Whether to keep convolutions' weights and activations
+            in channels last memory format. By default is `False`.
+        checkpointing : bool, optional
+            Whether to checkpoint layer1-layer4 in the training mode.
+            Their inner activations are not stored but recomputed
+            on backward. By default is `False`.
+        frozen_stages : int, optional
+            A number of frozen backbone stages from the first one:
+            0 - nothing is frozen, 1 - the stem, 2 - the stem and layer1
+            and so on up to 5 - the whole backbone. Frozen stages are not
+            trained, keep their batch norms in the evaluation mode and run
+            without storing activations. By default is 0.
+        frozen_bn : bool, optional
+            Whether to replace the backbone's batch norms with frozen
+            affine transforms of their statistics. By default is `False`.
+
+        Raises
+        ------
+        KeyError
+            Got model that is not supported.
+        ValueError
+            Got a wrong number of frozen stages.
+        """
         super().__init__()
 
         models = {
@@ -40,21 +187,99 @@ class FeatureExtractor(nn.Module):
         }
         if model_name not in models:
             raise KeyError('Got model that is not supported.')
+        if not 0 <= frozen_stages <= self.max_frozen_stages:
+            raise ValueError(
+                f'Got {frozen_stages} frozen stages but it must be from 0 '
+                f'to {self.max_frozen_stages}.')
         
-        # Get pretrained backbone
-        resnet = models[model_name]()
+        self.model_name = model_name
+
+        # Get backbone
+        if pretrained:
+            resnet = models[model_name]()
+        else:
+            resnet = models[model_name](weights=None)
         self.backbone = torch.nn.Sequential(*list(resnet.children())[:8])
 
-        # Check out shape
-        input_placeholder = torch.rand(1, 3, *input_size)
-        _, self.out_c, self.out_h, self.out_w = (
-            self.backbone(input_placeholder).shape)
+        self.out_c = self.out_channels[model_name]
+        self.out_h, self.out_w = self.get_out_size(input_size)
+
+        # Layer2 and layer3 have a quarter and a half of the last stage's
+        # channels
+        if fpn:
+            self.fpn = ops.FeaturePyramidNetwork(
+                [self.out_c // 4, self.out_c // 2, self.out_c], fpn_channels)
+            self.out_c = fpn_channels
+            self.level_sizes = [
+                self.get_out_size(input_size, level)
+                for level in self.fpn_levels]
+        else:
+            self.fpn = None
+            self.level_sizes = [(self.out_h, self.out_w)]
+
+        if frozen_bn:
+            _freeze_batch_norms(self.backbone)
+
+        # The stem consists of the first 4 modules and every next stage
+        # of 1 module
+        self.n_frozen = frozen_stages + 3 if frozen_stages else 0
+        for i, stage in enumerate(self.backbone):
+            for param in stage.parameters():
+                param.requires_grad = i >= self.n_frozen
+
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.checkpointing = checkpointing
+
+    def train(self, mode: bool = True) -> 'FeatureExtractor':
+        """Set the training mode except for the frozen stages.
 
-        # Unfreeze backbone
-        for param in self.backbone.parameters():
-            param.requires_grad = True
+        Parameters
+        ----------
+        mode : bool, optional
+            Whether to set the training mode. By default is `True`.
 
-    def forward(self, input_data: FloatTensor) -> FloatTensor:
+        Returns
+        -------
+        FeatureExtractor
+            Self.
+        """
+        super().train(mode)
+        for stage in self.backbone[:self.n_frozen]:
+            stage.eval()
+        return self
+
+    @classmethod
+    def get_out_size(
+        cls, input_size: Tuple[int, int], n_downsamples: Optional[int] = None
+    ) -> Tuple[int, int]:
+        """Get a size of a feature map for a given input size.
+
+        Parameters
+        ----------
+        input_size : Tuple[int, int]
+            A height and a width of an input image.
+        n_downsamples : Optional[int], optional
+            A number of the feature map's halvings. By default it is
+            the last stage's one.
+
+        Returns
+        -------
+        Tuple[int, int]
+            A height and a width of the feature map.
+        """
+        if n_downsamples is None:
+            n_downsamples = cls.n_downsamples
+        out_h, out_w = input_size
+        for _ in range(n_downsamples):
+            out_h = (out_h + 1) // 2
+            out_w = (out_w + 1) // 2
+        return out_h, out_w
+
+    def forward(
+        self, input_data: FloatTensor
+    ) -> Union[FloatTensor, List[FloatTensor]]:
         """Pass through backbone feature extractor.
 
         Parameters
@@ -64,10 +289,39 @@ class FeatureExtractor(nn.Module):
 
         Returns
         -------
-        FloatTensor
-            An output feature map with shape `(b, map_c, map_h, map_w)`.
+        Union[FloatTensor, List[FloatTensor]]
+            An output feature map with shape `(b, map_c, map_h, map_w)`
+            or, with FPN, a list of the pyramid levels' feature maps
+            from the finest to the coarsest one.
         """
-        return self.backbone(input_data)
+        if self.channels_last:
+            input_data = input_data.contiguous(
+                memory_format=torch.channels_last)
+        checkpointing = (self.checkpointing and self.training and
+                         torch.is_grad_enabled())
+        freezing = (self.n_frozen > 0 and self.training and
+                    torch.is_grad_enabled())
+        if self.fpn is None and not checkpointing and not freezing:
+            return self.backbone(input_data)
+
+        x = input_data
+        stage_outputs = OrderedDict()
+        for i, stage in enumerate(self.backbone):
+            if freezing and i < self.n_frozen:
+                with torch.no_grad():
+                    x = stage(x)
+            elif checkpointing and i in self.residual_stages:
+                x = checkpoint(
+                    stage, x, use_reentrant=False,
+                    context_fn=lambda stage=stage: (
+                        nullcontext(), _keep_bn_stats(stage)))
+            else:
+                x = stage(x)
+            if self.fpn is not None and i in self.fpn_stages:
+                stage_outputs[str(i)] = x
+        if self.fpn is None:
+            return x
+        return list(self.fpn(stage_outputs).values())
         
 
 class ProposalModule(nn.Module):
@@ -111,7 +365,7 @@ class ProposalModule(nn.Module):
 
     def forward(
         self,
-        feature_maps: FloatTensor,
+        feature_maps: Union[FloatTensor, List[FloatTensor]],
         pos_anc_idxs: IntTensor,
         neg_anc_idxs: IntTensor
     ) -> Tuple[FloatTensor, FloatTensor, FloatTensor]:
@@ -119,8 +373,10 @@ class ProposalModule(nn.Module):
 
         Parameters
         ----------
-        feature_maps : FloatTensor
-            A feature map tensor with shape `(b, n_channels, map_h, map_w)`.
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
+            A feature map tensor with shape `(b, n_channels, map_h, map_w)`
+            or a list of feature pyramid levels. Anchors of the levels
+            are indexed one after another.
         pos_anc_idxs : IntTensor
             Indexes of positive anchor boxes when batch tensor is flatten.
             Shape is `(n_pos_anc,)`.
@@ -135,14 +391,7 @@ class ProposalModule(nn.Module):
             with shapes `(n_pos_anc,)` and `(n_neg_anc,)`
             and offsets of positive anchors with shape `(n_pos_anc, 4)`.
         """
-        x = self.hidden_conv(feature_maps)
-        x = self.relu(x)
-        x = self.dropout(x)
-        conf_scores_pred: FloatTensor = self.conf_scores_head(x)
-        offsets_pred: FloatTensor = self.reg_head(x)
-
-        conf_scores_pred = conf_scores_pred.permute(0, 2, 3, 1)
-        offsets_pred = offsets_pred.permute(0, 2, 3, 1)
+        conf_scores_pred, offsets_pred = self.inference(feature_maps)
 
         pos_conf_scores = conf_scores_pred.flatten()[pos_anc_idxs]
         neg_conf_scores = conf_scores_pred.flatten()[neg_anc_idxs]
@@ -150,22 +399,37 @@ class ProposalModule(nn.Module):
         return pos_conf_scores, neg_conf_scores, pos_offsets
 
     def inference(
-        self, feature_maps: FloatTensor
+        self, feature_maps: Union[FloatTensor, List[FloatTensor]]
     ) -> Tuple[FloatTensor, FloatTensor]:
         """Inference pass of `ProposalModule`.
 
         Parameters
         ----------
-        feature_maps : FloatTensor
-            Backbone's feature maps.
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
+            Backbone's feature maps or a list of feature pyramid levels.
+            The heads are shared between the levels.
 
         Returns
         -------
         Tuple[FloatTensor, FloatTensor]
-            Object confidence scores with shape `(b, n_anc_box, map_h, map_w)`
+            Object confidence scores with shape `(b, map_h, map_w, n_anc_box)`
             and offsets for every anchor box
-            with shape `(b, n_anc_box * 4, map_h, map_w)`.
+            with shape `(b, map_h, map_w, n_anc_box * 4)`.
+            For a pyramid the levels' predictions are flattened
+            and concatenated into shapes `(b, n_anc)` and `(b, n_anc, 4)`.
         """
+        if isinstance(feature_maps, (list, tuple)):
+            levels_preds = [self.inference(level) for level in feature_maps]
+            b_size = feature_maps[0].shape[0]
+            conf_scores_pred = torch.cat(
+                [conf.reshape(b_size, -1) for conf, _ in levels_preds],
+                dim=1)
+            offsets_pred = torch.cat(
+                [offsets.reshape(b_size, -1, 4)
+                 for _, offsets in levels_preds],
+                dim=1)
+            return conf_scores_pred, offsets_pred
+
         x = self.hidden_conv(feature_maps)
         x = self.relu(x)
         x = self.dropout(x)
@@ -196,14 +460,34 @@ class RegionProposalNetwork(nn.Module):
         w_conf: float = 1.0,
         w_reg: float = 5.0,
         proposal_module_hid_dim: int = 512,
-        proposals_module_p_dropout: float = 0.3
+        proposals_module_p_dropout: float = 0.3,
+        anchor_cache_size: int = 8,
+        pretrained: bool = True,
+        fpn: bool = False,
+        fpn_channels: int = 256,
+        channels_last: bool = False,
+        checkpointing: bool = False,
+        frozen_stages: int = 0,
+        frozen_bn: bool = False,
+        max_iou_memory: int = 64 * 1024 ** 2,
+        spatial_matching: bool = False
     ) -> None:
         """Initialize region proposal network.
 
+        Input images can have any size. Anchor boxes grids for feature maps
+        that differ from the `input_size` one are generated on demand
+        and cached.
+
+        With FPN the proposal module is shared between layer2-layer4
+        pyramid levels. Anchor scales are given in units of a level's stride,
+        so every level has its own anchor sizes (from 16 pixels on the finest
+        level with the default scales). Anchors of all levels are kept
+        in image pixels.
+
         Parameters
         ----------
         input_size : Tuple[int, int]
-            Input images' size.
+            A default size of input images.
         backbone_model : str, optional
             A name of a backbone model. A resnet family is supported.
             By default it is equal `"resnet50"`.
@@ -224,9 +508,43 @@ class RegionProposalNetwork(nn.Module):
         w_reg : float, optional
             Weight coefficient for predicted offsets regression loss.
             By default is 5.0.
+        anchor_cache_size : int, optional
+            A maximum number of cached anchor boxes grids
+            for different feature map sizes. By default is 8.
+        pretrained : bool, optional
+            Whether to load pretrained backbone's weights.
+            By default is `True`.
+        fpn : bool, optional
+            Whether to predict proposals on a feature pyramid.
+            By default is `False`.
+        fpn_channels : int, optional
+            A number of channels of the pyramid levels. By default is 256.
+        channels_last : bool, optional
+            Whether to run the backbone and the proposal module
+            in channels last memory format. By default is `False`.
+        checkpointing : bool, optional
+            Whether to checkpoint the backbone's stages in the training
+            mode. By default is `False`.
+        frozen_stages : int, optional
+            A number of frozen backbone stages from the stem to layer4.
+            By default is 0.
+        frozen_bn : bool, optional
+            Whether to replace the backbone's batch norms with frozen ones.
+            By default is `False`.
+        max_iou_memory : int, optional
+            Approximate memory ceiling in bytes for IoU calculation
+            of one chunk of anchors while matching them with ground truth
+            boxes. By default is 64 MiB.
+        spatial_matching : bool, optional
+            Whether to calculate IoU only for intersecting anchor
+            and ground truth boxes. The matching is the same.
+            By default is `False`.
         """
         super().__init__()
-        self.feature_extractor = FeatureExtractor(backbone_model, input_size)
+        self.fpn = fpn
+        self.feature_extractor = FeatureExtractor(
+            backbone_model, input_size, pretrained, fpn, fpn_channels,
+            channels_last, checkpointing, frozen_stages, frozen_bn)
         self.backbone_c = self.feature_extractor.out_c
         self.backbone_h = self.feature_extractor.out_h
         self.backbone_w = self.feature_extractor.out_w
@@ -235,29 +553,192 @@ class RegionProposalNetwork(nn.Module):
             hidden_dim=proposal_module_hid_dim,
             n_anchors=len(anc_scales) * len(anc_ratios),
             p_dropout=proposals_module_p_dropout)
+        if channels_last:
+            self.proposal_module.to(memory_format=torch.channels_last)
         self.scores_sigmoid = nn.Sigmoid()
 
         self.pos_anc_thresh = pos_anc_thresh
         self.neg_anc_thresh = neg_anc_thresh
+        self.max_iou_memory = max_iou_memory
+        self.spatial_matching = spatial_matching
 
-        self.height_scale = input_size[0] // self.backbone_h
-        self.width_scale = input_size[1] // self.backbone_w
+        self.height_scale, self.width_scale = self.get_scale_factors(
+            input_size, (self.backbone_h, self.backbone_w))
 
         self.w_conf = w_conf
         self.w_reg = w_reg
 
-        x_anc_pts, y_anc_pts = generate_anchors(
-            (self.backbone_h, self.backbone_w))
-        anchor_grid = torch.nn.Parameter(generate_anchor_boxes(
-            x_anc_pts, y_anc_pts, anc_scales, anc_ratios,
-            (self.backbone_h, self.backbone_w)))
+        # The grid for the default input size is kept as a buffer
+        self.level_sizes = self.feature_extractor.level_sizes
+        self.anchor_cache = AnchorGridCache(
+            anc_scales, anc_ratios, anchor_cache_size)
+        if fpn:
+            anchor_grid = self._get_pyramid_anchors(
+                input_size, self.level_sizes)
+        else:
+            x_anc_pts, y_anc_pts = generate_anchors(
+                (self.backbone_h, self.backbone_w))
+            anchor_grid = torch.nn.Parameter(generate_anchor_boxes(
+                x_anc_pts, y_anc_pts, anc_scales, anc_ratios,
+                (self.backbone_h, self.backbone_w)))
         self.register_buffer('anchor_grid', anchor_grid)
 
+    def get_anchor_grid(self, map_size: Tuple[int, int]) -> FloatTensor:
+        """Get an anchor boxes grid for a feature map size.
+
+        Parameters
+        ----------
+        map_size : Tuple[int, int]
+            A height and a width of the feature map.
+
+        Returns
+        -------
+        FloatTensor
+            The anchor boxes grid with shape `[map_h, map_w, n_anc, 4]`.
+        """
+        map_h, map_w = map_size
+        if (map_h, map_w) == (self.backbone_h, self.backbone_w):
+            return self.anchor_grid
+        return self.anchor_cache.get(map_h, map_w, self.anchor_grid.device)
+
+    def _get_pyramid_anchors(
+        self,
+        image_size: Tuple[int, int],
+        map_sizes: List[Tuple[int, int]],
+        device: Optional[torch.device] = None
+    ) -> FloatTensor:
+        """Get anchor boxes of all pyramid levels in image pixels.
+
+        Parameters
+        ----------
+        image_size : Tuple[int, int]
+            A height and a width of the image.
+        map_sizes : List[Tuple[int, int]]
+            Heights and widths of the levels' feature maps.
+        device : Optional[torch.device], optional
+            A device of the anchors. If given then the levels' grids
+            are taken from the cache, otherwise they are generated.
+
+        Returns
+        -------
+        FloatTensor
+            The anchor boxes with shape `[n_anc, 4]`. Levels go one after
+            another from the finest to the coarsest one.
+        """
+        levels_anchors = []
+        for map_h, map_w in map_sizes:
+            height_scale, width_scale = self.get_scale_factors(
+                image_size, (map_h, map_w))
+            if device is None:
+                x_anc_pts, y_anc_pts = generate_anchors((map_h, map_w))
+                grid = generate_anchor_boxes(
+                    x_anc_pts, y_anc_pts, self.anchor_cache.anc_scales,
+                    self.anchor_cache.anc_ratios, (map_h, map_w))
+            else:
+                grid = self.anchor_cache.get(map_h, map_w, device)
+            levels_anchors.append(project_bboxes(
+                grid.view(-1, 4), width_scale, height_scale, 'a2p'))
+        return torch.cat(levels_anchors)
+
+    def get_anchors(
+        self,
+        image_size: Tuple[int, int],
+        map_sizes: List[Tuple[int, int]]
+    ) -> FloatTensor:
+        """Get flatten anchor boxes for feature maps of an image.
+
+        Anchors of a single feature map are given in its coordinates
+        and anchors of pyramid levels are given in image pixels.
+
+        Parameters
+        ----------
+        image_size : Tuple[int, int]
+            A height and a width of the image.
+        map_sizes : List[Tuple[int, int]]
+            Heights and widths of the feature maps.
+
+        Returns
+        -------
+        FloatTensor
+            The anchor boxes with shape `[n_anc, 4]`.
+        """
+        if not self.fpn:
+            return self.get_anchor_grid(map_sizes[0]).reshape(-1, 4)
+        if list(map_sizes) == self.level_sizes:
+            return self.anchor_grid
+        return self._get_pyramid_anchors(
+            image_size, map_sizes, self.anchor_grid.device)
+
+    def get_box_scale_factors(
+        self,
+        image_size: Tuple[int, int],
+        map_sizes: List[Tuple[int, int]]
+    ) -> Tuple[float, float]:
+        """Get scale factors between image pixels and anchors' coordinates.
+
+        Parameters
+        ----------
+        image_size : Tuple[int, int]
+            A height and a width of the image.
+        map_sizes : List[Tuple[int, int]]
+            Heights and widths of the feature maps.
+
+        Returns
+        -------
+        Tuple[float, float]
+            Height and width scale factors. They are ones with FPN.
+        """
+        if self.fpn:
+            return 1.0, 1.0
+        return self.get_scale_factors(image_size, map_sizes[0])
+
+    @staticmethod
+    def get_map_sizes(
+        feature_maps: Union[FloatTensor, List[FloatTensor]]
+    ) -> List[Tuple[int, int]]:
+        """Get sizes of a feature map or of feature pyramid levels.
+
+        Parameters
+        ----------
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
+            The feature map or the list of the levels' feature maps.
+
+        Returns
+        -------
+        List[Tuple[int, int]]
+            Heights and widths of the feature maps.
+        """
+        if not isinstance(feature_maps, (list, tuple)):
+            feature_maps = [feature_maps]
+        return [tuple(level.shape[-2:]) for level in feature_maps]
+
+    @staticmethod
+    def get_scale_factors(
+        image_size: Tuple[int, int], map_size: Tuple[int, int]
+    ) -> Tuple[float, float]:
+        """Get scale factors between an image and its feature map.
+
+        Parameters
+        ----------
+        image_size : Tuple[int, int]
+            A height and a width of the image.
+        map_size : Tuple[int, int]
+            A height and a width of the feature map.
+
+        Returns
+        -------
+        Tuple[float, float]
+            Height and width scale factors.
+        """
+        return image_size[0] / map_size[0], image_size[1] / map_size[1]
+
     def forward(
         self,
         images: FloatTensor,
         gt_boxes: FloatTensor,
-        gt_cls: FloatTensor
+        gt_cls: FloatTensor,
+        amp: bool = False,
+        proposal_sampler: Optional[ProposalSampler] = None
     ) -> Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor, FloatTensor]:
         """Forward pass of the region proposal network.
 
@@ -274,6 +755,13 @@ class RegionProposalNetwork(nn.Module):
             The ground truth bounding boxes with shape `(b, n_max_obj, 4)`.
         gt_cls : Tensor, optional
             The ground truth classes with shape `(b, n_max_obj)`.
+        amp : bool, optional
+            Whether to run the backbone and the proposal module
+            with automatic mixed precision. The box math and the loss
+            are calculated in float32 anyway. By default is `False`.
+        proposal_sampler : Optional[ProposalSampler], optional
+            A sampler of returned proposals. If not given then proposals
+            of all positive anchors are returned.
 
         Returns
         -------
@@ -281,9 +769,11 @@ class RegionProposalNetwork(nn.Module):
             Return:
             `rpn_loss` containing loss,
             `feature_maps` with shape `(out_channels, out_size_h, out_size_w)`
-            containing containing backbone's feature map,
+            containing containing backbone's feature map
+            (a list of them with FPN),
             `proposals` with shape `(n_pred_pos_anc, 4)`
-            containing generated proposals in format "xyxy",
+            containing generated proposals in format "xyxy"
+            on the feature map (in image pixels with FPN),
             `pos_b_idxs` with shape `(n_pred_pos_anc,)`
             containing batch indexes
             and `gt_class_pos` with shape `(n_pred_pos_anc,)`,
@@ -291,33 +781,58 @@ class RegionProposalNetwork(nn.Module):
         """
         b_size = images.shape[0]
 
-        feature_maps = self.feature_extractor(images)
+        with autocast(images.device, amp):
+            feature_maps = self.feature_extractor(images)
+        map_sizes = self.get_map_sizes(feature_maps)
+        height_scale, width_scale = self.get_box_scale_factors(
+            images.shape[-2:], map_sizes)
 
-        batch_anc_grid = self.anchor_grid.repeat((b_size, 1, 1, 1, 1))
-        batch_anc_grid = batch_anc_grid.view(b_size, -1, 4)
+        batch_anc_grid = self.get_anchors(
+            images.shape[-2:], map_sizes).repeat((b_size, 1, 1))
 
         gt_boxes_map = project_bboxes(
-            gt_boxes, self.width_scale, self.height_scale, 'p2a')
+            gt_boxes, width_scale, height_scale, 'p2a')
 
         (pos_anc_idxs, neg_anc_idxs, pos_b_idxs,
             pos_ancs, neg_ancs, gt_pos_anc_conf_scores,
-            gt_class_pos, gt_offsets) = get_required_anchors(
+            gt_class_pos, gt_offsets, pos_gt_idxs,
+            all_neg_anc_idxs) = get_required_anchors(
             batch_anc_grid, gt_boxes_map, gt_cls,
-            self.pos_anc_thresh, self.neg_anc_thresh)
-
-        (pos_conf_scores, neg_conf_scores,
-            pos_offsets) = self.proposal_module(
-            feature_maps, pos_anc_idxs, neg_anc_idxs)
+            self.pos_anc_thresh, self.neg_anc_thresh, self.max_iou_memory,
+            self.spatial_matching, return_matches=True)
+
+        with autocast(images.device, amp):
+            (pos_conf_scores, neg_conf_scores,
+                pos_offsets) = self.proposal_module(
+                feature_maps, pos_anc_idxs, neg_anc_idxs)
+        pos_conf_scores = pos_conf_scores.float()
+        neg_conf_scores = neg_conf_scores.float()
+        pos_offsets = pos_offsets.float()
         
         rpn_loss = self.rpn_loss(pos_conf_scores, neg_conf_scores, pos_offsets,
                                  gt_offsets, b_size)
         
         proposals = self._generate_proposals(pos_ancs, pos_offsets)
 
+        if proposal_sampler is not None:
+            # Background is sampled from all negative anchors
+            # and not only from the ones cut for the loss
+            neg_b_idxs = all_neg_anc_idxs // batch_anc_grid.shape[1]
+            neg_ancs = batch_anc_grid.flatten(end_dim=1)[all_neg_anc_idxs]
+            proposals, pos_b_idxs, gt_class_pos = proposal_sampler(
+                proposals, pos_b_idxs, pos_gt_idxs, gt_pos_anc_conf_scores,
+                gt_class_pos, neg_ancs, neg_b_idxs, b_size)
+
         return rpn_loss, feature_maps, proposals, pos_b_idxs, gt_class_pos
     
     def inference(
-        self, images: FloatTensor, conf_thresh: float = 0.5
+        self,
+        images: FloatTensor,
+        conf_thresh: float = 0.5,
+        nms_thresh: Optional[float] = None,
+        pre_nms_top_k: Optional[int] = None,
+        post_nms_top_k: Optional[int] = None,
+        amp: bool = False
     ) -> Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor]:
         """Inference pass of the region proposal network.
 
@@ -327,39 +842,74 @@ class RegionProposalNetwork(nn.Module):
             An input batch of images with shape `(b, c, h, w)`.
         conf_thresh : float, optional
             Object confidence threshold. By default is 0.5.
+        nms_thresh : Optional[float], optional
+            IoU NMS threshold. If not given then NMS is not done.
+            By default is `None`.
+        pre_nms_top_k : Optional[int], optional
+            A maximum number of the most confident anchors per image
+            that are considered before NMS. By default is `None`
+            that means no limit.
+        post_nms_top_k : Optional[int], optional
+            A maximum number of proposals per image that are kept after NMS.
+            It is used only when `nms_thresh` is given. By default is `None`
+            that means no limit.
+        amp : bool, optional
+            Whether to run the backbone and the proposal module
+            with automatic mixed precision. The box math is done in float32
+            anyway. By default is `False`.
 
         Returns
         -------
         Tuple[FloatTensor, FloatTensor, FloatTensor, IntTensor]
             Return:
             `feature_maps` with shape `(out_channels, out_size_h, out_size_w)`
-            containing backbone's feature map,
+            containing backbone's feature map (a list of them with FPN),
             `proposals` with shape `(n_pred_pos_anc, 4)`
-            containing generated proposals in format "xyxy",
+            containing generated proposals in format "xyxy" in image pixels,
             `pos_confs` with shape `(n_pred_pos_anc,)`,
             containing object confidences for generated proposals
             and `pos_b_idxs` with shape `(n_pred_pos_anc,)` batch indexes.
+            When NMS is done proposals are grouped by image
+            and sorted by confidence within every image.
         """
         b_size = images.shape[0]
 
-        feature_maps = self.feature_extractor(images)
-        scores, offsets = self.proposal_module.inference(feature_maps)
-        confidences = self.scores_sigmoid(scores)
-
-        pos_b_idxs = torch.where(confidences >= conf_thresh)[0]
-        confidences = confidences.flatten()
-        offsets = offsets.contiguous().view((-1, 4))
-        pos_anc_idxs = torch.where(confidences >= conf_thresh)[0]
-
-        pos_confs = confidences[pos_anc_idxs]
-        pos_offsets = offsets[pos_anc_idxs]
-
-        batch_anc_grid = self.anchor_grid.repeat((b_size, 1, 1, 1, 1))
-        pos_ancs = batch_anc_grid.flatten(end_dim=-2)[pos_anc_idxs]
+        with autocast(images.device, amp):
+            feature_maps = self.feature_extractor(images)
+            scores, offsets = self.proposal_module.inference(feature_maps)
+        confidences = self.scores_sigmoid(scores.float()).flatten(start_dim=1)
+        offsets = offsets.float().contiguous().view(b_size, -1, 4)
+        map_sizes = self.get_map_sizes(feature_maps)
+        height_scale, width_scale = self.get_box_scale_factors(
+            images.shape[-2:], map_sizes)
+        anc_grid = self.get_anchors(images.shape[-2:], map_sizes)
+
+        # Select a bounded number of the most confident anchors per image
+        n_anc = confidences.shape[1]
+        if pre_nms_top_k is not None and pre_nms_top_k < n_anc:
+            confidences, anc_idxs = confidences.topk(pre_nms_top_k, dim=1)
+            offsets = torch.gather(
+                offsets, 1, anc_idxs[..., None].expand(-1, -1, 4))
+            batch_anc_grid = anc_grid[anc_idxs]
+        else:
+            batch_anc_grid = anc_grid[None].expand(b_size, -1, -1)
+
+        pos_b_idxs, pos_anc_idxs = torch.where(confidences >= conf_thresh)
+        pos_confs = confidences[pos_b_idxs, pos_anc_idxs]
+        pos_offsets = offsets[pos_b_idxs, pos_anc_idxs]
+        pos_ancs = batch_anc_grid[pos_b_idxs, pos_anc_idxs]
 
         proposals = self._generate_proposals(pos_ancs, pos_offsets)
         proposals = project_bboxes(
-            proposals, self.width_scale, self.height_scale, mode='a2p')
+            proposals, width_scale, height_scale, mode='a2p')
+
+        if nms_thresh is not None:
+            keep = batched_nms_per_image(
+                proposals, pos_confs, pos_b_idxs, nms_thresh,
+                post_nms_top_k, b_size)
+            proposals = proposals[keep]
+            pos_confs = pos_confs[keep]
+            pos_b_idxs = pos_b_idxs[keep]
 
         return feature_maps, proposals, pos_confs, pos_b_idxs
             
@@ -491,13 +1041,22 @@ def confidence_loss(
 
 
 class ClassificationModule(nn.Module):
+
+    # A RoI with this size in pixels is pooled from the canonical level
+    # of a feature pyramid, two times smaller one from the previous level
+    # and so on (like in FPN paper)
+    canonical_size = 224
+    canonical_level = 4
+
     def __init__(
         self,
         out_channels: int,
         n_cls: int,
         roi_size: Tuple[int, int],
         hidden_dim: int = 512,
-        p_dropout: float = 0.3
+        p_dropout: float = 0.3,
+        fpn_levels: Optional[Tuple[int, ...]] = None,
+        roi_align: bool = False
     ) -> None:
         """Initialize `ClassificationModule`.
 
@@ -513,18 +1072,104 @@ class ClassificationModule(nn.Module):
             Hidden dimension, by default is 512.
         p_dropout : float, optional
             Dropout's probability, by default is 0.3.
+        fpn_levels : Optional[Tuple[int, ...]], optional
+            Numbers of halvings of feature pyramid levels. If given then
+            RoIs are expected in image pixels and every RoI is pooled
+            from a level that corresponds to its size.
+            By default is `None` that means a single feature map.
+        roi_align : bool, optional
+            Whether to use RoIAlign instead of RoI max pooling
+            and the following average pooling. RoIAlign averages
+            `roi_h * roi_w` bilinear samples of a RoI right into one value
+            per channel. By default is `False`.
         """
         super().__init__()
         self.roi_size = roi_size
-        self.avg_pool = nn.AvgPool2d(roi_size)
+        self.fpn_levels = fpn_levels
+        self.roi_align = roi_align
+        if roi_align:
+            # RoIAlign already gives the final 1x1 size
+            self.avg_pool = nn.Identity()
+        else:
+            self.avg_pool = nn.AvgPool2d(roi_size)
         self.fc = nn.Linear(out_channels, hidden_dim)
         self.dropout = nn.Dropout(p_dropout)
         self.cls_head = nn.Linear(hidden_dim, n_cls)
 
+    def _pool_level(
+        self, feature_map: FloatTensor, rois: FloatTensor, spatial_scale: float
+    ) -> FloatTensor:
+        """Pool RoIs from one feature map.
+
+        Parameters
+        ----------
+        feature_map : FloatTensor
+            The feature map with shape `(b, map_c, map_h, map_w)`.
+        rois : FloatTensor
+            RoIs with shape `(n_rois, 5)` where the first column
+            contains batch indexes.
+        spatial_scale : float
+            A scale from RoIs' coordinates to the feature map's ones.
+
+        Returns
+        -------
+        FloatTensor
+            Pooled features with shape `(n_rois, map_c, roi_h, roi_w)`
+            or `(n_rois, map_c, 1, 1)` with RoIAlign.
+        """
+        # RoI pooling is done in float32 like the proposals' coordinates
+        if self.roi_align:
+            return ops.roi_align(
+                feature_map.float(), rois, 1, spatial_scale=spatial_scale,
+                sampling_ratio=max(self.roi_size), aligned=True)
+        return ops.roi_pool(
+            feature_map.float(), rois, self.roi_size,
+            spatial_scale=spatial_scale)
+
+    def _roi_pool(
+        self,
+        feature_maps: Union[FloatTensor, List[FloatTensor]],
+        rois: FloatTensor
+    ) -> FloatTensor:
+        """Pool RoIs from a feature map or from feature pyramid levels.
+
+        Parameters
+        ----------
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
+            Backbone's feature map or a list of the pyramid levels.
+        rois : FloatTensor
+            RoIs with shape `(n_rois, 5)` where the first column
+            contains batch indexes.
+
+        Returns
+        -------
+        FloatTensor
+            Pooled features with shape `(n_rois, map_c, roi_h, roi_w)`
+            or `(n_rois, map_c, 1, 1)` with RoIAlign.
+        """
+        if self.fpn_levels is None:
+            return self._pool_level(feature_maps, rois, 1.0)
+
+        widths = rois[:, 3] - rois[:, 1]
+        heights = rois[:, 4] - rois[:, 2]
+        sizes = torch.sqrt((widths * heights).clamp(min=1e-6))
+        levels = torch.floor(
+            self.canonical_level + torch.log2(sizes / self.canonical_size))
+        levels = levels.clamp(self.fpn_levels[0], self.fpn_levels[-1])
+
+        out_size = (1, 1) if self.roi_align else self.roi_size
+        pooled = rois.new_zeros(
+            (rois.shape[0], feature_maps[0].shape[1], *out_size))
+        for level, level_map in zip(self.fpn_levels, feature_maps):
+            level_idxs = torch.where(levels == level)[0]
+            pooled[level_idxs] = self._pool_level(
+                level_map, rois[level_idxs], 2.0 ** -level)
+        return pooled
+
     def forward(
         self,
-        feature_maps: FloatTensor,
-        predicted_proposals: List[FloatTensor],
+        feature_maps: Union[FloatTensor, List[FloatTensor]],
+        rois: FloatTensor,
         gt_cls: FloatTensor
     ) -> Tuple[FloatTensor, FloatTensor]:
         """Forward pass of `ClassificationModule`.
@@ -534,40 +1179,34 @@ class ClassificationModule(nn.Module):
 
         Parameters
         ----------
-        predicted_proposals : FloatTensor
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
             Feature map from RPN's backbone
-            with shape `(b, out_channels, out_size_h, out_size_w)`.
-        predicted_proposals : List[Tensor]
-            Predicted proposals from RPN.
-            List has length `n_pos_anc` and each element has shape `(4,)`.
+            with shape `(b, out_channels, out_size_h, out_size_w)`
+            or a list of feature pyramid levels.
+        rois : FloatTensor
+            Predicted proposals from RPN of the whole batch
+            with shape `(n_pos_anc, 5)` where the first column
+            contains batch indexes.
         gt_cls : Tensor
             Ground truth classes with shape `(n_pos_anc,)`.
 
         Returns
         -------
         Tuple[FloatTensor, FloatTensor]
-            Class scores with shape `(n_pos_anc,)'
-            and additional class loss with shape `(n_cls,)`
+            Class scores with shape `(n_pos_anc, n_cls)'
+            and additional class loss.
         """
         # Check is there even one proposal
-        props_mask = torch.tensor(
-            [props.shape[0] == 0 for props in predicted_proposals])
-        if props_mask.all():
-            b = len(predicted_proposals)
-            device = props_mask[0].device
-            return torch.FloatTensor(size=(0, b), device=device), 0.0
-
-        x = ops.roi_pool(feature_maps, predicted_proposals, self.roi_size)
-        x = self.avg_pool(x).flatten(start_dim=1)
-        x = self.fc(x)
-        x = self.dropout(x)
-        cls_scores = self.cls_head(x)
-        return cls_scores, F.cross_entropy(cls_scores, gt_cls.long())
-        
+        if rois.shape[0] == 0:
+            return rois.new_zeros((0, self.cls_head.out_features)), 0.0
+
+        cls_scores = self.inference(feature_maps, rois)
+        return cls_scores, F.cross_entropy(cls_scores.float(), gt_cls.long())
+
     def inference(
         self,
-        feature_maps: FloatTensor,
-        predicted_proposals: List[FloatTensor]
+        feature_maps: Union[FloatTensor, List[FloatTensor]],
+        rois: FloatTensor
     ) -> FloatTensor:
         """Inference pass of `ClassificationModule`.
 
@@ -575,20 +1214,36 @@ class ClassificationModule(nn.Module):
 
         Parameters
         ----------
-        feature_maps : FloatTensor
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
             Feature map from RPN's backbone
-            with shape `(b, out_channels, out_size_h, out_size_w)`.
-        predicted_proposals : List[FloatTensor]
-            Predicted proposals from RPN.
-            List has length `n_pos_anc` and each element has shape `(4,)`.
+            with shape `(b, out_channels, out_size_h, out_size_w)`
+            or a list of feature pyramid levels.
+        rois : FloatTensor
+            Predicted proposals from RPN of the whole batch
+            with shape `(n_pos_anc, 5)` where the first column
+            contains batch indexes.
 
         Returns
         -------
         FloatTensor
-            Class scores with shape `(n_pos_anc,)'.
+            Class scores with shape `(n_pos_anc, n_cls)'.
         """
-        x = ops.roi_pool(feature_maps, predicted_proposals, self.roi_size)
-        x = self.avg_pool(x).flatten(start_dim=1)
+        return self._head(self._roi_pool(feature_maps, rois))
+
+    def _head(self, pooled_rois: FloatTensor) -> FloatTensor:
+        """Get class scores of pooled RoIs.
+
+        Parameters
+        ----------
+        pooled_rois : FloatTensor
+            Pooled features with shape `(n_rois, map_c, roi_h, roi_w)`.
+
+        Returns
+        -------
+        FloatTensor
+            Class scores with shape `(n_rois, n_cls)'.
+        """
+        x = self.avg_pool(pooled_rois).flatten(start_dim=1)
         x = self.fc(x)
         x = self.dropout(x)
         cls_scores = self.cls_head(x)
@@ -611,14 +1266,31 @@ class RCNN_Detector(nn.Module):
         proposal_module_hid_dim: int = 512,
         classifier_hid_dim: int = 512,
         proposals_module_p_dropout: float = 0.3,
-        classifier_p_dropout: float = 0.3
+        classifier_p_dropout: float = 0.3,
+        amp: bool = False,
+        anchor_cache_size: int = 8,
+        pretrained: bool = True,
+        fpn: bool = False,
+        fpn_channels: int = 256,
+        roi_align: bool = False,
+        channels_last: bool = False,
+        checkpointing: bool = False,
+        frozen_stages: int = 0,
+        frozen_bn: bool = False,
+        max_iou_memory: int = 64 * 1024 ** 2,
+        spatial_matching: bool = False,
+        n_proposals_per_img: Optional[int] = None,
+        n_proposals_per_gt: int = 1,
+        background_proposals: bool = False,
+        fg_proposals_fraction: float = 0.25
     ) -> None:
         """Initialize R-CNN network.
 
         Parameters
         ----------
         input_size : Tuple[int, int]
-            A size of input images.
+            A default size of input images. Images of other sizes
+            are supported too.
         n_cls : int
             A number of classification classes.
         roi_size : Tuple[int, int]
@@ -647,25 +1319,147 @@ class RCNN_Detector(nn.Module):
             A size of hidden dimension for classifier, by default is 512.
         classifier_p_dropout : float, optional
             A probability for classifier's dropout. By default is 0.3.
+        amp : bool, optional
+            Whether to run the backbone, the proposal module
+            and the classifier with automatic mixed precision
+            (bfloat16 on CPU and float16 on GPU). Box math and losses
+            are calculated in float32 anyway. By default is `False`.
+        anchor_cache_size : int, optional
+            A maximum number of cached anchor boxes grids
+            for different input sizes. By default is 8.
+        pretrained : bool, optional
+            Whether to load pretrained backbone's weights. It can be disabled
+            when a checkpoint is loaded anyway. By default is `True`.
+        fpn : bool, optional
+            Whether to build a feature pyramid over layer2-layer4
+            and to predict proposals on its levels (strides 8, 16 and 32)
+            instead of the single stride-32 feature map. It helps to find
+            small objects without an input upscaling. By default is `False`.
+        fpn_channels : int, optional
+            A number of channels of the pyramid levels. By default is 256.
+        roi_align : bool, optional
+            Whether the classifier pools RoIs with RoIAlign
+            instead of RoI max pooling. By default is `False`.
+        channels_last : bool, optional
+            Whether to run the backbone and the proposal module
+            in channels last memory format. It speeds up convolutions
+            on CPU and with AMP on GPU. By default is `False`.
+        checkpointing : bool, optional
+            Whether to checkpoint the backbone's layer1-layer4 in the training
+            mode. Their inner activations are recomputed on backward instead
+            of being stored, that allows bigger batches at the cost
+            of an extra backbone forward pass. By default is `False`.
+        frozen_stages : int, optional
+            A number of frozen backbone stages: 0 - nothing, 1 - the stem,
+            2 - the stem and layer1 and so on up to 5 - the whole backbone.
+            Frozen stages are not trained and run without storing
+            activations, that speeds up fine-tuning. By default is 0.
+        frozen_bn : bool, optional
+            Whether to replace the backbone's batch norms with frozen
+            affine transforms of their statistics. It suits small batches
+            that give noisy batch statistics. By default is `False`.
+        max_iou_memory : int, optional
+            Approximate memory ceiling in bytes for IoU calculation
+            of one chunk of anchors while matching them with ground truth
+            boxes. Padded ground truth boxes are skipped anyway.
+            By default is 64 MiB.
+        spatial_matching : bool, optional
+            Whether to calculate IoU only for intersecting anchor
+            and ground truth boxes instead of all pairs. The matching
+            is the same but it is faster on big feature maps and with
+            many objects (see rcnn/scripts/benchmark_anchor_matching.py).
+            By default is `False`.
+        n_proposals_per_img : Optional[int], optional
+            A number of proposals per image that the classifier
+            is trained on. Proposals are deduplicated to
+            `n_proposals_per_gt` ones per ground truth box and randomly
+            sampled, that bounds the classifier's cost per step.
+            If not given then proposals of all positive anchors are used.
+        n_proposals_per_gt : int, optional
+            A maximum number of sampled proposals per ground truth box.
+            They are the ones with the best anchors. By default is 1.
+        background_proposals : bool, optional
+            Whether to fill the sampled proposals with negative anchors
+            of an extra background class. The classifier gets `n_cls + 1`
+            outputs and the background one is dropped on inference.
+            It works only with `n_proposals_per_img`.
+            By default is `False`.
+        fg_proposals_fraction : float, optional
+            A maximum fraction of foreground proposals among the sampled
+            ones when background proposals are added. By default is 0.25.
         """
         super().__init__()
+        self.n_cls = n_cls
+        self.amp = amp
+        self.channels_last = channels_last
         self.rpn = RegionProposalNetwork(
             input_size=input_size, backbone_model=backbone_model,
             anc_scales=anc_scales, anc_ratios=anc_ratios,
             pos_anc_thresh=pos_anc_thresh, neg_anc_thresh=neg_anc_thresh,
             w_conf=w_conf_loss, w_reg=w_reg_loss,
             proposal_module_hid_dim=proposal_module_hid_dim,
-            proposals_module_p_dropout=proposals_module_p_dropout)
+            proposals_module_p_dropout=proposals_module_p_dropout,
+            anchor_cache_size=anchor_cache_size,
+            pretrained=pretrained, fpn=fpn, fpn_channels=fpn_channels,
+            channels_last=channels_last, checkpointing=checkpointing,
+            frozen_stages=frozen_stages, frozen_bn=frozen_bn,
+            max_iou_memory=max_iou_memory,
+            spatial_matching=spatial_matching)
         self.classifier = ClassificationModule(
-            out_channels=self.rpn.backbone_c, n_cls=n_cls, roi_size=roi_size,
-            hidden_dim=classifier_hid_dim, p_dropout=classifier_p_dropout)
+            out_channels=self.rpn.backbone_c,
+            n_cls=n_cls + 1 if background_proposals else n_cls,
+            roi_size=roi_size, hidden_dim=classifier_hid_dim,
+            p_dropout=classifier_p_dropout,
+            fpn_levels=FeatureExtractor.fpn_levels if fpn else None,
+            roi_align=roi_align)
         self.softmax = nn.Softmax(dim=1)
+        if n_proposals_per_img is None:
+            self.proposal_sampler = None
+        else:
+            self.proposal_sampler = ProposalSampler(
+                n_proposals_per_img, n_proposals_per_gt,
+                background_class=n_cls if background_proposals else None,
+                fg_fraction=fg_proposals_fraction)
+
+    def get_rois(
+        self,
+        images: FloatTensor,
+        feature_maps: Union[FloatTensor, List[FloatTensor]],
+        proposals: FloatTensor,
+        b_idxs: IntTensor
+    ) -> FloatTensor:
+        """Get RoIs on feature maps for proposals given in image pixels.
+
+        Parameters
+        ----------
+        images : FloatTensor
+            A batch of the input images with shape `(b, 3, img_h, img_w)`.
+        feature_maps : Union[FloatTensor, List[FloatTensor]]
+            Backbone's feature maps with shape `(b, map_c, map_h, map_w)`
+            or a list of feature pyramid levels.
+        proposals : FloatTensor
+            Proposals in image pixels with shape `(n_props, 4)`.
+        b_idxs : IntTensor
+            Batch indexes of the proposals with shape `(n_props,)`.
+
+        Returns
+        -------
+        FloatTensor
+            RoIs with shape `(n_props, 5)` where the first column
+            contains batch indexes. With FPN they stay in image pixels.
+        """
+        height_scale, width_scale = self.rpn.get_box_scale_factors(
+            images.shape[-2:], self.rpn.get_map_sizes(feature_maps))
+        map_proposals = project_bboxes(
+            proposals, width_scale, height_scale, mode='p2a')
+        return bboxes_to_rois(map_proposals, b_idxs)
 
     def forward(
         self,
         images: FloatTensor,
         gt_boxes: FloatTensor,
-        gt_cls: FloatTensor
+        gt_cls: FloatTensor,
+        gt_offsets: Optional[IntTensor] = None
     ) -> Tuple[List[FloatTensor], List[FloatTensor], FloatTensor]:
         """Forward pass of R-CNN.
 
@@ -679,9 +1473,15 @@ class RCNN_Detector(nn.Module):
             A batch of the input images
             with shape `(b, 3, img_h, img_w)`.
         gt_boxes : Tensor, optional
-            The ground truth bounding boxes with shape `(b, n_max_obj, 4)`.
+            The ground truth bounding boxes with shape `(b, n_max_obj, 4)`
+            padded with -1 or, in the ragged mode, with shape `(n_obj, 4)`.
         gt_cls : Tensor, optional
-            The ground truth classes with shape `(b, n_max_obj)`.
+            The ground truth classes with shape `(b, n_max_obj)`
+            or, in the ragged mode, with shape `(n_obj,)`.
+        gt_offsets : Optional[IntTensor], optional
+            Offsets of images' objects with shape `(b + 1,)` that enable
+            the ragged mode. Objects of an image `i` are
+            `gt_boxes[gt_offsets[i]:gt_offsets[i + 1]]`.
 
         Returns
         -------
@@ -694,25 +1494,27 @@ class RCNN_Detector(nn.Module):
             Calculated R-CNN loss.
         """
         b_size = images.shape[0]
+        if gt_offsets is not None:
+            gt_boxes = ragged_to_padded(gt_boxes, gt_offsets)
+            gt_cls = ragged_to_padded(gt_cls, gt_offsets)
 
         rpn_loss, feature_maps, proposals, pos_b_idxs, gt_class_pos = (
-            self.rpn(images, gt_boxes, gt_cls))
-        
-        proposals_list = []
-        for i in range(b_size):
-            proposals_idxs = torch.where(pos_b_idxs == i)[0]
-            proposals_list.append(
-                proposals[proposals_idxs].detach().clone())
-
-        cls_scores, classifier_loss = (
-            self.classifier(feature_maps, proposals_list, gt_class_pos))
+            self.rpn(images, gt_boxes, gt_cls, amp=self.amp,
+                     proposal_sampler=self.proposal_sampler))
+        proposals = proposals.detach()
+
+        # Proposals are already in the RoI pooling coordinates
+        rois = bboxes_to_rois(proposals, pos_b_idxs)
+        with autocast(images.device, self.amp):
+            cls_scores, classifier_loss = (
+                self.classifier(feature_maps, rois, gt_class_pos))
         total_loss = rpn_loss + classifier_loss
 
-        cls_scores_list = []
-        idx = 0
-        for image_proposals in proposals_list:
-            cls_scores_list.append(cls_scores[idx:len(image_proposals)])
-            idx += len(image_proposals)
+        # Positive anchors are grouped by image
+        n_props = torch.bincount(pos_b_idxs, minlength=b_size).tolist()
+        proposals_list = list(torch.split(proposals, n_props))
+        cls_scores_list = list(
+            torch.split(cls_scores[:, :self.n_cls], n_props))
 
         return proposals_list, cls_scores_list, total_loss
         
@@ -720,7 +1522,10 @@ class RCNN_Detector(nn.Module):
         self,
         images: FloatTensor,
         conf_thresh: float = 0.5,
-        nms_thresh: float = 0.7
+        nms_thresh: float = 0.7,
+        pre_nms_top_k: Optional[int] = None,
+        post_nms_top_k: Optional[int] = None,
+        amp: Optional[bool] = None
     ) -> Tuple[List[FloatTensor], List[FloatTensor]]:
         """Inference pass of R-CNN.
 
@@ -737,6 +1542,17 @@ class RCNN_Detector(nn.Module):
             Object confidence threshold. By default is 0.5.
         nms_thresh : float, optional
             IoU NMS threshold. By default is 0.7.
+        pre_nms_top_k : Optional[int], optional
+            A maximum number of the most confident anchors per image
+            that are considered before NMS. By default is `None`
+            that means no limit.
+        post_nms_top_k : Optional[int], optional
+            A maximum number of proposals per image that are kept after NMS
+            and passed to the classifier. By default is `None`
+            that means no limit.
+        amp : Optional[bool], optional
+            Whether to run the networks with automatic mixed precision.
+            If not given then the `amp` value set on initialization is used.
 
         Returns
         -------
@@ -746,31 +1562,98 @@ class RCNN_Detector(nn.Module):
             and predicted classes list with length `b_size`
             and each element has shape `(n_pos_anc_per_img, n_cls)`.
         """
+        if amp is None:
+            amp = self.amp
         with torch.no_grad():
             b_size = images.shape[0]
 
-            feature_maps, proposals, confidences, pos_b_idxs = (
-                self.rpn.inference(images, conf_thresh=conf_thresh))
-
-            conf_pred = []
-            proposals_list = []
-            for i in range(b_size):
-                cur_idxs = torch.where(pos_b_idxs == i)
-                cur_confs = confidences[cur_idxs]
-                cur_props = proposals[cur_idxs]
-                nms_idxs = ops.nms(cur_props, cur_confs, nms_thresh)
-                conf_pred.append(cur_confs[nms_idxs])
-                proposals_list.append(cur_props[nms_idxs])
-
-            cls_scores = self.classifier.inference(
-                feature_maps=feature_maps, predicted_proposals=proposals_list)
-            cls_conf = self.softmax(cls_scores)
-
-            cls_conf_list = []
-            idx = 0
-            for image_proposals in proposals_list:
-                cls_conf_list.append(
-                    cls_conf[idx:idx + len(image_proposals)])
-                idx += len(image_proposals)
+            feature_maps, proposals, _, pos_b_idxs = self.rpn.inference(
+                images, conf_thresh=conf_thresh, nms_thresh=nms_thresh,
+                pre_nms_top_k=pre_nms_top_k, post_nms_top_k=post_nms_top_k,
+                amp=amp)
+
+            n_props = torch.bincount(pos_b_idxs, minlength=b_size).tolist()
+            proposals_list = list(torch.split(proposals, n_props))
+
+            rois = self.get_rois(images, feature_maps, proposals, pos_b_idxs)
+            with autocast(images.device, amp):
+                cls_scores = self.classifier.inference(feature_maps, rois)
+            # The background class is dropped if it is there
+            cls_conf = self.softmax(cls_scores.float())[:, :self.n_cls]
+            cls_conf_list = list(torch.split(cls_conf, n_props))
             
             return proposals_list, cls_conf_list
+
+
+def load_detector(
+    checkpoint: Union[Path, str, Dict[str, Any]],
+    device: Union[torch.device, str] = 'cpu',
+    **detector_kwargs
+) -> RCNN_Detector:
+    """Create a detector and load its weights from a checkpoint.
+
+    The detector is created on the meta device without pretrained weights,
+    so loading of the checkpoint is the only real allocation.
+
+    Parameters
+    ----------
+    checkpoint : Union[Path, str, Dict[str, Any]]
+        A path to a saved state dict or the state dict itself.
+    device : Union[torch.device, str], optional
+        A device to load the detector on. By default is `"cpu"`.
+    **detector_kwargs
+        Arguments for `RCNN_Detector` initialization.
+
+    Returns
+    -------
+    RCNN_Detector
+        The loaded detector.
+    """
+    if isinstance(checkpoint, (str, Path)):
+        checkpoint = torch.load(checkpoint, map_location=device)
+    detector_kwargs['pretrained'] = False
+    with torch.device('meta'):
+        detector = RCNN_Detector(**detector_kwargs)
+    detector.load_state_dict(checkpoint, assign=True)
+    # Assigned weights have the checkpoint's memory format
+    # Anchor buffers stay contiguous like in the constructors
+    if detector.channels_last:
+        detector.rpn.feature_extractor.to(memory_format=torch.channels_last)
+        detector.rpn.proposal_module.to(memory_format=torch.channels_last)
+    return detector.to(device=device)
+
+
+def compile_detector(
+    detector: RCNN_Detector, mode: Optional[str] = None
+) -> RCNN_Detector:
+    """Compile a detector's dense parts with `torch.compile` in place.
+
+    The backbone and the proposal module are compiled as graphs
+    of a fixed input size. A number of proposals changes from batch
+    to batch, so anchors selection, NMS and RoI pooling stay eager
+    and the classifier's head is compiled with dynamic shapes.
+    It prevents recompilation on every batch (there is only one more
+    compilation when a batch gives a single proposal or none).
+    Compiled functions replace the modules' ones, so the state dict
+    does not change.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A detector to compile.
+    mode : Optional[str], optional
+        A `torch.compile` mode. By default is `None`.
+
+    Returns
+    -------
+    RCNN_Detector
+        The same detector with compiled parts.
+    """
+    rpn = detector.rpn
+    rpn.feature_extractor.compile(mode=mode)
+    rpn.proposal_module.inference = torch.compile(
+        rpn.proposal_module.inference, mode=mode)
+
+    detector.classifier._head = torch.compile(
+        detector.classifier._head, mode=mode, dynamic=True)
+    return detector
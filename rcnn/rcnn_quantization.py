@@ -0,0 +1,219 @@
+"""A module that contains R-CNN post-training quantization functions.
+
+The backbone and the proposal module convolutions are statically quantized
+to int8 with calibration. The classifier's linear layers are quantized
+dynamically.
+"""
+
+
+import copy
+from pathlib import Path
+from typing import Iterable, Union, Dict, Any
+
+import torch
+from torch import FloatTensor
+import torch.nn as nn
+import torch.ao.quantization as tq
+from torch.ao.nn.intrinsic import ConvReLU2d
+from torchvision.models.quantization.resnet import (
+    QuantizableResNet, QuantizableBasicBlock, QuantizableBottleneck)
+
+from rcnn.rcnn_model import RCNN_Detector, ProposalModule
+
+
+QUANTIZABLE_RESNETS = {
+    'resnet18': (QuantizableBasicBlock, [2, 2, 2, 2]),
+    'resnet34': (QuantizableBasicBlock, [3, 4, 6, 3]),
+    'resnet50': (QuantizableBottleneck, [3, 4, 6, 3]),
+    'resnet101': (QuantizableBottleneck, [3, 4, 23, 3]),
+    'resnet152': (QuantizableBottleneck, [3, 8, 36, 3]),
+}
+
+
+def _get_quantizable_backbone(
+    backbone: nn.Sequential, model_name: str
+) -> nn.Sequential:
+    """Get a fused quantizable copy of a float ResNet backbone.
+
+    Parameters
+    ----------
+    backbone : nn.Sequential
+        The float backbone from `FeatureExtractor`.
+    model_name : str
+        A name of the backbone's ResNet model.
+
+    Returns
+    -------
+    nn.Sequential
+        The quantizable backbone wrapped with quant and dequant stubs.
+    """
+    block, layers = QUANTIZABLE_RESNETS[model_name]
+    resnet = QuantizableResNet(block, layers)
+    body = nn.Sequential(*list(resnet.children())[:8])
+    # Frozen batch norms do not have `num_batches_tracked`
+    missing_keys, unexpected_keys = body.load_state_dict(
+        backbone.state_dict(), strict=False)
+    if unexpected_keys or any(not key.endswith('num_batches_tracked')
+                              for key in missing_keys):
+        raise RuntimeError(
+            'Could not load the backbone into a quantizable ResNet. '
+            f'Missing keys: {missing_keys}. '
+            f'Unexpected keys: {unexpected_keys}.')
+    body.eval()
+
+    # Fuse the stem and every residual block
+    tq.fuse_modules(body, ['0', '1', '2'], inplace=True)
+    for module in body.modules():
+        if isinstance(module, (QuantizableBasicBlock, QuantizableBottleneck)):
+            module.fuse_model()
+    return nn.Sequential(tq.QuantStub(), body, tq.DeQuantStub())
+
+
+def _make_proposal_module_quantizable(proposal_module: ProposalModule):
+    """Fuse and wrap with stubs the proposal module's convolutions in place.
+
+    Parameters
+    ----------
+    proposal_module : ProposalModule
+        The float proposal module.
+    """
+    proposal_module.hidden_conv = nn.Sequential(
+        tq.QuantStub(),
+        ConvReLU2d(proposal_module.hidden_conv, nn.ReLU()))
+    proposal_module.relu = nn.Identity()
+    # Dropout does nothing in the evaluation mode
+    proposal_module.dropout = nn.Identity()
+    proposal_module.conf_scores_head = nn.Sequential(
+        proposal_module.conf_scores_head, tq.DeQuantStub())
+    proposal_module.reg_head = nn.Sequential(
+        proposal_module.reg_head, tq.DeQuantStub())
+
+
+def prepare_quantizable_detector(
+    detector: RCNN_Detector, backend: str = 'x86'
+) -> RCNN_Detector:
+    """Get a copy of a detector that is prepared for static quantization.
+
+    The backbone is replaced with a fused quantizable ResNet,
+    the proposal module's convolutions are fused and wrapped with
+    quant stubs and observers are inserted.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A float detector.
+    backend : str, optional
+        A quantization backend. By default is `"x86"`.
+
+    Returns
+    -------
+    RCNN_Detector
+        The prepared copy of the detector in the evaluation mode.
+
+    Raises
+    ------
+    ValueError
+        Quantization of a detector with FPN is not supported.
+    """
+    if detector.rpn.fpn:
+        raise ValueError(
+            'Quantization of a detector with FPN is not supported.')
+    torch.backends.quantized.engine = backend
+    prepared = copy.deepcopy(detector).cpu().eval()
+
+    feature_extractor = prepared.rpn.feature_extractor
+    feature_extractor.backbone = _get_quantizable_backbone(
+        feature_extractor.backbone, feature_extractor.model_name)
+    _make_proposal_module_quantizable(prepared.rpn.proposal_module)
+
+    qconfig = tq.get_default_qconfig(backend)
+    feature_extractor.backbone.qconfig = qconfig
+    prepared.rpn.proposal_module.qconfig = qconfig
+    tq.prepare(prepared, inplace=True)
+    return prepared
+
+
+def convert_detector(prepared: RCNN_Detector) -> RCNN_Detector:
+    """Convert a prepared and calibrated detector to the quantized one.
+
+    Parameters
+    ----------
+    prepared : RCNN_Detector
+        The detector gotten from `prepare_quantizable_detector`.
+
+    Returns
+    -------
+    RCNN_Detector
+        The quantized detector. The conversion is done in place.
+    """
+    tq.convert(prepared, inplace=True)
+    tq.quantize_dynamic(
+        prepared.classifier, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return prepared
+
+
+def quantize_detector(
+    detector: RCNN_Detector,
+    calibration_images: Iterable[FloatTensor],
+    backend: str = 'x86',
+    conf_thresh: float = 0.5,
+    nms_thresh: float = 0.7
+) -> RCNN_Detector:
+    """Get a post-training quantized copy of a detector.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A trained float detector.
+    calibration_images : Iterable[FloatTensor]
+        Batches of images with shape `(b, 3, img_h, img_w)`
+        for activations' ranges calibration.
+    backend : str, optional
+        A quantization backend. By default is `"x86"`.
+    conf_thresh : float, optional
+        Object confidence threshold used on calibration. By default is 0.5.
+    nms_thresh : float, optional
+        IoU NMS threshold used on calibration. By default is 0.7.
+
+    Returns
+    -------
+    RCNN_Detector
+        The quantized detector that runs on CPU.
+    """
+    prepared = prepare_quantizable_detector(detector, backend)
+    for images in calibration_images:
+        prepared.inference(images.cpu(), conf_thresh, nms_thresh)
+    return convert_detector(prepared)
+
+
+def load_quantized_detector(
+    checkpoint: Union[Path, str, Dict[str, Any]],
+    backend: str = 'x86',
+    **detector_kwargs
+) -> RCNN_Detector:
+    """Load a quantized detector from a state dict.
+
+    Parameters
+    ----------
+    checkpoint : Union[Path, str, Dict[str, Any]]
+        A path to a saved state dict of a quantized detector
+        or the state dict itself.
+    backend : str, optional
+        A quantization backend. By default is `"x86"`.
+    **detector_kwargs
+        Arguments for `RCNN_Detector` initialization.
+
+    Returns
+    -------
+    RCNN_Detector
+        The loaded quantized detector.
+    """
+    if isinstance(checkpoint, (str, Path)):
+        checkpoint = torch.load(checkpoint, map_location='cpu')
+    # Weights are replaced by the checkpoint ones anyway
+    detector_kwargs['pretrained'] = False
+    detector = RCNN_Detector(**detector_kwargs)
+    quantized = convert_detector(
+        prepare_quantizable_detector(detector, backend))
+    quantized.load_state_dict(checkpoint)
+    return quantized
@@ -0,0 +1,179 @@
+"""A module that contains runners of exported R-CNN models.
+
+It depends only on torch and torchvision (for NMS and RoI pooling ops)
+and optionally on onnxruntime, so it can be used for deployment
+without the training code.
+"""
+
+
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import torch
+from torch import FloatTensor, IntTensor
+import torchvision  # noqa: F401 registers torchvision ops
+
+
+def unpack_predictions(
+    bboxes: FloatTensor,
+    scores: FloatTensor,
+    labels: IntTensor,
+    counts: IntTensor
+) -> Tuple[List[FloatTensor], List[FloatTensor], List[IntTensor]]:
+    """Split packed predictions of a batch into per-image lists.
+
+    Parameters
+    ----------
+    bboxes : FloatTensor
+        Bounding boxes of the whole batch with shape `(n_pred, 4)`.
+    scores : FloatTensor
+        Class confidences with shape `(n_pred,)`.
+    labels : IntTensor
+        Class labels with shape `(n_pred,)`.
+    counts : IntTensor
+        Counts of predictions per image with shape `(b,)`.
+
+    Returns
+    -------
+    Tuple[List[FloatTensor], List[FloatTensor], List[IntTensor]]
+        Bounding boxes, confidences and labels lists with length `b`.
+    """
+    counts = counts.tolist()
+    return (list(torch.split(bboxes, counts)),
+            list(torch.split(scores, counts)),
+            list(torch.split(labels, counts)))
+
+
+class TorchScriptDetector:
+    """A runner of a detector exported with `rcnn_export.export_torchscript`.
+    """
+
+    def __init__(
+        self,
+        model_path: Union[Path, str],
+        device: Union[torch.device, str] = 'cpu'
+    ) -> None:
+        """Load an exported detector.
+
+        Parameters
+        ----------
+        model_path : Union[Path, str]
+            A path to the exported TorchScript module.
+        device : Union[torch.device, str], optional
+            A device to run on. By default is `"cpu"`.
+        """
+        self.device = torch.device(device)
+        self.model = torch.jit.load(str(model_path), map_location=self.device)
+        self.model.eval()
+
+    def __call__(
+        self, images: FloatTensor
+    ) -> Tuple[FloatTensor, FloatTensor, IntTensor, IntTensor]:
+        """Get packed predictions for a batch of images.
+
+        Parameters
+        ----------
+        images : FloatTensor
+            A batch of the input images with shape `(b, 3, img_h, img_w)`.
+
+        Returns
+        -------
+        Tuple[FloatTensor, FloatTensor, IntTensor, IntTensor]
+            Bounding boxes with shape `(n_pred, 4)`,
+            class confidences with shape `(n_pred,)`,
+            class labels with shape `(n_pred,)`
+            and counts of predictions per image with shape `(b,)`.
+        """
+        with torch.no_grad():
+            return self.model(images.to(device=self.device))
+
+    def inference(
+        self, images: FloatTensor
+    ) -> Tuple[List[FloatTensor], List[FloatTensor], List[IntTensor]]:
+        """Get per-image predictions for a batch of images.
+
+        Parameters
+        ----------
+        images : FloatTensor
+            A batch of the input images with shape `(b, 3, img_h, img_w)`.
+
+        Returns
+        -------
+        Tuple[List[FloatTensor], List[FloatTensor], List[IntTensor]]
+            Bounding boxes, confidences and labels lists with length `b`.
+            Each element has shape `(n_pred_per_img, 4)`, `(n_pred_per_img,)`
+            and `(n_pred_per_img,)` respectively.
+        """
+        return unpack_predictions(*self(images))
+
+
+class OnnxDetector:
+    """A runner of a detector exported with `rcnn_export.export_onnx`.
+
+    It has the same interface as `TorchScriptDetector`
+    but runs the model with onnxruntime.
+    """
+
+    def __init__(
+        self,
+        model_path: Union[Path, str],
+        n_threads: Optional[int] = None
+    ) -> None:
+        """Load an exported detector.
+
+        Parameters
+        ----------
+        model_path : Union[Path, str]
+            A path to the exported ONNX model.
+        n_threads : Optional[int], optional
+            A number of intra-op threads. If not given then onnxruntime
+            chooses it.
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(
+            str(model_path), options, providers=['CPUExecutionProvider'])
+
+    def __call__(
+        self, images: FloatTensor
+    ) -> Tuple[FloatTensor, FloatTensor, IntTensor, IntTensor]:
+        """Get packed predictions for a batch of images.
+
+        Parameters
+        ----------
+        images : FloatTensor
+            A batch of the input images with shape `(b, 3, img_h, img_w)`.
+
+        Returns
+        -------
+        Tuple[FloatTensor, FloatTensor, IntTensor, IntTensor]
+            Bounding boxes with shape `(n_pred, 4)`,
+            class confidences with shape `(n_pred,)`,
+            class labels with shape `(n_pred,)`
+            and counts of predictions per image with shape `(b,)`.
+        """
+        images = images.detach().cpu().numpy()
+        outputs = self.session.run(None, {'images': images})
+        return tuple(map(torch.from_numpy, outputs))
+
+    def inference(
+        self, images: FloatTensor
+    ) -> Tuple[List[FloatTensor], List[FloatTensor], List[IntTensor]]:
+        """Get per-image predictions for a batch of images.
+
+        Parameters
+        ----------
+        images : FloatTensor
+            A batch of the input images with shape `(b, 3, img_h, img_w)`.
+
+        Returns
+        -------
+        Tuple[List[FloatTensor], List[FloatTensor], List[IntTensor]]
+            Bounding boxes, confidences and labels lists with length `b`.
+            Each element has shape `(n_pred_per_img, 4)`, `(n_pred_per_img,)`
+            and `(n_pred_per_img,)` respectively.
+        """
+        return unpack_predictions(*self(images))
@@ -0,0 +1,404 @@
+"""A module that contains a local HTTP R-CNN inference server.
+
+The server is built on asyncio streams without extra dependencies.
+Request handlers decode images and put them into a bounded queue.
+A batching worker gathers queued images until a maximum batch size
+or a maximum wait time is reached, runs one batched inference call
+in a worker thread and fans the results out to the waiting handlers.
+
+Endpoints:
+    `POST /detect` with an encoded image (jpeg, png, ...) as a body
+    returns detections as JSON.
+    `GET /stats` returns a queue depth, a batch size histogram
+    and latency percentiles as JSON.
+"""
+
+
+import asyncio
+from collections import deque
+import json
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+import torch
+from torch import FloatTensor
+import torchvision.ops as ops
+
+from rcnn.rcnn_model import RCNN_Detector
+from rcnn.rcnn_utils import prepare_images_batch
+from utils.image_utils.image_functions import decode_image
+
+
+HTTP_STATUSES = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class ServerStats:
+    """Statistics of the batching server."""
+
+    def __init__(self, max_batch_size: int, n_latencies: int = 10000) -> None:
+        """Initialize `ServerStats`.
+
+        Parameters
+        ----------
+        max_batch_size : int
+            A maximum batch size of the server.
+        n_latencies : int, optional
+            A number of the last requests' latencies that percentiles
+            are calculated on. By default is 10000.
+        """
+        self.batch_sizes = [0] * (max_batch_size + 1)
+        self.latencies: Deque[float] = deque(maxlen=n_latencies)
+        self.n_requests = 0
+
+    def add_batch(self, batch_size: int, latencies: List[float]) -> None:
+        """Register a processed batch.
+
+        Parameters
+        ----------
+        batch_size : int
+            A size of the batch.
+        latencies : List[float]
+            Latencies of the batch's requests in seconds
+            from enqueueing to getting a result.
+        """
+        self.batch_sizes[batch_size] += 1
+        self.latencies.extend(latencies)
+        self.n_requests += batch_size
+
+    def as_dict(self, queue_depth: int) -> Dict[str, Any]:
+        """Get the statistics as a JSON serializable dict.
+
+        Parameters
+        ----------
+        queue_depth : int
+            A current number of queued requests.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The statistics. Latencies are given in milliseconds.
+        """
+        if self.latencies:
+            p50, p90, p99 = np.percentile(
+                np.array(self.latencies) * 1000, (50, 90, 99)).tolist()
+        else:
+            p50 = p90 = p99 = None
+        return {
+            'queue_depth': queue_depth,
+            'n_requests': self.n_requests,
+            'batch_size_histogram': {
+                str(size): count
+                for size, count in enumerate(self.batch_sizes) if count},
+            'latency_ms': {'p50': p50, 'p90': p90, 'p99': p99},
+        }
+
+
+class DetectionServer:
+    """A local HTTP server of a detector with dynamic micro-batching."""
+
+    def __init__(
+        self,
+        detector: RCNN_Detector,
+        input_size: Tuple[int, int],
+        mean: FloatTensor,
+        std: FloatTensor,
+        conf_thresh: float = 0.5,
+        nms_thresh: float = 0.7,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        max_queue_size: int = 256,
+        max_body_size: int = 32 * 1024 * 1024,
+        index2name: Optional[Dict[int, str]] = None
+    ) -> None:
+        """Initialize `DetectionServer`.
+
+        Parameters
+        ----------
+        detector : RCNN_Detector
+            A detector in the evaluation mode.
+        input_size : Tuple[int, int]
+            A height and a width of the detector's input.
+        mean : FloatTensor
+            Normalization mean of channels.
+        std : FloatTensor
+            Normalization standard deviation of channels.
+        conf_thresh : float, optional
+            Object confidence threshold. By default is 0.5.
+        nms_thresh : float, optional
+            IoU NMS threshold. By default is 0.7.
+        max_batch_size : int, optional
+            A maximum number of images in one inference call.
+            By default is 8.
+        max_wait : float, optional
+            A maximum time in seconds that the first image of a batch
+            waits for other ones. By default is 0.01.
+        max_queue_size : int, optional
+            A maximum number of queued images. Requests are rejected
+            with 503 when the queue is full. By default is 256.
+        max_body_size : int, optional
+            A maximum size of a request body in bytes.
+            By default is 32 MiB.
+        index2name : Optional[Dict[int, str]], optional
+            A converter dict from int labels to names. If given then
+            names are returned instead of int labels.
+        """
+        self.detector = detector
+        self.device = next(detector.parameters()).device
+        self.input_size = input_size
+        self.mean = mean
+        self.std = std
+        self.conf_thresh = conf_thresh
+        self.nms_thresh = nms_thresh
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.max_body_size = max_body_size
+        self.index2name = index2name
+        self.stats = ServerStats(max_batch_size)
+        self.queue: Optional[asyncio.Queue] = None
+
+    def _infer(
+        self, images: List[NDArray], orig_sizes: List[Tuple[int, int]]
+    ) -> List[Dict[str, Any]]:
+        """Detect objects on a batch of images.
+
+        It is called in a worker thread.
+
+        Parameters
+        ----------
+        images : List[NDArray]
+            RGB images. They can have different sizes.
+        orig_sizes : List[Tuple[int, int]]
+            Heights and widths of the original images that boxes
+            are returned for. They differ from the images' sizes
+            for images decoded at a reduced resolution.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            Bounding boxes in images' pixels, labels and scores
+            for every image.
+        """
+        batch = prepare_images_batch(
+            images, self.input_size, self.mean, self.std)
+        bboxes, cls_confs = self.detector.inference(
+            batch.to(device=self.device), self.conf_thresh, self.nms_thresh)
+
+        results = []
+        for (img_h, img_w), img_bboxes, img_confs in zip(
+                orig_sizes, bboxes, cls_confs):
+            scale = torch.tensor([
+                img_w / self.input_size[1], img_h / self.input_size[0]] * 2)
+            scores, labels = img_confs.cpu().max(dim=1)
+            labels = labels.tolist()
+            if self.index2name is not None:
+                labels = [self.index2name[label] for label in labels]
+            img_bboxes = ops.clip_boxes_to_image(
+                img_bboxes.cpu() * scale, (img_h, img_w))
+            results.append({
+                'bboxes': img_bboxes.tolist(),
+                'labels': labels,
+                'scores': scores.tolist(),
+            })
+        return results
+
+    async def _batching_worker(self) -> None:
+        """Gather queued images into batches and run inference."""
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(
+                        await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            images = [image for image, _, _, _ in requests]
+            orig_sizes = [orig_size for _, orig_size, _, _ in requests]
+            try:
+                results = await loop.run_in_executor(
+                    None, self._infer, images, orig_sizes)
+            except Exception as error:
+                for _, _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            end = time.perf_counter()
+            self.stats.add_batch(
+                len(requests), [end - start for _, _, _, start in requests])
+            for (_, _, future, _), result in zip(requests, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def detect(
+        self, image: NDArray, orig_size: Optional[Tuple[int, int]] = None
+    ) -> Dict[str, Any]:
+        """Enqueue an image and wait for its detections.
+
+        Parameters
+        ----------
+        image : NDArray
+            An RGB image.
+        orig_size : Optional[Tuple[int, int]], optional
+            A height and a width of the original image if the image
+            is decoded at a reduced resolution. Boxes are returned
+            for this size. By default is the image's size.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Bounding boxes in image's pixels, labels and scores.
+
+        Raises
+        ------
+        asyncio.QueueFull
+            The queue is full.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((image, orig_size or image.shape[:2], future,
+                               time.perf_counter()))
+        return await future
+
+    def _decode(self, body: bytes) -> Tuple[NDArray, Tuple[int, int]]:
+        """Decode an image not smaller than the detector's input size.
+
+        Jpeg images are decoded at 1/2, 1/4 or 1/8 resolution
+        when it is enough for the input size.
+
+        Parameters
+        ----------
+        body : bytes
+            The encoded image.
+
+        Returns
+        -------
+        Tuple[NDArray, Tuple[int, int]]
+            The RGB image and the original height and width.
+
+        Raises
+        ------
+        ValueError
+            The body is empty or image decoding is not correct.
+        """
+        if not body:
+            raise ValueError('The body is empty.')
+        return decode_image(
+            body, min_size=self.input_size, return_orig_size=True)
+
+    async def _handle_request(
+        self, method: str, path: str, body: bytes
+    ) -> Tuple[int, Dict[str, Any]]:
+        """Handle one HTTP request.
+
+        Parameters
+        ----------
+        method : str
+            The request's method.
+        path : str
+            The request's path.
+        body : bytes
+            The request's body.
+
+        Returns
+        -------
+        Tuple[int, Dict[str, Any]]
+            A status code and a JSON response.
+        """
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats.as_dict(self.queue.qsize())
+        if method != 'POST' or path != '/detect':
+            return 404, {'error': f'Unknown endpoint {method} {path}.'}
+
+        # Decoding is done in a thread to not block other connections
+        loop = asyncio.get_running_loop()
+        try:
+            image, orig_size = await loop.run_in_executor(
+                None, self._decode, body)
+        except (ValueError, cv2.error):
+            return 400, {'error': 'Could not decode the image.'}
+        try:
+            return 200, await self.detect(image, orig_size)
+        except asyncio.QueueFull:
+            return 503, {'error': 'The server is overloaded.'}
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Read an HTTP request from a connection and write a response.
+
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            The connection's reader.
+        writer : asyncio.StreamWriter
+            The connection's writer.
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, path, _ = request_line.split(' ', 2)
+            headers = {}
+            for line in header_lines:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            body_size = int(headers.get('content-length', 0))
+            if body_size > self.max_body_size:
+                status, response = 413, {'error': 'The body is too large.'}
+            else:
+                body = await reader.readexactly(body_size)
+                status, response = await self._handle_request(
+                    method, path, body)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError):
+            status, response = 400, {'error': 'Malformed request.'}
+        except Exception:
+            # Inference failures are not retriable like a full queue
+            status, response = 500, {'error': 'Internal server error.'}
+
+        payload = json.dumps(response).encode()
+        writer.write(
+            f'HTTP/1.1 {status} {HTTP_STATUSES[status]}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            'Connection: close\r\n\r\n'.encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000) -> None:
+        """Run the server until it is cancelled.
+
+        Parameters
+        ----------
+        host : str, optional
+            A host to listen. By default is `"127.0.0.1"`.
+        port : int, optional
+            A port to listen. By default is 8000.
+        """
+        self.queue = asyncio.Queue(self.max_queue_size)
+        worker = asyncio.create_task(self._batching_worker())
+        server = await asyncio.start_server(
+            self._handle_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
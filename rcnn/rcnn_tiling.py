@@ -0,0 +1,210 @@
+"""A module that contains tiled sliding-window R-CNN inference.
+
+Large images are cut into overlapping tiles of the detector's input size
+instead of being resized. Tiles are streamed through the detector
+by small batches, so memory does not depend on an image size.
+Predictions are mapped back to image coordinates and duplicates
+on tiles' seams are merged with a global NMS.
+"""
+
+
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from torch import FloatTensor, IntTensor
+import torch.nn.functional as F
+
+from rcnn.rcnn_model import RCNN_Detector
+from rcnn.rcnn_utils import batched_nms_per_image, count_per_image
+
+
+def get_tile_starts(size: int, tile_size: int, overlap: int) -> List[int]:
+    """Get start coordinates of overlapping tiles along one side.
+
+    The last tile is aligned with the side's end, so tiles do not
+    go out of the image.
+
+    Parameters
+    ----------
+    size : int
+        A size of the image's side.
+    tile_size : int
+        A size of the tile's side.
+    overlap : int
+        A minimum overlap of neighboring tiles.
+
+    Returns
+    -------
+    List[int]
+        The start coordinates.
+
+    Raises
+    ------
+    ValueError
+        Overlap must be less than the tile size.
+    """
+    if overlap >= tile_size:
+        raise ValueError(
+            f'Overlap must be less than the tile size but got {overlap} '
+            f'and {tile_size}.')
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def iterate_tiles(
+    images: Sequence[FloatTensor],
+    tile_size: Tuple[int, int],
+    overlap: Tuple[int, int],
+    tiles_per_batch: int
+) -> Iterator[Tuple[FloatTensor, IntTensor, FloatTensor]]:
+    """Iterate over batches of tiles of images.
+
+    Only one batch of tiles is materialized at a time.
+    Images that are smaller than a tile are padded with zeros.
+
+    Parameters
+    ----------
+    images : Sequence[FloatTensor]
+        Images with shape `(3, img_h, img_w)`. They can have different sizes.
+    tile_size : Tuple[int, int]
+        A height and a width of the tiles.
+    overlap : Tuple[int, int]
+        Minimum vertical and horizontal overlaps of neighboring tiles.
+    tiles_per_batch : int
+        A maximum number of tiles in a batch.
+
+    Yields
+    ------
+    Iterator[Tuple[FloatTensor, IntTensor, FloatTensor]]
+        Tiles with shape `(n_tiles, 3, tile_h, tile_w)`,
+        indexes of their images with shape `(n_tiles,)`
+        and their offsets in xyxy format with shape `(n_tiles, 4)`.
+    """
+    tile_h, tile_w = tile_size
+    tiles = []
+    img_idxs = []
+    offsets = []
+    for i, image in enumerate(images):
+        img_h, img_w = image.shape[-2:]
+        image = F.pad(
+            image, (0, max(tile_w - img_w, 0), 0, max(tile_h - img_h, 0)))
+        for y in get_tile_starts(img_h, tile_h, overlap[0]):
+            for x in get_tile_starts(img_w, tile_w, overlap[1]):
+                tiles.append(image[:, y:y + tile_h, x:x + tile_w])
+                img_idxs.append(i)
+                offsets.append((x, y, x, y))
+                if len(tiles) == tiles_per_batch:
+                    yield (torch.stack(tiles), torch.tensor(img_idxs),
+                           torch.tensor(offsets, dtype=torch.float32))
+                    tiles = []
+                    img_idxs = []
+                    offsets = []
+    if len(tiles) != 0:
+        yield (torch.stack(tiles), torch.tensor(img_idxs),
+               torch.tensor(offsets, dtype=torch.float32))
+
+
+def tiled_inference(
+    detector: RCNN_Detector,
+    images: Sequence[FloatTensor],
+    tile_size: Tuple[int, int],
+    overlap: Tuple[int, int] = (64, 64),
+    tiles_per_batch: int = 8,
+    conf_thresh: float = 0.5,
+    nms_thresh: float = 0.7,
+    merge_thresh: Optional[float] = None,
+    pre_nms_top_k: Optional[int] = None,
+    post_nms_top_k: Optional[int] = None,
+    max_detections: Optional[int] = None,
+    amp: Optional[bool] = None
+) -> Tuple[List[FloatTensor], List[FloatTensor]]:
+    """Do tiled sliding-window inference of R-CNN on large images.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A detector in the evaluation mode.
+    images : Sequence[FloatTensor]
+        Normalized images with shape `(3, img_h, img_w)`. They can have
+        different sizes and can be kept on CPU. Tiles are moved
+        to the detector's device by batches.
+    tile_size : Tuple[int, int]
+        A height and a width of the tiles. Usually it is the detector's
+        input size.
+    overlap : Tuple[int, int], optional
+        Minimum vertical and horizontal overlaps of neighboring tiles.
+        They should be bigger than expected objects. By default is (64, 64).
+    tiles_per_batch : int, optional
+        A maximum number of tiles that pass through the detector at once.
+        By default is 8.
+    conf_thresh : float, optional
+        Object confidence threshold. By default is 0.5.
+    nms_thresh : float, optional
+        IoU NMS threshold within a tile. By default is 0.7.
+    merge_thresh : Optional[float], optional
+        IoU threshold of the global NMS that merges duplicates of tiles'
+        overlaps. If not given then `nms_thresh` is used.
+    pre_nms_top_k : Optional[int], optional
+        A maximum number of the most confident anchors per tile
+        that are considered before NMS. By default is `None`
+        that means no limit.
+    post_nms_top_k : Optional[int], optional
+        A maximum number of predictions per tile. By default is `None`
+        that means no limit.
+    max_detections : Optional[int], optional
+        A maximum number of predictions per image after merging.
+        By default is `None` that means no limit.
+    amp : Optional[bool], optional
+        Whether to run the detector with automatic mixed precision.
+        If not given then the detector's setting is used.
+
+    Returns
+    -------
+    Tuple[List[FloatTensor], List[FloatTensor]]
+        Bounding boxes list with length `n_images`
+        and each element has shape `(n_pred_per_img, 4)`
+        and predicted classes list with length `n_images`
+        and each element has shape `(n_pred_per_img, n_cls)`.
+        Predictions of an image are sorted by the class confidence.
+    """
+    if merge_thresh is None:
+        merge_thresh = nms_thresh
+    device = next(detector.parameters()).device
+    # Bounds to clip boxes with xyxy
+    limits = torch.tensor(
+        [[img.shape[-1], img.shape[-2], img.shape[-1], img.shape[-2]]
+         for img in images], dtype=torch.float32, device=device)
+
+    bboxes = []
+    cls_confs = []
+    b_idxs = []
+    for tiles, img_idxs, offsets in iterate_tiles(
+            images, tile_size, overlap, tiles_per_batch):
+        tiles_bboxes, tiles_confs = detector.inference(
+            tiles.to(device=device), conf_thresh, nms_thresh,
+            pre_nms_top_k, post_nms_top_k, amp)
+        n_preds = torch.tensor(
+            [tile_bboxes.shape[0] for tile_bboxes in tiles_bboxes],
+            device=device)
+        pred_img_idxs = img_idxs.to(device=device).repeat_interleave(n_preds)
+        tiles_bboxes = torch.cat(tiles_bboxes) + (
+            offsets.to(device=device).repeat_interleave(n_preds, dim=0))
+        bboxes.append(torch.minimum(
+            tiles_bboxes.clamp(min=0.0), limits[pred_img_idxs]))
+        cls_confs.append(torch.cat(tiles_confs))
+        b_idxs.append(pred_img_idxs)
+
+    bboxes = torch.cat(bboxes)
+    cls_confs = torch.cat(cls_confs)
+    b_idxs = torch.cat(b_idxs)
+
+    keep = batched_nms_per_image(
+        bboxes, cls_confs.max(dim=1).values, b_idxs, merge_thresh,
+        max_detections, len(images))
+    n_preds = count_per_image(b_idxs[keep], len(images)).tolist()
+    return (list(torch.split(bboxes[keep], n_preds)),
+            list(torch.split(cls_confs[keep], n_preds)))
@@ -2,7 +2,9 @@
 
 
 from typing import Iterable, Tuple, Union, Dict, Optional, List
+from collections import OrderedDict
 
+import numpy as np
 from numpy.typing import NDArray
 import torch
 from torch import FloatTensor, IntTensor, Tensor
@@ -305,6 +307,74 @@ def generate_anchor_boxes(
     return anc_base
 
 
+class AnchorGridCache:
+    """A bounded LRU cache of anchor boxes grids.
+
+    Grids are generated on demand for every feature map size and device
+    and the least recently used ones are dropped when the cache is full.
+    """
+
+    def __init__(
+        self,
+        anc_scales: Iterable[float],
+        anc_ratios: Iterable[float],
+        max_size: int = 8
+    ) -> None:
+        """Initialize `AnchorGridCache`.
+
+        Parameters
+        ----------
+        anc_scales : Iterable[float]
+            Scale factors of anchor bounding boxes.
+        anc_ratios : Iterable[float]
+            Ratio factors of anchor bounding boxes sides.
+        max_size : int, optional
+            A maximum number of cached grids. By default is 8.
+        """
+        self.anc_scales = tuple(anc_scales)
+        self.anc_ratios = tuple(anc_ratios)
+        self.max_size = max_size
+        self._grids: OrderedDict[
+            Tuple[int, int, torch.device], FloatTensor] = OrderedDict()
+
+    def get(
+        self, map_h: int, map_w: int, device: Union[torch.device, str]
+    ) -> FloatTensor:
+        """Get an anchor boxes grid for a feature map size.
+
+        Parameters
+        ----------
+        map_h : int
+            A height of the feature map.
+        map_w : int
+            A width of the feature map.
+        device : Union[torch.device, str]
+            A device of the grid.
+
+        Returns
+        -------
+        FloatTensor
+            The anchor boxes grid with shape `[map_h, map_w, n_anc, 4]`.
+        """
+        key = (map_h, map_w, torch.device(device))
+        grid = self._grids.get(key)
+        if grid is not None:
+            self._grids.move_to_end(key)
+            return grid
+
+        x_anc_pts, y_anc_pts = generate_anchors((map_h, map_w))
+        grid = generate_anchor_boxes(
+            x_anc_pts, y_anc_pts, self.anc_scales, self.anc_ratios,
+            (map_h, map_w)).to(device=device)
+        self._grids[key] = grid
+        if len(self._grids) > self.max_size:
+            self._grids.popitem(last=False)
+        return grid
+
+    def __len__(self) -> int:
+        return len(self._grids)
+
+
 def project_bboxes(
     bboxes: FloatTensor,
     width_scale_factor: float,
@@ -340,16 +410,15 @@ def project_bboxes(
         raise ValueError(
             'The mode must be either "a2p" or "p2a", '
             f'but given mode is {mode}.')
-    batch_size = bboxes.shape[0]
-    proj_bboxes = bboxes.clone().reshape(batch_size, -1, 4)
+    proj_bboxes = bboxes.clone().reshape(-1, 4)
     pad_bbox_mask = (proj_bboxes == -1)  # indicating padded bboxes
 
     if mode == 'a2p':
-        proj_bboxes[:, :, [0, 2]] *= width_scale_factor
-        proj_bboxes[:, :, [1, 3]] *= height_scale_factor
+        proj_bboxes[:, [0, 2]] *= width_scale_factor
+        proj_bboxes[:, [1, 3]] *= height_scale_factor
     elif mode == 'p2a':
-        proj_bboxes[:, :, [0, 2]] /= width_scale_factor
-        proj_bboxes[:, :, [1, 3]] /= height_scale_factor
+        proj_bboxes[:, [0, 2]] /= width_scale_factor
+        proj_bboxes[:, [1, 3]] /= height_scale_factor
 
     proj_bboxes[pad_bbox_mask] = -1
     proj_bboxes = proj_bboxes.reshape(bboxes.shape)
@@ -402,6 +471,336 @@ def anc_gt_iou(
     return torch.stack(torch.chunk(iou, b_size, dim=1))
 
 
+# Approximate bytes of `box_iou` temporaries per an anchor-box pair
+IOU_BYTES_PER_PAIR = 40
+
+
+def match_anchors(
+    anc_boxes_grid: FloatTensor,
+    gt_boxes: FloatTensor,
+    pos_thresh: float,
+    max_iou_memory: int = 64 * 1024 ** 2
+) -> Tuple[IntTensor, IntTensor, FloatTensor, IntTensor]:
+    """Match anchor boxes with a batch of ground truth boxes.
+
+    It gives the same result as the dense `anc_gt_iou` matching
+    but padded `-1` ground truth boxes are skipped and IoU is calculated
+    per image in chunks of anchors, so its memory is bounded.
+    As positive anchors depend on the best IoU of every ground truth box
+    over all anchors, IoU is recalculated on the second pass
+    when there are several chunks.
+
+    Parameters
+    ----------
+    anc_boxes_grid : FloatTensor
+        A grid of the anchor boxes with shape `[n_anc, 4]`.
+    gt_boxes : FloatTensor
+        The ground truth boxes with shape `[b, n_max_obj, 4]`.
+    pos_thresh : float
+        IoU threshold for positive anchor boxes.
+    max_iou_memory : int, optional
+        Approximate memory ceiling in bytes for one chunk's IoU
+        calculation. By default is 64 MiB.
+
+    Returns
+    -------
+    Tuple[IntTensor, IntTensor, FloatTensor, IntTensor]
+        Batch indexes of positive anchors with shape `[n_pos]`,
+        their indexes in the flattened batch of anchors with shape `[n_pos]`
+        (an anchor is repeated for every ground truth box it is positive
+        for), max IoU of every anchor with shape `[b * n_anc]`
+        and indexes of the ground truth boxes that give the max IoU
+        with shape `[b * n_anc]`.
+    """
+    n_anc = anc_boxes_grid.shape[0]
+    b_size = gt_boxes.shape[0]
+    device = anc_boxes_grid.device
+
+    pos_anc_idxs = []
+    max_iou_per_anc = torch.zeros(
+        (b_size, n_anc), dtype=anc_boxes_grid.dtype, device=device)
+    max_iou_gt_idxs = torch.zeros(
+        (b_size, n_anc), dtype=torch.long, device=device)
+    for i in range(b_size):
+        # Padded boxes have zero IoU with every anchor, so they are never
+        # positive and do not change max values
+        gt_idxs = torch.where((gt_boxes[i] != -1).any(dim=1))[0]
+        n_gt = gt_idxs.shape[0]
+        if n_gt == 0:
+            continue
+        img_gt_boxes = gt_boxes[i, gt_idxs]
+        chunk_size = max(1, max_iou_memory // (n_gt * IOU_BYTES_PER_PAIR))
+        chunks = range(0, n_anc, chunk_size)
+
+        max_iou_per_gt = torch.zeros(
+            n_gt, dtype=anc_boxes_grid.dtype, device=device)
+        for start in chunks:
+            iou = torchvision.ops.box_iou(
+                anc_boxes_grid[start:start + chunk_size], img_gt_boxes)
+            max_iou_per_gt = torch.maximum(
+                max_iou_per_gt, iou.max(dim=0).values)
+            chunk_max_iou, chunk_max_idxs = iou.max(dim=1)
+            max_iou_per_anc[i, start:start + chunk_size] = chunk_max_iou
+            max_iou_gt_idxs[i, start:start + chunk_size] = (
+                gt_idxs[chunk_max_idxs])
+
+        for start in chunks:
+            if len(chunks) > 1:
+                iou = torchvision.ops.box_iou(
+                    anc_boxes_grid[start:start + chunk_size], img_gt_boxes)
+            # Max anchors' IoU per each ground truth and other anchors
+            # that passed the threshold
+            positive_mask = torch.logical_or(
+                torch.logical_and(
+                    iou == max_iou_per_gt, max_iou_per_gt > 0.0),
+                iou > pos_thresh)
+            # Rows are repeated for every matched ground truth
+            pos_anc_idxs.append(
+                torch.where(positive_mask)[0] + i * n_anc + start)
+
+    if pos_anc_idxs:
+        pos_anc_idxs = torch.cat(pos_anc_idxs)
+    else:
+        pos_anc_idxs = torch.zeros((0,), dtype=torch.long, device=device)
+    pos_b_idxs = torch.div(pos_anc_idxs, n_anc, rounding_mode='floor')
+    return (pos_b_idxs, pos_anc_idxs, max_iou_per_anc.flatten(),
+            max_iou_gt_idxs.flatten())
+
+
+def paired_box_iou(boxes1: FloatTensor, boxes2: FloatTensor) -> FloatTensor:
+    """Calculate IoU between corresponding boxes of two sets.
+
+    Operations are the same as in `torchvision.ops.box_iou`, so values
+    are equal to the corresponding elements of its IoU matrix.
+
+    Parameters
+    ----------
+    boxes1 : FloatTensor
+        Boxes in xyxy system with shape `[n, 4]`.
+    boxes2 : FloatTensor
+        Boxes in xyxy system with shape `[n, 4]`.
+
+    Returns
+    -------
+    FloatTensor
+        IoU with shape `[n]`.
+    """
+    area1 = torchvision.ops.box_area(boxes1)
+    area2 = torchvision.ops.box_area(boxes2)
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[:, 0] * wh[:, 1]
+    union = area1 + area2 - inter
+    return inter / union
+
+
+def _expand_ranges(
+    starts: IntTensor, lengths: IntTensor
+) -> Tuple[IntTensor, IntTensor]:
+    """Expand integer ranges into their elements.
+
+    Parameters
+    ----------
+    starts : IntTensor
+        Starts of the ranges with shape `[n]`.
+    lengths : IntTensor
+        Non-negative lengths of the ranges with shape `[n]`.
+
+    Returns
+    -------
+    Tuple[IntTensor, IntTensor]
+        Indexes of the ranges of the elements and the elements.
+    """
+    range_idxs = torch.repeat_interleave(
+        torch.arange(starts.shape[0], device=starts.device), lengths)
+    offsets = starts - (torch.cumsum(lengths, 0) - lengths)
+    elements = (torch.arange(range_idxs.shape[0], device=starts.device) +
+                offsets.index_select(0, range_idxs))
+    return range_idxs, elements
+
+
+def _get_intersecting_pairs_of_group(
+    anc_boxes: FloatTensor, boxes: FloatTensor
+) -> Tuple[IntTensor, IntTensor]:
+    """Get pairs of anchor boxes of similar sizes and boxes that intersect.
+
+    Anchors are bucketed into a regular grid of cells by their top-left
+    corners. A box can intersect only anchors whose corners are left of
+    and above its bottom-right corner and not farther than the biggest
+    anchor's size from its top-left corner. Every row of cells
+    is a contiguous range of sorted anchors, so candidates are gathered
+    without comparing the box with every anchor and then are checked
+    exactly.
+
+    Parameters
+    ----------
+    anc_boxes : FloatTensor
+        Anchor boxes with shape `[n_anc, 4]`.
+    boxes : FloatTensor
+        Boxes with shape `[n_boxes, 4]`.
+
+    Returns
+    -------
+    Tuple[IntTensor, IntTensor]
+        Indexes of the anchors and of the boxes of the pairs.
+    """
+    device = anc_boxes.device
+    anc_sizes = anc_boxes[:, 2:] - anc_boxes[:, :2]
+    max_size = anc_sizes.max(dim=0).values
+    origin = anc_boxes[:, :2].min(dim=0).values
+    # A quarter of the biggest anchor keeps both a number of cells' rows
+    # per box and extra candidates small
+    cell_size = (max_size / 4).clamp(min=1e-6)
+    n_cells = ((anc_boxes[:, :2].max(dim=0).values - origin) /
+               cell_size).long() + 1
+    n_cells_x = int(n_cells[0])
+
+    anc_cells = ((anc_boxes[:, :2] - origin) / cell_size).long()
+    anc_cell_idxs = anc_cells[:, 1] * n_cells_x + anc_cells[:, 0]
+    sorted_cell_idxs, order = torch.sort(anc_cell_idxs, stable=True)
+    cell_starts = torch.searchsorted(
+        sorted_cell_idxs,
+        torch.arange(int(n_cells.prod()) + 1, device=device))
+
+    # One more cell on the near side covers rounding errors
+    first_cells = ((boxes[:, :2] - max_size - origin) /
+                   cell_size).floor().long() - 1
+    last_cells = ((boxes[:, 2:] - origin) / cell_size).floor().long()
+    first_cells = torch.minimum(first_cells.clamp(min=0), n_cells - 1)
+    last_cells = torch.minimum(last_cells.clamp(min=0), n_cells - 1)
+
+    # Ranges of sorted anchors for every row of cells of every box
+    n_rows = (last_cells[:, 1] - first_cells[:, 1] + 1).clamp(min=0)
+    row_box_idxs, rows = _expand_ranges(first_cells[:, 1], n_rows)
+    starts = cell_starts[rows * n_cells_x + first_cells[row_box_idxs, 0]]
+    ends = cell_starts[rows * n_cells_x + last_cells[row_box_idxs, 0] + 1]
+    range_idxs, anc_positions = _expand_ranges(
+        starts, (ends - starts).clamp(min=0))
+    anc_idxs = order.index_select(0, anc_positions)
+    box_idxs = row_box_idxs.index_select(0, range_idxs)
+
+    candidate_ancs = anc_boxes.index_select(0, anc_idxs)
+    candidate_boxes = boxes.index_select(0, box_idxs)
+    intersect = torch.logical_and(
+        (candidate_ancs[:, :2] < candidate_boxes[:, 2:]).all(dim=1),
+        (candidate_ancs[:, 2:] > candidate_boxes[:, :2]).all(dim=1))
+    intersect_idxs = torch.where(intersect)[0]
+    return (anc_idxs.index_select(0, intersect_idxs),
+            box_idxs.index_select(0, intersect_idxs))
+
+
+def get_intersecting_pairs(
+    anc_boxes_grid: FloatTensor, boxes: FloatTensor
+) -> Tuple[IntTensor, IntTensor]:
+    """Get pairs of anchor boxes and boxes that intersect.
+
+    Only such pairs can have non-zero IoU. Anchors are split into groups
+    by powers of two of their widths and heights, so a search area
+    of a box is extended only by sizes of the group's anchors,
+    and every group is searched with a grid of cells.
+
+    Parameters
+    ----------
+    anc_boxes_grid : FloatTensor
+        Anchor boxes with shape `[n_anc, 4]`.
+    boxes : FloatTensor
+        Boxes with shape `[n_boxes, 4]`.
+
+    Returns
+    -------
+    Tuple[IntTensor, IntTensor]
+        Indexes of the anchors and of the boxes of the pairs.
+    """
+    anc_sizes = anc_boxes_grid[:, 2:] - anc_boxes_grid[:, :2]
+    size_classes = torch.log2(anc_sizes.clamp(min=1e-6)).ceil().long()
+    _, groups = torch.unique(size_classes, dim=0, return_inverse=True)
+
+    anc_idxs = []
+    box_idxs = []
+    for group in range(int(groups.max()) + 1):
+        group_anc_idxs = torch.where(groups == group)[0]
+        group_pair_ancs, group_pair_boxes = _get_intersecting_pairs_of_group(
+            anc_boxes_grid.index_select(0, group_anc_idxs), boxes)
+        anc_idxs.append(group_anc_idxs.index_select(0, group_pair_ancs))
+        box_idxs.append(group_pair_boxes)
+    return torch.cat(anc_idxs), torch.cat(box_idxs)
+
+
+def match_anchors_spatial(
+    anc_boxes_grid: FloatTensor,
+    gt_boxes: FloatTensor,
+    pos_thresh: float
+) -> Tuple[IntTensor, IntTensor, FloatTensor, IntTensor]:
+    """Match anchor boxes with ground truth boxes of intersecting pairs.
+
+    It gives the same result as `match_anchors` but IoU is calculated
+    only for anchor and ground truth boxes that intersect. They are found
+    with `get_intersecting_pairs`, so the work grows with a number
+    of objects and their areas rather than with `n_anc * n_max_obj`.
+
+    Parameters
+    ----------
+    anc_boxes_grid : FloatTensor
+        A grid of the anchor boxes with shape `[n_anc, 4]`.
+    gt_boxes : FloatTensor
+        The ground truth boxes with shape `[b, n_max_obj, 4]`.
+        Padded boxes are filled with `-1`.
+    pos_thresh : float
+        IoU threshold for positive anchor boxes.
+
+    Returns
+    -------
+    Tuple[IntTensor, IntTensor, FloatTensor, IntTensor]
+        Batch indexes of positive anchors with shape `[n_pos]`,
+        their indexes in the flattened batch of anchors with shape `[n_pos]`
+        (an anchor is repeated for every ground truth box it is positive
+        for), max IoU of every anchor with shape `[b * n_anc]`
+        and indexes of the ground truth boxes that give the max IoU
+        with shape `[b * n_anc]`.
+    """
+    n_anc = anc_boxes_grid.shape[0]
+    b_size = gt_boxes.shape[0]
+    device = anc_boxes_grid.device
+
+    real_mask = (gt_boxes != -1).any(dim=2)
+    gt_b_idxs, gt_idxs = torch.where(real_mask)
+    real_gt_boxes = gt_boxes[gt_b_idxs, gt_idxs]
+    anc_idxs, pair_gt = get_intersecting_pairs(anc_boxes_grid, real_gt_boxes)
+    iou = paired_box_iou(
+        anc_boxes_grid.index_select(0, anc_idxs),
+        real_gt_boxes.index_select(0, pair_gt))
+    pair_anc = gt_b_idxs.index_select(0, pair_gt) * n_anc + anc_idxs
+
+    # Not intersecting pairs have zero IoU
+    max_iou_per_gt = torch.zeros(
+        gt_idxs.shape[0], dtype=iou.dtype, device=device).scatter_reduce(
+            0, pair_gt, iou, 'amax')
+    max_iou_per_anc = torch.zeros(
+        b_size * n_anc, dtype=iou.dtype, device=device).scatter_reduce(
+            0, pair_anc, iou, 'amax')
+    # Ties are resolved to the first ground truth box like `max` does
+    # and anchors without overlaps get the first not padded box
+    max_iou_gt_idxs = real_mask.byte().argmax(dim=1).repeat_interleave(n_anc)
+    best_idxs = torch.where(torch.logical_and(
+        iou == max_iou_per_anc.index_select(0, pair_anc), iou > 0.0))[0]
+    max_iou_gt_idxs = max_iou_gt_idxs.scatter_reduce(
+        0, pair_anc.index_select(0, best_idxs),
+        gt_idxs.index_select(0, pair_gt.index_select(0, best_idxs)), 'amin',
+        include_self=False)
+
+    # Max anchors' IoU per each ground truth and other anchors
+    # that passed the threshold
+    pair_max_iou_per_gt = max_iou_per_gt.index_select(0, pair_gt)
+    positive_mask = torch.logical_or(
+        torch.logical_and(
+            iou == pair_max_iou_per_gt, pair_max_iou_per_gt > 0.0),
+        iou > pos_thresh)
+    pos_anc_idxs = torch.sort(pair_anc[positive_mask]).values
+    pos_b_idxs = torch.div(pos_anc_idxs, n_anc, rounding_mode='floor')
+    return pos_b_idxs, pos_anc_idxs, max_iou_per_anc, max_iou_gt_idxs
+
+
 def calculate_gt_offsets(
     positive_anchors: FloatTensor,
     gt_bboxes: FloatTensor
@@ -448,9 +847,15 @@ def get_required_anchors(
     gt_boxes: FloatTensor,
     gt_classes: FloatTensor,
     pos_thresh: float = 0.7,
-    neg_thresh: float = 0.2
-) -> Tuple[IntTensor, IntTensor, IntTensor, FloatTensor, FloatTensor,
-           FloatTensor, FloatTensor, FloatTensor]:
+    neg_thresh: float = 0.2,
+    max_iou_memory: int = 64 * 1024 ** 2,
+    spatial_matching: bool = False,
+    return_matches: bool = False
+) -> Union[Tuple[IntTensor, IntTensor, IntTensor, FloatTensor, FloatTensor,
+                 FloatTensor, FloatTensor, FloatTensor],
+           Tuple[IntTensor, IntTensor, IntTensor, FloatTensor, FloatTensor,
+                 FloatTensor, FloatTensor, FloatTensor, IntTensor,
+                 IntTensor]]:
     """Get required anchors from all available ones.
 
     Get indices for positive anchor boxes, and the same number of indices for
@@ -478,89 +883,384 @@ def get_required_anchors(
         Confidence threshold for positive anchor boxes. By default is 0.7.
     neg_thresh : float, optional
         Confidence threshold for negative anchor boxes. By default is 0.2.
+    max_iou_memory : int, optional
+        Approximate memory ceiling in bytes for IoU calculation
+        of one chunk of anchors. By default is 64 MiB.
+    spatial_matching : bool, optional
+        Whether to calculate IoU only for intersecting anchor
+        and ground truth boxes with `match_anchors_spatial`.
+        The result is the same. By default is `False`.
+    return_matches : bool, optional
+        Whether to return indexes of positive anchors' ground truth boxes
+        in `gt_boxes[pos_b_idxs]` and indexes of all negative anchors
+        before the cut additionally. By default is `False`.
 
     Returns
     -------
-    Tuple[IntTensor, IntTensor, IntTensor, FloatTensor, FloatTensor,
-          FloatTensor, FloatTensor, FloatTensor]
+    Union[Tuple[IntTensor, IntTensor, IntTensor, FloatTensor, FloatTensor,
+                FloatTensor, FloatTensor, FloatTensor],
+          Tuple[IntTensor, IntTensor, IntTensor, FloatTensor, FloatTensor,
+                FloatTensor, FloatTensor, FloatTensor, IntTensor,
+                IntTensor]]
         Tuple consists of described above `pos_anc_idxs`, `neg_anc_idxs`,
         `pos_b_idxs`, `pos_ancs`, `neg_ancs`, `pos_anc_conf_scores`,
-        `gt_class_pos` and `gt_offsets`.
+        `gt_class_pos`, `gt_offsets` and optionally `pos_gt_idxs`
+        and `all_neg_anc_idxs`.
     """
-    anchors_per_img = anc_boxes_all.shape[1]
-    b_size, n_max_objects = gt_boxes.shape[:2]
-
     # Send only anchor boxes grid (one slice of the anchors batch)
-    # iou shape - (b, all_anc, max_obj)
-    iou = anc_gt_iou(anc_boxes_all[0], gt_boxes)
-    max_iou_per_gt, indexes = iou.max(dim=1, keepdim=True)  # (b, 1, max_obj)
-
-    # Get max anchors' iou per each ground truth.
-    positive_anc_mask = torch.logical_and(
-        iou == max_iou_per_gt, max_iou_per_gt > 0.0)
-    # and other that passed the threshold.
-    positive_anc_mask = torch.logical_or(positive_anc_mask, iou > pos_thresh)
-
-    # Get batch indexes of the positive anchors.
-    # It is necessary to determine the ownership of the anchors.
-    pos_b_idxs = torch.where(positive_anc_mask)[0]
-    # Flat a batch dimension with num_all_anchors
-    # (b * num_all_anchors, max_num_objects)
-    positive_anc_mask = positive_anc_mask.flatten(end_dim=1)
-    # We do not need to know number of object in image that has this positive
-    # anchor. We need to know just index in num_all_anchors.
-    pos_anc_idxs = torch.where(positive_anc_mask)[0]
-
-    # Now need to determine the nearest gt bbox for every anchor
-    max_iou_per_anc, max_iou_per_anc_idx = iou.max(dim=-1)  # b, all_anc
-    # Flat tensor so the positive indexes fit
-    # b * all_anc, max_obj
-    max_iou_per_anc = max_iou_per_anc.flatten(end_dim=1)
+    if spatial_matching:
+        pos_b_idxs, pos_anc_idxs, max_iou_per_anc, max_iou_gt_idxs = (
+            match_anchors_spatial(anc_boxes_all[0], gt_boxes, pos_thresh))
+    else:
+        pos_b_idxs, pos_anc_idxs, max_iou_per_anc, max_iou_gt_idxs = (
+            match_anchors(anc_boxes_all[0], gt_boxes, pos_thresh,
+                          max_iou_memory))
 
     # Get score for each positive anchors.
     pos_anc_conf_scores = max_iou_per_anc[pos_anc_idxs]
 
-    # Get classes of positive anchors
-    # expand gt classes to map against every anchor box
-    gt_classes_expand = gt_classes[:, None, :].expand(
-        b_size, anchors_per_img, n_max_objects)
-    # for every anchor box, consider only the class of the gt bbox
+    # For every positive anchor consider only the gt bbox
     # it overlaps with the most.
-    anc_classes = torch.gather(
-        gt_classes_expand, -1, max_iou_per_anc_idx[..., None]).squeeze(-1)
-    # Flat tensor so the positive indexes fit
-    anc_classes = anc_classes.flatten(start_dim=0, end_dim=1)
-    gt_class_pos = anc_classes[pos_anc_idxs]
+    pos_gt_idxs = max_iou_gt_idxs[pos_anc_idxs]
+    gt_class_pos = gt_classes[pos_b_idxs, pos_gt_idxs]
+    nearest_gt_boxes = gt_boxes[pos_b_idxs, pos_gt_idxs]  # pos_anc, 4
 
-    # Expand and flat anchors to iterate with gotten positive indexes
+    # Flat anchors to iterate with gotten positive indexes
     anc_boxes_all_flat = anc_boxes_all.flatten(end_dim=1)
     pos_ancs = anc_boxes_all_flat[pos_anc_idxs]
-    
-    # Expand gt boxes to map every anchor
-    gt_boxes_expand = gt_boxes[:, None, ...].expand(
-        b_size, anchors_per_img, n_max_objects, 4)  # b, all_anc, max_obj, 4
-    # Get the nearest gt boxes from max_samples gt boxes
-    nearest_gt_boxes = torch.gather(
-        gt_boxes_expand,
-        2,
-        max_iou_per_anc_idx[..., None, None].repeat(1, 1, 1, 4)
-    )  # b, all_anc, 1, 4
-    nearest_gt_boxes = nearest_gt_boxes.flatten(end_dim=2)  # b*all_anc, 4
-    nearest_gt_boxes = nearest_gt_boxes[pos_anc_idxs]  # pos_anc, 4
 
     # Get offsets for positive anchors.
     gt_offsets = calculate_gt_offsets(
         pos_ancs, nearest_gt_boxes)  # pos_anc, 4
 
     negative_mask = max_iou_per_anc < neg_thresh
-    neg_anc_idxs = torch.where(negative_mask)[0]
+    all_neg_anc_idxs = torch.where(negative_mask)[0]
     # Cut negative anchors. Get the same count as positive.
-    neg_anc_idxs = neg_anc_idxs[
+    neg_anc_idxs = all_neg_anc_idxs[
         torch.randint(0,
-                      neg_anc_idxs.shape[0],
+                      all_neg_anc_idxs.shape[0],
                       (pos_anc_idxs.shape[0],))]
     # Get negative anchors
     neg_ancs = anc_boxes_all_flat[neg_anc_idxs]
 
+    if return_matches:
+        return (pos_anc_idxs, neg_anc_idxs, pos_b_idxs, pos_ancs, neg_ancs,
+                pos_anc_conf_scores, gt_class_pos, gt_offsets, pos_gt_idxs,
+                all_neg_anc_idxs)
     return (pos_anc_idxs, neg_anc_idxs, pos_b_idxs, pos_ancs, neg_ancs,
             pos_anc_conf_scores, gt_class_pos, gt_offsets)
+
+
+def _group_ranks(sorted_keys: IntTensor) -> IntTensor:
+    """Get positions of elements inside runs of equal sorted keys.
+
+    Parameters
+    ----------
+    sorted_keys : IntTensor
+        Sorted keys with shape `[n]`.
+
+    Returns
+    -------
+    IntTensor
+        The positions with shape `[n]`.
+    """
+    idxs = torch.arange(sorted_keys.shape[0], device=sorted_keys.device)
+    run_starts = torch.ones_like(sorted_keys, dtype=torch.bool)
+    run_starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    if sorted_keys.shape[0] == 0:
+        return idxs
+    start_idxs = torch.cummax(
+        torch.where(run_starts, idxs, torch.zeros_like(idxs)), dim=0).values
+    return idxs - start_idxs
+
+
+class ProposalSampler:
+    """A sampler of a fixed budget of classifier proposals per image.
+
+    Every positive anchor gives a proposal, so there are many near
+    duplicate proposals for every ground truth box. Only `n_per_gt`
+    proposals with the best anchors' IoU are kept for a box.
+    Then up to the foreground budget of kept proposals are randomly
+    sampled per image. With a background class, negative anchors
+    are added as background proposals up to `n_per_img` per image.
+    """
+
+    def __init__(
+        self,
+        n_per_img: int = 64,
+        n_per_gt: int = 1,
+        background_class: Optional[int] = None,
+        fg_fraction: float = 0.25
+    ) -> None:
+        """Initialize `ProposalSampler`.
+
+        Parameters
+        ----------
+        n_per_img : int, optional
+            A maximum number of proposals per image. By default is 64.
+        n_per_gt : int, optional
+            A maximum number of proposals per ground truth box.
+            By default is 1.
+        background_class : Optional[int], optional
+            A class of background proposals. If not given then background
+            proposals are not added.
+        fg_fraction : float, optional
+            A maximum fraction of foreground proposals of an image
+            when background proposals are added. By default is 0.25.
+        """
+        self.n_per_img = n_per_img
+        self.n_per_gt = n_per_gt
+        self.background_class = background_class
+        if background_class is None:
+            self.n_fg_per_img = n_per_img
+        else:
+            self.n_fg_per_img = max(1, int(n_per_img * fg_fraction))
+
+    def _sample_per_image(
+        self, b_idxs: IntTensor, n_per_img: IntTensor
+    ) -> IntTensor:
+        """Randomly sample elements up to a limit per image.
+
+        Parameters
+        ----------
+        b_idxs : IntTensor
+            Batch indexes of the elements with shape `[n]`.
+        n_per_img : IntTensor
+            Limits of the images with shape `[b]`.
+
+        Returns
+        -------
+        IntTensor
+            Sorted indexes of the sampled elements.
+        """
+        shuffled = torch.randperm(b_idxs.shape[0], device=b_idxs.device)
+        shuffled = shuffled[torch.argsort(b_idxs[shuffled], stable=True)]
+        ranks = _group_ranks(b_idxs[shuffled])
+        return torch.sort(
+            shuffled[ranks < n_per_img[b_idxs[shuffled]]]).values
+
+    def __call__(
+        self,
+        proposals: FloatTensor,
+        pos_b_idxs: IntTensor,
+        pos_gt_idxs: IntTensor,
+        pos_scores: FloatTensor,
+        gt_class_pos: FloatTensor,
+        neg_ancs: FloatTensor,
+        neg_b_idxs: IntTensor,
+        n_images: int
+    ) -> Tuple[FloatTensor, IntTensor, FloatTensor]:
+        """Sample proposals for the classifier.
+
+        Parameters
+        ----------
+        proposals : FloatTensor
+            Proposals of positive anchors with shape `[n_pos, 4]`.
+        pos_b_idxs : IntTensor
+            Batch indexes of the proposals with shape `[n_pos]`.
+        pos_gt_idxs : IntTensor
+            Indexes of the proposals' ground truth boxes in their images
+            with shape `[n_pos]`.
+        pos_scores : FloatTensor
+            IoU of the positive anchors with their ground truth boxes
+            with shape `[n_pos]`.
+        gt_class_pos : FloatTensor
+            Classes of the proposals with shape `[n_pos]`.
+        neg_ancs : FloatTensor
+            Negative anchors with shape `[n_neg, 4]`.
+        neg_b_idxs : IntTensor
+            Batch indexes of the negative anchors with shape `[n_neg]`.
+        n_images : int
+            A number of images in the batch.
+
+        Returns
+        -------
+        Tuple[FloatTensor, IntTensor, FloatTensor]
+            Sampled proposals, their batch indexes and classes.
+            They are grouped by image.
+        """
+        # Order by box and by descending IoU inside a box
+        order = torch.argsort(pos_scores, descending=True, stable=True)
+        n_gt = int(pos_gt_idxs.max()) + 1 if pos_gt_idxs.shape[0] else 1
+        box_keys = pos_b_idxs * n_gt + pos_gt_idxs
+        order = order[torch.argsort(box_keys[order], stable=True)]
+        unique = order[_group_ranks(box_keys[order]) < self.n_per_gt]
+
+        n_fg_per_img = torch.full(
+            (n_images,), self.n_fg_per_img, device=pos_b_idxs.device)
+        keep_pos = unique[self._sample_per_image(
+            pos_b_idxs[unique], n_fg_per_img)]
+        proposals = proposals[keep_pos]
+        b_idxs = pos_b_idxs[keep_pos]
+        classes = gt_class_pos[keep_pos]
+        if self.background_class is None:
+            return proposals, b_idxs, classes
+
+        n_bg_per_img = self.n_per_img - count_per_image(b_idxs, n_images)
+        keep_neg = self._sample_per_image(neg_b_idxs, n_bg_per_img)
+        proposals = torch.cat((proposals, neg_ancs[keep_neg]))
+        b_idxs = torch.cat((b_idxs, neg_b_idxs[keep_neg]))
+        classes = torch.cat((classes, classes.new_full(
+            (keep_neg.shape[0],), self.background_class)))
+        order = torch.argsort(b_idxs, stable=True)
+        return proposals[order], b_idxs[order], classes[order]
+
+
+def prepare_images_batch(
+    images: List[NDArray],
+    input_size: Tuple[int, int],
+    mean: FloatTensor,
+    std: FloatTensor
+) -> FloatTensor:
+    """Resize and normalize RGB images into a batch for the detector.
+
+    Parameters
+    ----------
+    images : List[NDArray]
+        RGB images. They can have different sizes.
+    input_size : Tuple[int, int]
+        A height and a width of the model's input.
+    mean : FloatTensor
+        Normalization mean of channels.
+    std : FloatTensor
+        Normalization standard deviation of channels.
+
+    Returns
+    -------
+    FloatTensor
+        The batch with shape `(b, 3, input_h, input_w)`.
+    """
+    height, width = input_size
+    batch = np.stack([
+        cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        for image in images])
+    batch = torch.from_numpy(batch).permute(0, 3, 1, 2).float() / 255
+    return (batch - mean[:, None, None]) / std[:, None, None]
+
+
+def bboxes_to_rois(bboxes: FloatTensor, b_idxs: IntTensor) -> FloatTensor:
+    """Pack bounding boxes of a batch and their batch indexes into RoIs.
+
+    Parameters
+    ----------
+    bboxes : FloatTensor
+        Bounding boxes in xyxy system with shape `(n_boxes, 4)`.
+    b_idxs : IntTensor
+        Batch indexes of the bounding boxes with shape `(n_boxes,)`.
+
+    Returns
+    -------
+    FloatTensor
+        RoIs with shape `(n_boxes, 5)` where the first column
+        contains batch indexes.
+    """
+    return torch.cat((b_idxs[:, None].to(dtype=bboxes.dtype), bboxes), dim=1)
+
+
+def count_per_image(b_idxs: IntTensor, n_images: int) -> IntTensor:
+    """Count elements that belong to every image of a batch.
+
+    Unlike `torch.bincount` it can be exported to ONNX.
+
+    Parameters
+    ----------
+    b_idxs : IntTensor
+        Batch indexes of elements with shape `(n_elements,)`.
+    n_images : int
+        A number of images in the batch.
+
+    Returns
+    -------
+    IntTensor
+        Counts of elements per image with shape `(n_images,)`.
+    """
+    counts = torch.zeros(n_images, dtype=torch.int64, device=b_idxs.device)
+    return counts.scatter_add(0, b_idxs, torch.ones_like(b_idxs))
+
+
+def ragged_to_padded(
+    values: Tensor, offsets: IntTensor, pad_value: float = -1.0
+) -> Tensor:
+    """Pad ragged per-image values to the batch's maximum count.
+
+    Parameters
+    ----------
+    values : Tensor
+        Flat values of all images with shape `(n_values, ...)`.
+    offsets : IntTensor
+        Offsets of images' values with shape `(b + 1,)` starting from 0.
+        Values of an image `i` are `values[offsets[i]:offsets[i + 1]]`.
+    pad_value : float, optional
+        A value for padding. By default is -1.0.
+
+    Returns
+    -------
+    Tensor
+        The padded values with shape `(b, n_max, ...)`.
+    """
+    counts = offsets[1:] - offsets[:-1]
+    n_max = int(counts.max()) if counts.shape[0] != 0 else 0
+    padded = values.new_full(
+        (counts.shape[0], n_max, *values.shape[1:]), pad_value)
+    b_idxs = torch.repeat_interleave(
+        torch.arange(counts.shape[0], device=values.device), counts)
+    positions = (torch.arange(values.shape[0], device=values.device) -
+                 offsets[b_idxs])
+    padded[b_idxs, positions] = values
+    return padded
+
+
+def batched_nms_per_image(
+    bboxes: FloatTensor,
+    scores: FloatTensor,
+    b_idxs: IntTensor,
+    iou_thresh: float,
+    top_k: Optional[int] = None,
+    n_images: Optional[int] = None
+) -> IntTensor:
+    """Do non maximum suppression independently for every image in a batch.
+
+    NMS is done with one call for the whole batch where batch indexes play
+    a role of categories. Kept indexes are grouped by image
+    and sorted by score within every image.
+
+    Parameters
+    ----------
+    bboxes : FloatTensor
+        Bounding boxes in xyxy system with shape `(n_boxes, 4)`.
+    scores : FloatTensor
+        Scores of the bounding boxes with shape `(n_boxes,)`.
+    b_idxs : IntTensor
+        Batch indexes of the bounding boxes with shape `(n_boxes,)`.
+    iou_thresh : float
+        IoU threshold for suppression.
+    top_k : Optional[int], optional
+        A maximum number of kept boxes per image. By default is `None`
+        that means no limit.
+    n_images : Optional[int], optional
+        A number of images in the batch. It is required for `top_k`
+        selecting. If not given then it is calculated from `b_idxs`.
+
+    Returns
+    -------
+    IntTensor
+        Indexes of the kept bounding boxes with shape `(n_kept,)`.
+    """
+    keep = torchvision.ops.batched_nms(bboxes, scores, b_idxs, iou_thresh)
+    # Kept indexes are sorted by score, so sorting by batch index
+    # and then by position groups them per image saving the order.
+    # Keys are unique, so a stable sort is not needed
+    positions = torch.arange(keep.shape[0], device=keep.device)
+    _, order = torch.sort(b_idxs[keep] * keep.shape[0] + positions)
+    keep = keep[order]
+
+    if top_k is not None:
+        if n_images is None:
+            n_images = int(b_idxs.max()) + 1 if b_idxs.numel() > 0 else 0
+        kept_b_idxs = b_idxs[keep]
+        n_kept = count_per_image(kept_b_idxs, n_images)
+        starts = torch.cumsum(n_kept, dim=0) - n_kept
+        # Rank of every box in its image
+        ranks = positions - starts[kept_b_idxs]
+        keep = keep[ranks < top_k]
+    return keep
@@ -0,0 +1,328 @@
+"""A module that contains a streaming R-CNN video pipeline.
+
+Frames are decoded on a reader thread and annotated frames are encoded
+on a writer thread while the main thread runs batched inference.
+The threads are connected with bounded queues, so a slow stage holds
+the other ones back instead of accumulating frames in memory.
+
+In the frame-skip mode the network runs only on keyframes.
+A frame becomes a keyframe when it differs enough from the previous
+keyframe, other frames reuse the previous keyframe's detections.
+"""
+
+
+from pathlib import Path
+from queue import Queue
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+import torch
+from torch import FloatTensor
+
+from rcnn.rcnn_model import RCNN_Detector
+from rcnn.rcnn_utils import draw_bounding_boxes_cv2, prepare_images_batch
+
+
+class FrameReader(threading.Thread):
+    """A thread that decodes video frames into a bounded queue.
+
+    RGB frames are put in the queue and `None` is put after the last one.
+    """
+
+    def __init__(self, video_path: Union[Path, str], queue_size: int) -> None:
+        """Initialize `FrameReader`.
+
+        Parameters
+        ----------
+        video_path : Union[Path, str]
+            A path to the video.
+        queue_size : int
+            A maximum number of decoded frames that wait for processing.
+
+        Raises
+        ------
+        FileNotFoundError
+            Did not find video.
+        """
+        super().__init__(daemon=True)
+        if not Path(video_path).exists():
+            raise FileNotFoundError(f'Did not find video {video_path}.')
+        self.capture = cv2.VideoCapture(str(video_path))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frame_size = (
+            int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        self.queue: Queue = Queue(queue_size)
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        try:
+            while not self.stopped.is_set():
+                success, frame = self.capture.read()
+                if not success:
+                    break
+                self.queue.put(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        finally:
+            self.capture.release()
+            self.queue.put(None)
+
+    def stop(self) -> None:
+        """Stop decoding and drop not processed frames."""
+        self.stopped.set()
+        while self.is_alive():
+            # Unblock the reader if the queue is full
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.join(timeout=0.1)
+
+
+class FrameWriter(threading.Thread):
+    """A thread that draws detections on frames and encodes them.
+
+    Frames with their bounding boxes and labels are got from a bounded
+    queue until `None` is got.
+    """
+
+    def __init__(
+        self,
+        save_path: Union[Path, str],
+        fps: float,
+        frame_size: Tuple[int, int],
+        queue_size: int,
+        index2name: Optional[Dict[int, str]] = None
+    ) -> None:
+        """Initialize `FrameWriter`.
+
+        Parameters
+        ----------
+        save_path : Union[Path, str]
+            A path to save the annotated video.
+        fps : float
+            Frames per second of the video.
+        frame_size : Tuple[int, int]
+            A height and a width of the frames.
+        queue_size : int
+            A maximum number of frames that wait for writing.
+        index2name : Optional[Dict[int, str]], optional
+            A converter dict from int labels to names.
+        """
+        super().__init__(daemon=True)
+        save_path = Path(save_path)
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        height, width = frame_size
+        self.writer = cv2.VideoWriter(
+            str(save_path), cv2.VideoWriter_fourcc(*'mp4v'), fps,
+            (width, height))
+        self.index2name = index2name
+        self.queue: Queue = Queue(queue_size)
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                frame, bboxes, labels = item
+                # Labels are drawn only as names
+                if self.index2name is None:
+                    labels = None
+                frame = draw_bounding_boxes_cv2(
+                    frame, bboxes, labels, self.index2name)
+                self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        except BaseException as error:
+            self.error = error
+            # Keep consuming, so the producer is not blocked forever
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.writer.release()
+
+
+class FrameChangeDetector:
+    """A cheap detector of changes between a frame and a keyframe.
+
+    Frames are compared as small grayscale thumbnails by a mean absolute
+    difference of pixels' intensities.
+    """
+
+    def __init__(
+        self,
+        change_thresh: float,
+        max_skip: int,
+        thumbnail_size: Tuple[int, int] = (36, 64)
+    ) -> None:
+        """Initialize `FrameChangeDetector`.
+
+        Parameters
+        ----------
+        change_thresh : float
+            A mean absolute difference of intensities from 0 to 255
+            that makes a frame a keyframe.
+        max_skip : int
+            A maximum number of frames in a row that reuse a keyframe's
+            detections.
+        thumbnail_size : Tuple[int, int], optional
+            A height and a width of compared thumbnails.
+            By default is (36, 64).
+        """
+        self.change_thresh = change_thresh
+        self.max_skip = max_skip
+        self.thumbnail_size = thumbnail_size
+        self.keyframe_thumbnail: Optional[NDArray] = None
+        self.n_skipped = 0
+
+    def is_keyframe(self, frame: NDArray) -> bool:
+        """Check whether a frame needs a new inference.
+
+        Parameters
+        ----------
+        frame : NDArray
+            An RGB frame.
+
+        Returns
+        -------
+        bool
+            Whether the frame is a keyframe.
+        """
+        height, width = self.thumbnail_size
+        thumbnail = cv2.resize(
+            cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), (width, height),
+            interpolation=cv2.INTER_AREA).astype(np.float32)
+        if (self.keyframe_thumbnail is None or
+                self.n_skipped >= self.max_skip or
+                np.abs(thumbnail - self.keyframe_thumbnail).mean() >=
+                self.change_thresh):
+            self.keyframe_thumbnail = thumbnail
+            self.n_skipped = 0
+            return True
+        self.n_skipped += 1
+        return False
+
+
+def process_video(
+    detector: RCNN_Detector,
+    video_path: Union[Path, str],
+    save_path: Union[Path, str],
+    input_size: Tuple[int, int],
+    mean: FloatTensor,
+    std: FloatTensor,
+    conf_thresh: float = 0.5,
+    nms_thresh: float = 0.7,
+    b_size: int = 8,
+    queue_size: int = 32,
+    change_thresh: Optional[float] = None,
+    max_skip: int = 30,
+    index2name: Optional[Dict[int, str]] = None
+) -> Dict[str, int]:
+    """Detect objects on a video and save it with drawn detections.
+
+    Parameters
+    ----------
+    detector : RCNN_Detector
+        A detector in the evaluation mode.
+    video_path : Union[Path, str]
+        A path to the input video.
+    save_path : Union[Path, str]
+        A path to save the annotated video.
+    input_size : Tuple[int, int]
+        A height and a width of the detector's input.
+    mean : FloatTensor
+        Normalization mean of channels.
+    std : FloatTensor
+        Normalization standard deviation of channels.
+    conf_thresh : float, optional
+        Object confidence threshold. By default is 0.5.
+    nms_thresh : float, optional
+        IoU NMS threshold. By default is 0.7.
+    b_size : int, optional
+        A number of frames that pass through the detector at once.
+        By default is 8.
+    queue_size : int, optional
+        A capacity of the reader's and the writer's queues.
+        By default is 32.
+    change_thresh : Optional[float], optional
+        A mean absolute difference of thumbnails' intensities (0-255)
+        that makes a frame a keyframe. If given then the network runs
+        only on keyframes and other frames reuse detections
+        of the previous keyframe. By default is `None` that means
+        every frame is processed.
+    max_skip : int, optional
+        A maximum number of frames in a row that reuse detections.
+        By default is 30.
+    index2name : Optional[Dict[int, str]], optional
+        A converter dict from int labels to names.
+
+    Returns
+    -------
+    Dict[str, int]
+        Numbers of all frames and of frames that passed
+        through the network.
+    """
+    device = next(detector.parameters()).device
+    reader = FrameReader(video_path, queue_size)
+    writer = FrameWriter(
+        save_path, reader.fps, reader.frame_size, queue_size, index2name)
+    change_detector = (
+        FrameChangeDetector(change_thresh, max_skip)
+        if change_thresh is not None else None)
+    frame_h, frame_w = reader.frame_size
+    height_scale = frame_h / input_size[0]
+    width_scale = frame_w / input_size[1]
+    scale = torch.tensor([width_scale, height_scale] * 2)
+
+    reader.start()
+    writer.start()
+    # Frames wait here in order until their batch of keyframes is done
+    pending: List[Tuple[NDArray, bool]] = []
+    keyframes: List[NDArray] = []
+    detections = (torch.zeros((0, 4)), torch.zeros((0,), dtype=torch.long))
+    n_frames = 0
+    n_keyframes = 0
+
+    def flush():
+        nonlocal detections
+        if keyframes:
+            batch = prepare_images_batch(
+                keyframes, input_size, mean, std).to(device=device)
+            bboxes, cls_confs = detector.inference(
+                batch, conf_thresh, nms_thresh)
+            batch_detections = iter([
+                (img_bboxes.cpu() * scale,
+                 img_confs.argmax(dim=1).cpu())
+                for img_bboxes, img_confs in zip(bboxes, cls_confs)])
+        for frame, is_keyframe in pending:
+            if is_keyframe:
+                detections = next(batch_detections)
+            if writer.error is not None:
+                raise writer.error
+            writer.queue.put((frame, *detections))
+        pending.clear()
+        keyframes.clear()
+
+    try:
+        while True:
+            frame = reader.queue.get()
+            if frame is None:
+                break
+            n_frames += 1
+            is_keyframe = (change_detector is None or
+                           change_detector.is_keyframe(frame))
+            pending.append((frame, is_keyframe))
+            if is_keyframe:
+                keyframes.append(frame)
+                n_keyframes += 1
+            # Skipped frames also hold memory while they wait
+            if len(keyframes) == b_size or len(pending) >= queue_size:
+                flush()
+        flush()
+    finally:
+        reader.stop()
+        writer.queue.put(None)
+        writer.join()
+    if writer.error is not None:
+        raise writer.error
+    return {'n_frames': n_frames, 'n_keyframes': n_keyframes}
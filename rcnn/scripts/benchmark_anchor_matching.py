@@ -0,0 +1,115 @@
+"""Script to compare dense and spatially indexed anchor matching.
+
+Random ground truth boxes are matched with anchors of feature maps
+of different sizes. Both matchers must give identical results,
+the script checks it and reports their latencies.
+"""
+
+from pathlib import Path
+import sys
+import time
+from typing import Callable, Tuple
+
+import torch
+from torch import FloatTensor
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_utils import (
+    generate_anchors, generate_anchor_boxes, match_anchors,
+    match_anchors_spatial)
+
+
+def get_random_gt_boxes(
+    b_size: int, n_objects: int, n_max_obj: int, map_size: Tuple[int, int]
+) -> FloatTensor:
+    """Get random word-like ground truth boxes padded with `-1`.
+
+    Parameters
+    ----------
+    b_size : int
+        A number of images.
+    n_objects : int
+        A number of objects per image.
+    n_max_obj : int
+        A padded number of objects per image.
+    map_size : Tuple[int, int]
+        A height and a width of the feature map.
+
+    Returns
+    -------
+    FloatTensor
+        The boxes with shape `(b_size, n_max_obj, 4)`.
+    """
+    map_h, map_w = map_size
+    scale = torch.tensor([map_w, map_h])
+    centers = torch.rand(b_size, n_objects, 2) * scale
+    sizes = torch.rand(b_size, n_objects, 2) * torch.tensor([4.0, 1.5]) + 0.5
+    boxes = torch.cat([centers - sizes / 2, centers + sizes / 2], dim=2)
+    boxes = torch.minimum(boxes.clamp(min=0), scale.repeat(2))
+    padding = torch.full((b_size, n_max_obj - n_objects, 4), -1.0)
+    return torch.cat([boxes, padding], dim=1)
+
+
+def measure_latency(match_fn: Callable[[], object], n_iters: int) -> float:
+    """Measure a mean latency of a matching function.
+
+    Parameters
+    ----------
+    match_fn : Callable[[], object]
+        The measured function.
+    n_iters : int
+        A number of measured calls.
+
+    Returns
+    -------
+    float
+        The mean latency in seconds.
+    """
+    match_fn()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        match_fn()
+    return (time.perf_counter() - start) / n_iters
+
+
+def main():
+    torch.manual_seed(0)
+    for map_size in MAP_SIZES:
+        x_anc_pts, y_anc_pts = generate_anchors(map_size)
+        anc_grid = generate_anchor_boxes(
+            x_anc_pts, y_anc_pts, ANC_SCALES, ANC_RATIOS,
+            map_size).reshape(-1, 4)
+        for n_objects in N_OBJECTS:
+            gt_boxes = get_random_gt_boxes(
+                B_SIZE, n_objects, N_MAX_OBJ, map_size)
+            dense = match_anchors(anc_grid, gt_boxes, POS_THRESH)
+            spatial = match_anchors_spatial(anc_grid, gt_boxes, POS_THRESH)
+            identical = all(
+                torch.equal(dense_out, spatial_out)
+                for dense_out, spatial_out in zip(dense, spatial))
+
+            dense_latency = measure_latency(
+                lambda: match_anchors(anc_grid, gt_boxes, POS_THRESH),
+                N_ITERS)
+            spatial_latency = measure_latency(
+                lambda: match_anchors_spatial(
+                    anc_grid, gt_boxes, POS_THRESH),
+                N_ITERS)
+            print(f'map: {map_size[0]}x{map_size[1]} '
+                  f'objects: {n_objects} '
+                  f'dense: {dense_latency * 1000:.1f} ms '
+                  f'spatial: {spatial_latency * 1000:.1f} ms '
+                  f'speed-up: {dense_latency / spatial_latency:.2f}x '
+                  f'identical: {identical}')
+
+
+if __name__ == '__main__':
+    MAP_SIZES = ((14, 14), (28, 28), (56, 56), (112, 112))
+    N_OBJECTS = (10, 100, 500)
+    N_MAX_OBJ = 600
+    B_SIZE = 8
+    ANC_SCALES = (2.0, 4.0, 6.0)
+    ANC_RATIOS = (0.5, 1.0, 1.5)
+    POS_THRESH = 0.7
+    N_ITERS = 5
+    main()
@@ -0,0 +1,123 @@
+"""Script to compare inference speed of R-CNN execution modes.
+
+Every mode is compared against the eager float32 baseline on random images.
+"""
+
+from pathlib import Path
+import copy
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+import torch
+from torch import FloatTensor
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import RCNN_Detector, compile_detector
+
+
+def measure_latency(
+    inference_fn: Callable[[FloatTensor], object],
+    images: FloatTensor,
+    n_warmup: int,
+    n_iters: int
+) -> float:
+    """Measure a mean latency of an inference function.
+
+    Parameters
+    ----------
+    inference_fn : Callable[[FloatTensor], object]
+        The measured function that takes a batch of images.
+    images : FloatTensor
+        The batch of images.
+    n_warmup : int
+        A number of not measured warmup calls.
+    n_iters : int
+        A number of measured calls.
+
+    Returns
+    -------
+    float
+        The mean latency in seconds.
+    """
+    for _ in range(n_warmup):
+        inference_fn(images)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        inference_fn(images)
+    return (time.perf_counter() - start) / n_iters
+
+
+def get_modes(
+    model: RCNN_Detector, model_kwargs: Dict[str, Any]
+) -> Dict[str, Callable]:
+    """Get inference functions of the compared execution modes.
+
+    Parameters
+    ----------
+    model : RCNN_Detector
+        The benchmarked model.
+    model_kwargs : Dict[str, Any]
+        Arguments that the model was created with. They are used to create
+        its copies in other modes.
+
+    Returns
+    -------
+    Dict[str, Callable]
+        The modes' names and corresponding inference functions.
+    """
+    device = next(model.parameters()).device
+    channels_last_model = RCNN_Detector(**model_kwargs, channels_last=True)
+    channels_last_model.load_state_dict(model.state_dict())
+    channels_last_model.to(device=device)
+    channels_last_model.eval()
+    compiled_model = compile_detector(copy.deepcopy(model))
+
+    return {
+        'fp32': lambda images: model.inference(
+            images, CONF_THRESH, NMS_THRESH, amp=False),
+        'amp': lambda images: model.inference(
+            images, CONF_THRESH, NMS_THRESH, amp=True),
+        'channels_last': lambda images: channels_last_model.inference(
+            images, CONF_THRESH, NMS_THRESH),
+        'compile': lambda images: compiled_model.inference(
+            images, CONF_THRESH, NMS_THRESH),
+    }
+
+
+def main():
+    device = torch.device(DEVICE)
+    model_kwargs = dict(input_size=INPUT_SIZE,
+                        n_cls=N_CLS,
+                        roi_size=ROI_SIZE,
+                        backbone_model=BACKBONE_MODEL,
+                        pretrained=False)
+    model = RCNN_Detector(**model_kwargs)
+    model.to(device=device)
+    model.eval()
+
+    modes = get_modes(model, model_kwargs)
+    for b_size in B_SIZES:
+        images = torch.rand(b_size, 3, *INPUT_SIZE, device=device)
+        latencies: List[float] = []
+        for name, inference_fn in modes.items():
+            latency = measure_latency(
+                inference_fn, images, N_WARMUP, N_ITERS)
+            latencies.append(latency)
+            print(f'b_size: {b_size} mode: {name} '
+                  f'latency: {latency * 1000:.1f} ms '
+                  f'speed-up: {latencies[0] / latency:.2f}x')
+
+
+if __name__ == '__main__':
+    DEVICE = 'cpu'
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.1
+    B_SIZES = (1, 8, 32)
+    N_WARMUP = 2
+    N_ITERS = 5
+    main()
@@ -0,0 +1,131 @@
+"""Script to check ONNX export of R-CNN.
+
+A randomly initialized detector is exported to ONNX, then outputs
+of onnxruntime are compared with eager PyTorch ones
+and throughput of both backends is measured.
+"""
+
+from pathlib import Path
+import sys
+import time
+from typing import Callable, Tuple
+
+import torch
+from torch import FloatTensor
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import RCNN_Detector
+from rcnn.rcnn_export import RCNN_InferenceModule, export_onnx
+from rcnn.rcnn_runtime import OnnxDetector
+
+
+def check_parity(
+    eager_outputs: Tuple[FloatTensor, ...],
+    onnx_outputs: Tuple[FloatTensor, ...],
+    atol: float
+) -> bool:
+    """Check that eager and ONNX packed predictions match.
+
+    Parameters
+    ----------
+    eager_outputs : Tuple[FloatTensor, ...]
+        Bounding boxes, scores, labels and counts from eager PyTorch.
+    onnx_outputs : Tuple[FloatTensor, ...]
+        Bounding boxes, scores, labels and counts from onnxruntime.
+    atol : float
+        An absolute tolerance for boxes and scores.
+
+    Returns
+    -------
+    bool
+        Whether predictions match.
+    """
+    eager_bboxes, eager_scores, eager_labels, eager_counts = eager_outputs
+    onnx_bboxes, onnx_scores, onnx_labels, onnx_counts = onnx_outputs
+    if not torch.equal(eager_counts, onnx_counts):
+        print(f'Counts mismatch: {eager_counts.tolist()} '
+              f'vs {onnx_counts.tolist()}')
+        return False
+    bboxes_diff = (eager_bboxes - onnx_bboxes).abs().max().item()
+    scores_diff = (eager_scores - onnx_scores).abs().max().item()
+    n_labels_diff = (eager_labels != onnx_labels).sum().item()
+    print(f'Max bboxes diff: {bboxes_diff:.6f} '
+          f'max scores diff: {scores_diff:.6f} '
+          f'labels mismatches: {n_labels_diff}')
+    return bboxes_diff <= atol and scores_diff <= atol and n_labels_diff == 0
+
+
+def measure_throughput(
+    inference_fn: Callable[[FloatTensor], object],
+    images: FloatTensor,
+    n_iters: int
+) -> float:
+    """Measure throughput of an inference function in images per second.
+
+    Parameters
+    ----------
+    inference_fn : Callable[[FloatTensor], object]
+        The measured function that takes a batch of images.
+    images : FloatTensor
+        The batch of images.
+    n_iters : int
+        A number of measured calls.
+
+    Returns
+    -------
+    float
+        The throughput in images per second.
+    """
+    inference_fn(images)  # warmup
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        inference_fn(images)
+    return n_iters * images.shape[0] / (time.perf_counter() - start)
+
+
+def main():
+    torch.manual_seed(SEED)
+    model = RCNN_Detector(input_size=INPUT_SIZE,
+                          n_cls=N_CLS,
+                          roi_size=ROI_SIZE,
+                          backbone_model=BACKBONE_MODEL,
+                          pretrained=False)
+    model.eval()
+    eager_model = RCNN_InferenceModule(
+        model, CONF_THRESH, NMS_THRESH, PRE_NMS_TOP_K, POST_NMS_TOP_K)
+
+    export_onnx(model, SAVE_PTH, INPUT_SIZE, CONF_THRESH, NMS_THRESH,
+                PRE_NMS_TOP_K, POST_NMS_TOP_K)
+    onnx_model = OnnxDetector(SAVE_PTH)
+
+    images = torch.rand(B_SIZE, 3, *INPUT_SIZE)
+    with torch.no_grad():
+        eager_outputs = eager_model(images)
+    onnx_outputs = onnx_model(images)
+    parity = check_parity(eager_outputs, onnx_outputs, ATOL)
+    print(f'Parity: {"passed" if parity else "failed"}')
+
+    with torch.no_grad():
+        eager_throughput = measure_throughput(eager_model, images, N_ITERS)
+    onnx_throughput = measure_throughput(onnx_model, images, N_ITERS)
+    print(f'Eager PyTorch: {eager_throughput:.2f} img/s '
+          f'onnxruntime: {onnx_throughput:.2f} img/s '
+          f'speed-up: {onnx_throughput / eager_throughput:.2f}x')
+
+
+if __name__ == '__main__':
+    WORK_DIR = Path(__file__).parents[2] / 'work_dir'
+    SAVE_PTH = WORK_DIR / 'exported' / 'rcnn.onnx'
+    SEED = 42
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    CONF_THRESH = 0.5
+    NMS_THRESH = 0.7
+    PRE_NMS_TOP_K = 2000
+    POST_NMS_TOP_K = 300
+    B_SIZE = 4
+    N_ITERS = 5
+    ATOL = 1e-3
+    main()
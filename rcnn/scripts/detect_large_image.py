@@ -0,0 +1,63 @@
+"""Script to detect text on a large image with tiled R-CNN inference.
+
+The image is not resized. It is cut into overlapping tiles
+of the model's input size and predictions are merged.
+"""
+
+from pathlib import Path
+import sys
+
+import torch
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import load_detector
+from rcnn.rcnn_tiling import tiled_inference
+from rcnn.rcnn_utils import draw_bounding_boxes_cv2
+from utils.image_utils.image_functions import read_image, save_image
+
+
+def main():
+    device = torch.device(DEVICE)
+    model = load_detector(MODEL_PTH,
+                          device=device,
+                          input_size=INPUT_SIZE,
+                          n_cls=N_CLS,
+                          roi_size=ROI_SIZE,
+                          backbone_model=BACKBONE_MODEL)
+    model.eval()
+
+    image = read_image(IMAGE_PTH)
+    mean = torch.tensor([0.46201408, 0.44023338, 0.40830722])
+    std = torch.tensor([0.2513935, 0.24573067, 0.24901628])
+    image_tensor = torch.from_numpy(image).permute(2, 0, 1) / 255
+    image_tensor = (image_tensor - mean[:, None, None]) / std[:, None, None]
+
+    bboxes, cls_confs = tiled_inference(
+        model, [image_tensor], INPUT_SIZE, overlap=OVERLAP,
+        tiles_per_batch=TILES_PER_BATCH, conf_thresh=CONF_THRESH,
+        nms_thresh=NMS_THRESH, merge_thresh=MERGE_THRESH)
+    labels = torch.argmax(cls_confs[0], dim=1)
+    print(f'Found {bboxes[0].shape[0]} objects.')
+
+    image = draw_bounding_boxes_cv2(
+        image, bboxes[0].cpu(), labels.cpu(), INDEX2NAME)
+    save_image(image, SAVE_PTH)
+
+
+if __name__ == '__main__':
+    WORK_DIR = Path(__file__).parents[2] / 'work_dir' / 'train_1'
+    MODEL_PTH = WORK_DIR / 'best_model.pt'
+    IMAGE_PTH = Path(__file__).parents[2] / 'data' / 'large_image.jpg'
+    SAVE_PTH = WORK_DIR / 'large_image_predictions.jpg'
+    DEVICE = 'cuda'
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    INDEX2NAME = {0: 'legible', 1: 'illegible'}
+    OVERLAP = (96, 96)
+    TILES_PER_BATCH = 8
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.1
+    MERGE_THRESH = 0.3
+    main()
@@ -0,0 +1,59 @@
+"""Script to detect text on a video with the streaming R-CNN pipeline.
+
+With `CHANGE_THRESH` the network runs only on frames that differ
+from the previous keyframe and static frames reuse its detections.
+"""
+
+from pathlib import Path
+import sys
+import time
+
+import torch
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import load_detector
+from rcnn.rcnn_video import process_video
+
+
+def main():
+    device = torch.device(DEVICE)
+    model = load_detector(MODEL_PTH,
+                          device=device,
+                          input_size=INPUT_SIZE,
+                          n_cls=N_CLS,
+                          roi_size=ROI_SIZE,
+                          backbone_model=BACKBONE_MODEL)
+    model.eval()
+
+    mean = torch.tensor([0.46201408, 0.44023338, 0.40830722])
+    std = torch.tensor([0.2513935, 0.24573067, 0.24901628])
+    start = time.perf_counter()
+    stats = process_video(
+        model, VIDEO_PTH, SAVE_PTH, INPUT_SIZE, mean, std,
+        conf_thresh=CONF_THRESH, nms_thresh=NMS_THRESH, b_size=B_SIZE,
+        queue_size=QUEUE_SIZE, change_thresh=CHANGE_THRESH,
+        max_skip=MAX_SKIP, index2name=INDEX2NAME)
+    duration = time.perf_counter() - start
+    print(f'Frames: {stats["n_frames"]} '
+          f'keyframes: {stats["n_keyframes"]} '
+          f'fps: {stats["n_frames"] / duration:.1f}')
+
+
+if __name__ == '__main__':
+    WORK_DIR = Path(__file__).parents[2] / 'work_dir' / 'train_1'
+    MODEL_PTH = WORK_DIR / 'best_model.pt'
+    VIDEO_PTH = Path(__file__).parents[2] / 'data' / 'video.mp4'
+    SAVE_PTH = WORK_DIR / 'video_predictions.mp4'
+    DEVICE = 'cuda'
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    INDEX2NAME = {0: 'legible', 1: 'illegible'}
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.1
+    B_SIZE = 8
+    QUEUE_SIZE = 32
+    CHANGE_THRESH = 3.0  # None to run the network on every frame
+    MAX_SKIP = 30
+    main()
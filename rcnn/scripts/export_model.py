@@ -0,0 +1,37 @@
+"""Script to export a trained R-CNN to a self-contained TorchScript module."""
+
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import load_detector
+from rcnn.rcnn_export import export_torchscript
+
+
+def main():
+    model = load_detector(MODEL_PTH,
+                          input_size=INPUT_SIZE,
+                          n_cls=N_CLS,
+                          roi_size=ROI_SIZE,
+                          backbone_model=BACKBONE_MODEL)
+
+    export_torchscript(
+        model, SAVE_PTH, INPUT_SIZE, conf_thresh=CONF_THRESH,
+        nms_thresh=NMS_THRESH, pre_nms_top_k=PRE_NMS_TOP_K,
+        post_nms_top_k=POST_NMS_TOP_K)
+    print(f'Exported model is saved to {SAVE_PTH}.')
+
+
+if __name__ == '__main__':
+    WORK_DIR = Path(__file__).parents[2] / 'work_dir' / 'train_1'
+    MODEL_PTH = WORK_DIR / 'best_model.pt'
+    SAVE_PTH = WORK_DIR / 'exported' / 'rcnn_scripted.pt'
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.1
+    PRE_NMS_TOP_K = 2000
+    POST_NMS_TOP_K = 300
+    main()
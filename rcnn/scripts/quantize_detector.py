@@ -0,0 +1,124 @@
+"""Script to quantize a trained R-CNN and report accuracy and latency deltas.
+
+Calibration is done on images from the train set of the coco text dataset.
+IoU metric and latency of the float and the quantized models
+are compared on the validation set.
+"""
+
+from pathlib import Path
+import sys
+import time
+from itertools import islice
+from typing import Tuple
+
+import torch
+from torch.utils.data import DataLoader
+import albumentations as A
+from albumentations.pytorch import ToTensorV2
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).parents[2]))
+from dataset.object_detection_dataset import TextDetectionCocoDataset
+from rcnn.rcnn_model import RCNN_Detector, load_detector
+from rcnn.rcnn_quantization import quantize_detector
+from utils.torch_utils.torch_metrics import calculate_iou
+
+
+def evaluate(
+    model: RCNN_Detector, loader: DataLoader, desc: str
+) -> Tuple[float, float]:
+    """Calculate a mean IoU metric and a mean batch latency of a model.
+
+    Parameters
+    ----------
+    model : RCNN_Detector
+        The evaluated model.
+    loader : DataLoader
+        The validation loader.
+    desc : str
+        A description for a progress bar.
+
+    Returns
+    -------
+    Tuple[float, float]
+        The mean IoU and the mean batch latency in seconds.
+    """
+    iou_values = []
+    latencies = []
+    for images, gt_boxes, _ in islice(tqdm(loader, desc=desc), N_EVAL_BATCHES):
+        start = time.perf_counter()
+        bboxes, _ = model.inference(images, CONF_THRESH, NMS_THRESH)
+        latencies.append(time.perf_counter() - start)
+        iou_values.append(calculate_iou(gt_boxes, bboxes).item())
+    return (sum(iou_values) / len(iou_values),
+            sum(latencies) / len(latencies))
+
+
+def main():
+    anns_pth = DSET_DIR / 'parsed_cocotext.json'
+    img_dir = DSET_DIR / 'images'
+    name2index = {'pad': -1, 'legible': 0, 'illegible': 1}
+    n_cls = len(name2index) - 1
+
+    mean = torch.tensor([0.46201408, 0.44023338, 0.40830722])
+    std = torch.tensor([0.2513935, 0.24573067, 0.24901628])
+    transform = A.Compose(
+        [
+            A.Resize(*INPUT_SIZE),
+            A.Normalize(mean=mean, std=std),
+            ToTensorV2()
+        ],
+        bbox_params=A.BboxParams(
+            format='pascal_voc', label_fields=['classes'])
+    )
+    train_dset = TextDetectionCocoDataset(
+        annotation_path=anns_pth, img_dir=img_dir, dset_type='train',
+        name2index=name2index, transforms=transform)
+    val_dset = TextDetectionCocoDataset(
+        annotation_path=anns_pth, img_dir=img_dir, dset_type='val',
+        name2index=name2index, transforms=transform)
+    calib_loader = DataLoader(train_dset, batch_size=B_SIZE, shuffle=True)
+    val_loader = DataLoader(val_dset, batch_size=B_SIZE)
+
+    model = load_detector(MODEL_PTH,
+                          input_size=INPUT_SIZE,
+                          n_cls=n_cls,
+                          roi_size=ROI_SIZE,
+                          backbone_model=BACKBONE_MODEL)
+    model.eval()
+
+    n_calib_batches = N_CALIB_IMAGES // B_SIZE
+    calib_images = (
+        images for images, _, _ in tqdm(
+            islice(calib_loader, n_calib_batches), total=n_calib_batches,
+            desc='Calibration'))
+    quantized = quantize_detector(
+        model, calib_images, conf_thresh=CONF_THRESH, nms_thresh=NMS_THRESH)
+    torch.save(quantized.state_dict(), SAVE_PTH)
+
+    float_iou, float_latency = evaluate(model, val_loader, 'Float model')
+    quant_iou, quant_latency = evaluate(
+        quantized, val_loader, 'Quantized model')
+    print(f'Float: IoU_metric: {float_iou:.4f} '
+          f'latency: {float_latency * 1000:.1f} ms')
+    print(f'Quantized: IoU_metric: {quant_iou:.4f} '
+          f'latency: {quant_latency * 1000:.1f} ms')
+    print(f'Deltas: IoU_metric: {quant_iou - float_iou:+.4f} '
+          f'latency: {(quant_latency - float_latency) * 1000:+.1f} ms '
+          f'speed-up: {float_latency / quant_latency:.2f}x')
+
+
+if __name__ == '__main__':
+    DSET_DIR = Path(__file__).parents[2] / 'data'
+    WORK_DIR = Path(__file__).parents[2] / 'work_dir' / 'train_1'
+    MODEL_PTH = WORK_DIR / 'best_model.pt'
+    SAVE_PTH = WORK_DIR / 'quantized_model.pt'
+    INPUT_SIZE = (448, 448)
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.1
+    B_SIZE = 8
+    N_CALIB_IMAGES = 300
+    N_EVAL_BATCHES = 50
+    main()
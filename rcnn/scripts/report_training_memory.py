@@ -0,0 +1,236 @@
+"""Script to report R-CNN training memory and throughput per batch size.
+
+Training steps run on random images with and without checkpointing
+of the backbone's stages. On GPU a peak of allocated memory is measured.
+On CPU, where the allocator has no peak statistics, only bytes of tensors
+saved for backward are counted. They are the activations that
+checkpointing trades for recomputation.
+
+A linear fit of memory over batch sizes gives an estimate of the biggest
+batch size that fits into a memory budget.
+"""
+
+from pathlib import Path
+import sys
+import time
+from typing import Dict, List, Set, Tuple
+
+import torch
+from torch import FloatTensor, Tensor
+import torch.optim as optim
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import RCNN_Detector
+
+
+def get_random_targets(
+    b_size: int, n_objects: int, input_size: Tuple[int, int],
+    n_cls: int, device: torch.device
+) -> Tuple[FloatTensor, FloatTensor]:
+    """Get random ground truth boxes and classes.
+
+    Parameters
+    ----------
+    b_size : int
+        A number of images.
+    n_objects : int
+        A number of objects per image.
+    input_size : Tuple[int, int]
+        A height and a width of images.
+    n_cls : int
+        A number of classes.
+    device : torch.device
+        A device for the targets.
+
+    Returns
+    -------
+    Tuple[FloatTensor, FloatTensor]
+        Boxes with shape `(b_size, n_objects, 4)` and classes
+        with shape `(b_size, n_objects)`.
+    """
+    img_h, img_w = input_size
+    scale = torch.tensor([img_w, img_h], device=device)
+    centers = torch.rand(b_size, n_objects, 2, device=device) * scale
+    sizes = (torch.rand(b_size, n_objects, 2, device=device) * 0.2 + 0.05
+             ) * scale
+    boxes = torch.cat([centers - sizes / 2, centers + sizes / 2], dim=2)
+    boxes = torch.minimum(boxes.clamp(min=0), scale.repeat(2) - 1)
+    classes = torch.randint(n_cls, (b_size, n_objects), device=device)
+    return boxes, classes
+
+
+class SavedTensorsCounter:
+    """Count bytes of unique tensors saved for backward.
+
+    Parameters are not counted.
+    """
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        """Initialize `SavedTensorsCounter`.
+
+        Parameters
+        ----------
+        model : torch.nn.Module
+            The model whose parameters are skipped.
+        """
+        self.param_ptrs = {
+            param.untyped_storage().data_ptr()
+            for param in model.parameters()}
+        self.ptrs: Set[int] = set()
+        self.n_bytes = 0
+
+    def pack(self, tensor: Tensor) -> Tensor:
+        storage = tensor.untyped_storage()
+        ptr = storage.data_ptr()
+        if ptr not in self.param_ptrs and ptr not in self.ptrs:
+            self.ptrs.add(ptr)
+            self.n_bytes += storage.nbytes()
+        return tensor
+
+    def hooks(self) -> torch.autograd.graph.saved_tensors_hooks:
+        return torch.autograd.graph.saved_tensors_hooks(
+            self.pack, lambda tensor: tensor)
+
+
+def measure_step(
+    model: RCNN_Detector,
+    optimizer: optim.Optimizer,
+    b_size: int,
+    device: torch.device
+) -> Tuple[float, float]:
+    """Measure memory and duration of training steps.
+
+    Parameters
+    ----------
+    model : RCNN_Detector
+        The trained model.
+    optimizer : optim.Optimizer
+        The model's optimizer.
+    b_size : int
+        A batch size.
+    device : torch.device
+        A device of the model.
+
+    Returns
+    -------
+    Tuple[float, float]
+        Memory in bytes (the peak of allocated memory on GPU and bytes
+        of saved activations on CPU) and a mean step duration in seconds.
+    """
+    images = torch.rand(b_size, 3, *INPUT_SIZE, device=device)
+    gt_boxes, gt_cls = get_random_targets(
+        b_size, N_OBJECTS, INPUT_SIZE, N_CLS, device)
+
+    def step():
+        optimizer.zero_grad()
+        _, _, loss = model(images, gt_boxes, gt_cls)
+        loss.backward()
+        optimizer.step()
+
+    # Optimizer states are created on the first step
+    for _ in range(N_WARMUP):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    counter = SavedTensorsCounter(model)
+    with counter.hooks():
+        step()
+    if device.type == 'cuda':
+        memory = torch.cuda.max_memory_allocated(device)
+    else:
+        memory = counter.n_bytes
+
+    start = time.perf_counter()
+    for _ in range(N_ITERS):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return memory, (time.perf_counter() - start) / N_ITERS
+
+
+def get_max_b_size(
+    b_sizes: List[int], memories: List[float], budget: float
+) -> int:
+    """Estimate the biggest batch size that fits into a memory budget.
+
+    Parameters
+    ----------
+    b_sizes : List[int]
+        Measured batch sizes.
+    memories : List[float]
+        Measured memory of the batch sizes.
+    budget : float
+        The memory budget.
+
+    Returns
+    -------
+    int
+        The estimated batch size.
+    """
+    b_sizes_t = torch.tensor(b_sizes, dtype=torch.float64)
+    memories_t = torch.tensor(memories, dtype=torch.float64)
+    b_mean = b_sizes_t.mean()
+    mem_mean = memories_t.mean()
+    per_image = (((b_sizes_t - b_mean) * (memories_t - mem_mean)).sum() /
+                 ((b_sizes_t - b_mean) ** 2).sum())
+    fixed = mem_mean - per_image * b_mean
+    return int((budget - fixed) / per_image)
+
+
+def main():
+    device = torch.device(DEVICE)
+    budget = MEMORY_BUDGET_GB * 1024 ** 3 if MEMORY_BUDGET_GB else None
+    if budget is None and device.type == 'cuda':
+        budget = torch.cuda.get_device_properties(device).total_memory
+
+    results: Dict[bool, List[float]] = {}
+    for checkpointing in (False, True):
+        torch.manual_seed(0)
+        model = RCNN_Detector(input_size=INPUT_SIZE,
+                              n_cls=N_CLS,
+                              roi_size=ROI_SIZE,
+                              backbone_model=BACKBONE_MODEL,
+                              pretrained=False,
+                              checkpointing=checkpointing)
+        model.to(device=device)
+        model.train()
+        optimizer = optim.Adam(model.parameters(), lr=1e-4)
+
+        results[checkpointing] = []
+        for b_size in B_SIZES:
+            memory, duration = measure_step(model, optimizer, b_size, device)
+            results[checkpointing].append(memory)
+            print(f'checkpointing: {checkpointing} b_size: {b_size} '
+                  f'memory: {memory / 1024 ** 2:.0f} MiB '
+                  f'step: {duration * 1000:.0f} ms '
+                  f'throughput: {b_size / duration:.1f} img/s')
+        del model, optimizer
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    memory_type = 'peak memory' if device.type == 'cuda' else 'activations'
+    for checkpointing, memories in results.items():
+        if budget is not None and len(B_SIZES) > 1:
+            max_b_size = get_max_b_size(list(B_SIZES), memories, budget)
+            print(f'checkpointing: {checkpointing} estimated max b_size '
+                  f'for {budget / 1024 ** 3:.1f} GiB of {memory_type}: '
+                  f'{max_b_size}')
+    print(f'Checkpointing {memory_type} relative to no checkpointing '
+          f'at b_size {B_SIZES[-1]}: '
+          f'{results[True][-1] / results[False][-1]:.2f}')
+
+
+if __name__ == '__main__':
+    DEVICE = 'cuda'
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    N_OBJECTS = 8
+    B_SIZES = (2, 4, 8)
+    # The device's total memory on GPU if None
+    MEMORY_BUDGET_GB = None
+    N_WARMUP = 1
+    N_ITERS = 3
+    main()
@@ -0,0 +1,56 @@
+"""Script to run a local HTTP server of a trained R-CNN.
+
+Example of requests:
+    curl --data-binary @image.jpg http://127.0.0.1:8000/detect
+    curl http://127.0.0.1:8000/stats
+"""
+
+from pathlib import Path
+import asyncio
+import sys
+
+import torch
+
+sys.path.append(str(Path(__file__).parents[2]))
+from rcnn.rcnn_model import load_detector
+from rcnn.rcnn_server import DetectionServer
+
+
+def main():
+    device = torch.device(DEVICE)
+    model = load_detector(MODEL_PTH,
+                          device=device,
+                          input_size=INPUT_SIZE,
+                          n_cls=N_CLS,
+                          roi_size=ROI_SIZE,
+                          backbone_model=BACKBONE_MODEL)
+    model.eval()
+
+    mean = torch.tensor([0.46201408, 0.44023338, 0.40830722])
+    std = torch.tensor([0.2513935, 0.24573067, 0.24901628])
+    server = DetectionServer(
+        model, INPUT_SIZE, mean, std, conf_thresh=CONF_THRESH,
+        nms_thresh=NMS_THRESH, max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_WAIT, max_queue_size=MAX_QUEUE_SIZE,
+        index2name=INDEX2NAME)
+    print(f'Serving on http://{HOST}:{PORT}')
+    asyncio.run(server.serve(HOST, PORT))
+
+
+if __name__ == '__main__':
+    WORK_DIR = Path(__file__).parents[2] / 'work_dir' / 'train_1'
+    MODEL_PTH = WORK_DIR / 'best_model.pt'
+    DEVICE = 'cuda'
+    INPUT_SIZE = (448, 448)
+    N_CLS = 2
+    ROI_SIZE = (2, 2)
+    BACKBONE_MODEL = 'resnet50'
+    INDEX2NAME = {0: 'legible', 1: 'illegible'}
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.1
+    HOST = '127.0.0.1'
+    PORT = 8000
+    MAX_BATCH_SIZE = 8
+    MAX_WAIT = 0.01  # seconds
+    MAX_QUEUE_SIZE = 256
+    main()
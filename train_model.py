@@ -1,5 +1,6 @@
 """Training script."""
 
+from functools import partial
 from pathlib import Path
 
 import torch
@@ -10,8 +11,12 @@ import albumentations as A
 from albumentations.pytorch import ToTensorV2
 from tqdm import tqdm
 
-from dataset.object_detection_dataset import TextDetectionCocoDataset
-from rcnn.rcnn_model import RCNN_Detector
+from dataset.batch_augmentation import BatchDetectionAugmentation
+from dataset.object_detection_dataset import (
+    TextDetectionCocoDataset, collate_detection_batch,
+    collate_uint8_detection_batch)
+from dataset.sharded_dataset import ShardedDetectionDataset
+from rcnn.rcnn_model import RCNN_Detector, compile_detector
 from rcnn.rcnn_utils import draw_bounding_boxes_cv2
 from utils.torch_utils.torch_metrics import (
     calculate_iou, calculate_prediction_count_diff)
@@ -21,6 +26,18 @@ from utils.torch_utils.torch_functions import image_tensor_to_numpy
 def main():
     # Get dataset parameters
     anns_pth = DSET_DIR / 'parsed_cocotext.json'
+    # Made by dataset/scripts/compile_annotation_index.py
+    anns_index_dir = DSET_DIR / 'parsed_cocotext_index'
+    if anns_index_dir.exists():
+        anns_pth = anns_index_dir
+    # Decode images once (see dataset/scripts/build_image_cache.py)
+    image_cache_dir = None  # DSET_DIR / 'image_cache'
+    image_cache_max_side = None
+    # Decode jpegs at 1/2, 1/4 or 1/8 resolution when it is not smaller
+    # than this, e.g. (crop_size, crop_size). Crops are upscaled more then.
+    min_image_size = None
+    # Stream the train set from tar shards (dataset/scripts/write_shards.py)
+    shards_dir = None  # DSET_DIR / 'shards'
     img_dir = DSET_DIR / 'images'
     name2index = {'pad': -1, 'legible': 0, 'illegible': 1}
     index2name = {-1: 'pad', 0: 'legible', 1: 'illegible'}
@@ -33,14 +50,34 @@ def main():
     input_size = (448, 448)
     roi_size = (2, 2)
     backbone_model = 'resnet50'
+    fpn = False  # multi-level RPN on layer2-layer4 for small text
+    # Same matching, faster on big maps (FPN) and with many words
+    spatial_matching = False
+    roi_align = False
+    # Bound the classifier's proposals per image (all positive anchors if None)
+    n_proposals_per_img = None
+    background_proposals = False
     conf_thresh = 0.8
     iou_thresh = 0.1
 
     # Get training parameters
     lr = 0.0001
     b_size = 8
+    # Pass flat boxes with per-image offsets instead of padded ones
+    ragged_targets = False
+    # Augment whole uint8 batches on the device instead of samples in workers
+    batch_augmentation = False
     weight_decay = 1e-3
     device = 'cuda'
+    amp = False  # bfloat16 autocast on CPU and float16 on GPU
+    channels_last = False
+    compile_model = False
+    # Recompute backbone activations on backward to fit bigger batches
+    # (see rcnn/scripts/report_training_memory.py)
+    checkpointing = False
+    # Fine-tuning: 1 freezes the stem, 2 - the stem and layer1, ...
+    frozen_stages = 0
+    frozen_bn = False
     continue_training = True
     end_ep = 56
 
@@ -64,47 +101,88 @@ def main():
     # Get transforms
     mean = torch.tensor([0.46201408, 0.44023338, 0.40830722])
     std = torch.tensor([0.2513935, 0.24573067, 0.24901628])
-    transform = A.Compose(
-        [
-            A.HorizontalFlip(),
-            A.VerticalFlip(),
-            A.RandomResizedCrop(crop_size, crop_size),
-            A.RandomBrightnessContrast(),
-            A.Normalize(mean=mean, std=std),
-            ToTensorV2()
-        ],
-        bbox_params=A.BboxParams(
-            format='pascal_voc', min_area=bbox_min_area,
-            min_visibility=bbox_min_visibility, label_fields=['classes'])
-    )
+    if batch_augmentation:
+        transform = None
+        augment = BatchDetectionAugmentation(
+            (crop_size, crop_size), mean=mean, std=std,
+            min_area=bbox_min_area, min_visibility=bbox_min_visibility)
+    else:
+        augment = None
+        transform = A.Compose(
+            [
+                A.HorizontalFlip(),
+                A.VerticalFlip(),
+                A.RandomResizedCrop(crop_size, crop_size),
+                A.RandomBrightnessContrast(),
+                A.Normalize(mean=mean, std=std),
+                ToTensorV2()
+            ],
+            bbox_params=A.BboxParams(
+                format='pascal_voc', min_area=bbox_min_area,
+                min_visibility=bbox_min_visibility, label_fields=['classes'])
+        )
 
     # Get dataset and loader
-    train_dset = TextDetectionCocoDataset(
-        annotation_path=anns_pth, img_dir=img_dir, dset_type='train',
-        name2index=name2index, transforms=transform)
+    if shards_dir is None:
+        train_dset = TextDetectionCocoDataset(
+            annotation_path=anns_pth, img_dir=img_dir, dset_type='train',
+            name2index=name2index, transforms=transform, pad=False,
+            image_cache_dir=image_cache_dir and image_cache_dir / 'train',
+            image_cache_max_side=image_cache_max_side,
+            min_image_size=min_image_size)
+    else:
+        train_dset = ShardedDetectionDataset(
+            shards_dir / 'train', name2index=name2index,
+            transforms=transform, min_image_size=min_image_size)
     val_dset = TextDetectionCocoDataset(
         annotation_path=anns_pth, img_dir=img_dir, dset_type='val',
-        name2index=name2index, transforms=transform)
-    
+        name2index=name2index, transforms=transform, pad=False,
+        image_cache_dir=image_cache_dir and image_cache_dir / 'val',
+        image_cache_max_side=image_cache_max_side,
+        min_image_size=min_image_size)
+
+    # Boxes are padded only to a batch's maximum number of objects
+    collate_fn = partial(
+        collate_uint8_detection_batch if batch_augmentation
+        else collate_detection_batch, ragged=ragged_targets)
+    # The sharded dataset shuffles itself
     train_loader = DataLoader(
-        train_dset, batch_size=b_size, shuffle=True)
+        train_dset, batch_size=b_size, shuffle=shards_dir is None,
+        collate_fn=collate_fn)
     val_loader = DataLoader(
-        val_dset, batch_size=b_size)
+        val_dset, batch_size=b_size, collate_fn=collate_fn)
 
     # Get the model
     model = RCNN_Detector(input_size=input_size,
                           n_cls=n_cls,
                           roi_size=roi_size,
-                          backbone_model=backbone_model)
+                          backbone_model=backbone_model,
+                          amp=amp,
+                          pretrained=not continue_training,
+                          fpn=fpn,
+                          roi_align=roi_align,
+                          channels_last=channels_last,
+                          checkpointing=checkpointing,
+                          frozen_stages=frozen_stages,
+                          frozen_bn=frozen_bn,
+                          spatial_matching=spatial_matching,
+                          n_proposals_per_img=n_proposals_per_img,
+                          background_proposals=background_proposals)
     model.to(device=device)
     if model_params:
         model.load_state_dict(model_params)
+    if compile_model:
+        compile_detector(model)
     
     # Get an optimizer
     optimizer = optim.Adam(
         model.parameters(), lr=lr, weight_decay=weight_decay)
     if optim_params:
         optimizer.load_state_dict(optim_params)
+
+    # Float16 gradients need scaling, bfloat16 ones do not
+    scaler = torch.amp.GradScaler(
+        device.type, enabled=amp and device.type != 'cpu')
     
     # Do training
     best_loss = None
@@ -116,18 +194,23 @@ def main():
 
         # Train pass
         model.train()
+        if shards_dir is not None:
+            train_dset.set_epoch(ep)
         desc = f'Train epoch {ep}'
         for batch in tqdm(train_loader, desc=desc):
-            images, gt_boxes, gt_classes = batch
-            images = images.to(device=device)
-            gt_boxes = gt_boxes.to(device=device)
-            gt_classes = gt_classes.to(device=device)
+            batch = [tensor.to(device=device) for tensor in batch]
+            if augment:
+                batch = augment(*batch)
+            images, gt_boxes, gt_classes, *gt_offsets = batch
+            gt_offsets = gt_offsets[0] if ragged_targets else None
 
-            proposals, classes, loss = model(images, gt_boxes, gt_classes)
+            proposals, classes, loss = model(
+                images, gt_boxes, gt_classes, gt_offsets)
 
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             train_losses.append(loss.item())
 
@@ -137,13 +220,15 @@ def main():
         with torch.no_grad():
             save_examples = True  # Save one batch of examples on validation
             for batch in tqdm(val_loader, desc=desc):
-                images, gt_boxes, gt_classes = batch
-                images = images.to(device=device)
-                gt_boxes = gt_boxes.to(device=device)
-                gt_classes = gt_classes.to(device=device)
+                batch = [tensor.to(device=device) for tensor in batch]
+                if augment:
+                    batch = augment(*batch)
+                images, gt_boxes, gt_classes, *gt_offsets = batch
+                gt_offsets = gt_offsets[0] if ragged_targets else None
 
                 # Do forward pass to get loss
-                proposals, classes, loss = model(images, gt_boxes, gt_classes)
+                proposals, classes, loss = model(
+                    images, gt_boxes, gt_classes, gt_offsets)
 
                 # Do inference pass to get some output examples
                 bboxes, classes = model.inference(
@@ -151,9 +236,9 @@ def main():
 
                 # Calculate and save metrics
                 val_losses.append(loss.item())
-                iou_values.append(calculate_iou(gt_boxes, bboxes))
-                n_pred_diff_values.append(
-                    calculate_prediction_count_diff(gt_boxes, bboxes))
+                iou_values.append(calculate_iou(gt_boxes, bboxes, gt_offsets))
+                n_pred_diff_values.append(calculate_prediction_count_diff(
+                    gt_boxes, bboxes, gt_offsets))
                 
                 # Save one batch of predictions
                 if save_examples:
@@ -162,9 +247,13 @@ def main():
                             images[i] * std.view((3, 1, 1)).to(device=device) +
                             mean.view((3, 1, 1)).to(device=device))
                         save_image = image_tensor_to_numpy(save_image)
+                        if ragged_targets:
+                            img_objs = slice(gt_offsets[i], gt_offsets[i + 1])
+                        else:
+                            img_objs = i
                         save_image = draw_bounding_boxes_cv2(
-                            save_image, gt_boxes[i],
-                            gt_classes[i].to(dtype=torch.int16),
+                            save_image, gt_boxes[img_objs],
+                            gt_classes[img_objs].to(dtype=torch.int16),
                             index2name, color=(0, 255, 0))
                         labels = torch.argmax(classes[i], dim=1)
                         save_image = draw_bounding_boxes_cv2(
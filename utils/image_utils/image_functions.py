@@ -1,8 +1,9 @@
 """A module that contain functions for working with images."""
 
 
+from io import BytesIO
 from pathlib import Path
-from typing import Tuple, Union, Optional
+from typing import BinaryIO, Tuple, Union, Optional
 
 import numpy as np
 from numpy.typing import NDArray
@@ -10,7 +11,171 @@ import cv2
 import matplotlib.pyplot as plt
 
 
-def read_image(path: Union[Path, str], grayscale: bool = False) -> NDArray:
+# Flags of libjpeg scaled decoding by reduction factors
+REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+# Start of frame markers except DHT, JPG and DAC
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_APP1_MARKER = 0xE1
+EXIF_ORIENTATION_TAG = 0x0112
+# EXIF orientations that swap height and width
+TRANSPOSING_ORIENTATIONS = frozenset((5, 6, 7, 8))
+
+
+def _read_exif_transposed(app1: bytes) -> Optional[bool]:
+    # Orientation is looked up in the first IFD of the TIFF structure
+    tiff = app1[6:]
+    if tiff[:2] == b'II':
+        byteorder = 'little'
+    elif tiff[:2] == b'MM':
+        byteorder = 'big'
+    else:
+        return None
+    ifd = int.from_bytes(tiff[4:8], byteorder)
+    if len(tiff) < ifd + 2:
+        return None
+    n_entries = int.from_bytes(tiff[ifd:ifd + 2], byteorder)
+    for i in range(n_entries):
+        entry = tiff[ifd + 2 + i * 12:ifd + 14 + i * 12]
+        if len(entry) < 12:
+            return None
+        if int.from_bytes(entry[:2], byteorder) == EXIF_ORIENTATION_TAG:
+            orientation = int.from_bytes(entry[8:10], byteorder)
+            return orientation in TRANSPOSING_ORIENTATIONS
+    return False
+
+
+def _read_jpeg_header(
+    f: BinaryIO
+) -> Optional[Tuple[Tuple[int, int], Optional[bool]]]:
+    if f.read(2) != b'\xff\xd8':
+        return None
+    transposed = False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # Fill bytes can precede a marker
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD9:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if marker[1] in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            size = (int.from_bytes(frame[1:3], 'big'),
+                    int.from_bytes(frame[3:5], 'big'))
+            return size, transposed
+        segment_length = int.from_bytes(length, 'big') - 2
+        if marker[1] == JPEG_APP1_MARKER:
+            segment = f.read(segment_length)
+            if segment[:6] == b'Exif\x00\x00':
+                transposed = _read_exif_transposed(segment)
+        else:
+            f.seek(segment_length, 1)
+
+
+def _get_jpeg_header(
+    source: Union[Path, str, bytes]
+) -> Optional[Tuple[Tuple[int, int], Optional[bool]]]:
+    if isinstance(source, bytes):
+        return _read_jpeg_header(BytesIO(source))
+    with open(source, 'rb') as f:
+        return _read_jpeg_header(f)
+
+
+def get_jpeg_size(
+    source: Union[Path, str, bytes]
+) -> Optional[Tuple[int, int]]:
+    """Get a size of a jpeg image from its header without decoding.
+
+    Parameters
+    ----------
+    source : Union[Path, str, bytes]
+        A path to the image or the encoded image.
+
+    Returns
+    -------
+    Optional[Tuple[int, int]]
+        A height and a width of the image or `None` if it is not a jpeg.
+        EXIF orientation is not applied.
+    """
+    header = _get_jpeg_header(source)
+    return header[0] if header is not None else None
+
+
+def get_decode_reduction(
+    image_size: Optional[Tuple[int, int]],
+    min_size: Optional[Tuple[int, int]],
+    transposed: Optional[bool] = None
+) -> int:
+    """Get the biggest jpeg decode reduction that keeps a minimum size.
+
+    Images are resized to `min_size` without keeping the aspect ratio,
+    so the height and the width are compared separately in the decoded
+    orientation. When the orientation is unknown every decoded side
+    must be not smaller than the biggest side of `min_size`.
+
+    Parameters
+    ----------
+    image_size : Optional[Tuple[int, int]]
+        A height and a width of a jpeg image from its header
+        or `None` for other images.
+    min_size : Optional[Tuple[int, int]]
+        A minimum height and width of the decoded image.
+    transposed : Optional[bool], optional
+        Whether EXIF orientation swaps the height and the width
+        of the image or `None` if it is unknown.
+
+    Returns
+    -------
+    int
+        The reduction factor 1, 2, 4 or 8.
+    """
+    if image_size is None or min_size is None:
+        return 1
+    h, w = image_size[::-1] if transposed else image_size
+    min_h, min_w = min_size
+    if transposed is None:
+        min_h = min_w = max(min_size)
+    for reduction in (8, 4, 2):
+        # libjpeg rounds reduced sides up
+        if -(-h // reduction) >= min_h and -(-w // reduction) >= min_w:
+            return reduction
+    return 1
+
+
+def _get_orig_size(
+    image: NDArray,
+    header: Optional[Tuple[Tuple[int, int], Optional[bool]]],
+    reduction: int
+) -> Tuple[int, int]:
+    if header is None:
+        return image.shape[:2]
+    size, transposed = header
+    if transposed is None:
+        # The decoder's orientation is known from the reduced sides
+        reduced = tuple(-(-side // reduction) for side in size)
+        transposed = image.shape[:2] != reduced
+    return size[::-1] if transposed else size
+
+
+def read_image(
+    path: Union[Path, str],
+    grayscale: bool = False,
+    min_size: Optional[Tuple[int, int]] = None,
+    return_orig_size: bool = False
+) -> Union[NDArray, Tuple[NDArray, Tuple[int, int]]]:
     """Read image to numpy array.
 
     Parameters
@@ -19,11 +184,19 @@ def read_image(path: Union[Path, str], grayscale: bool = False) -> NDArray:
         Path to image file
     grayscale : bool, optional
         Whether read image in grayscale, by default False
+    min_size : Optional[Tuple[int, int]], optional
+        A hint of a minimum needed height and width. If it is given then
+        a jpeg image is decoded at 1/2, 1/4 or 1/8 resolution when
+        it stays not smaller than this size. By default is None.
+    return_orig_size : bool, optional
+        Whether to return also a height and a width of the image
+        at full resolution in the decoded orientation, by default False
 
     Returns
     -------
-    NDArray
-        Array containing read image.
+    Union[NDArray, Tuple[NDArray, Tuple[int, int]]]
+        Array containing read image and its full resolution size
+        if `return_orig_size` is set.
 
     Raises
     ------
@@ -36,11 +209,63 @@ def read_image(path: Union[Path, str], grayscale: bool = False) -> NDArray:
         path = Path(path)
     if not path.exists():
         raise FileNotFoundError(f'Did not find image {path}.')
-    flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
-    img = cv2.imread(str(path), flag)
+    flags = REDUCED_GRAYSCALE_FLAGS if grayscale else REDUCED_COLOR_FLAGS
+    header = _get_jpeg_header(path) if min_size else None
+    image_size, transposed = header or (None, None)
+    reduction = get_decode_reduction(image_size, min_size, transposed)
+    img = cv2.imread(str(path), flags[reduction])
     if img is None:
         raise ValueError('Image reading is not correct.')
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if return_orig_size:
+        return img, _get_orig_size(img, header, reduction)
+    return img
+
+
+def decode_image(
+    data: bytes,
+    grayscale: bool = False,
+    min_size: Optional[Tuple[int, int]] = None,
+    return_orig_size: bool = False
+) -> Union[NDArray, Tuple[NDArray, Tuple[int, int]]]:
+    """Decode an encoded image (jpeg, png, ...) to numpy array.
+
+    Parameters
+    ----------
+    data : bytes
+        The encoded image.
+    grayscale : bool, optional
+        Whether decode image in grayscale, by default False
+    min_size : Optional[Tuple[int, int]], optional
+        A hint of a minimum needed height and width. If it is given then
+        a jpeg image is decoded at 1/2, 1/4 or 1/8 resolution when
+        it stays not smaller than this size. By default is None.
+    return_orig_size : bool, optional
+        Whether to return also a height and a width of the image
+        at full resolution in the decoded orientation, by default False
+
+    Returns
+    -------
+    Union[NDArray, Tuple[NDArray, Tuple[int, int]]]
+        Array containing decoded image and its full resolution size
+        if `return_orig_size` is set.
+
+    Raises
+    ------
+    ValueError
+        Image decoding is not correct.
+    """
+    flags = REDUCED_GRAYSCALE_FLAGS if grayscale else REDUCED_COLOR_FLAGS
+    header = _get_jpeg_header(data) if min_size else None
+    image_size, transposed = header or (None, None)
+    reduction = get_decode_reduction(image_size, min_size, transposed)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags[reduction])
+    if img is None:
+        raise ValueError('Image decoding is not correct.')
+    if not grayscale:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if return_orig_size:
+        return img, _get_orig_size(img, header, reduction)
     return img
 
 
@@ -1,36 +1,66 @@
 """The modula that contains metrics calculating functions."""
 
 
-from typing import List
+from typing import List, Optional
 
 import torch
-from torch import FloatTensor
+from torch import FloatTensor, IntTensor
 from torchvision.ops import box_iou
 
 
+def _split_gt_boxes(
+    gt_boxes: FloatTensor, gt_offsets: Optional[IntTensor] = None
+) -> List[FloatTensor]:
+    """Split padded or ragged ground truth boxes into images' boxes.
+
+    Parameters
+    ----------
+    gt_boxes : FloatTensor
+        Ground truth bounding boxes with shape `(n_img, n_max_obj, 4)`
+        padded with -1 or, in the ragged mode, with shape `(n_obj, 4)`.
+    gt_offsets : Optional[IntTensor], optional
+        Offsets of images' boxes with shape `(n_img + 1,)` that enable
+        the ragged mode.
+
+    Returns
+    -------
+    List[FloatTensor]
+        Boxes of every image without padding.
+    """
+    if gt_offsets is not None:
+        return list(torch.split(gt_boxes, torch.diff(gt_offsets).tolist()))
+    # Calculate n objects in gt boxes
+    n_objs = (gt_boxes >= 0).any(dim=2).sum(dim=1)
+    return [img_boxes[:n_obj] for img_boxes, n_obj in zip(gt_boxes, n_objs)]
+
+
 def calculate_iou(
-    gt_boxes: FloatTensor, predicted_boxes: List[FloatTensor]
+    gt_boxes: FloatTensor,
+    predicted_boxes: List[FloatTensor],
+    gt_offsets: Optional[IntTensor] = None
 ) -> FloatTensor:
     """Calculate IoU over predictions and ground truth bounding boxes.
 
     Parameters
     ----------
     gt_boxes : FloatTensor
-        Ground truth bounding boxes with shape `(n_img, n_max_obj, 4)`.
+        Ground truth bounding boxes with shape `(n_img, n_max_obj, 4)`
+        or, in the ragged mode, with shape `(n_obj, 4)`.
     predicted_boxes : List[FloatTensor]
         Proposals list with length `n_img`
         and each element has shape `(n_props_per_img, 4)`.
+    gt_offsets : Optional[IntTensor], optional
+        Offsets of images' ground truth boxes with shape `(n_img + 1,)`
+        that enable the ragged mode.
 
     Returns
     -------
     FloatTensor
         Calculated IoU scalar value.
     """
-    # Calculate n objects in gt boxes
-    n_objs = (gt_boxes >= 0).any(dim=2).sum(dim=1)
     iou_list = []
-    for i, n_obj in enumerate(n_objs):
-        iou = box_iou(gt_boxes[i][:n_obj], predicted_boxes[i])
+    for i, img_gt_boxes in enumerate(_split_gt_boxes(gt_boxes, gt_offsets)):
+        iou = box_iou(img_gt_boxes, predicted_boxes[i])
         # Check is there a prediction
         if iou.shape[0] != 0 and iou.shape[1] != 0:
             iou, _ = iou.max(dim=1)
@@ -43,16 +73,22 @@ def calculate_iou(
 
 
 def calculate_prediction_count_diff(
-    gt_boxes: FloatTensor, predicted_boxes: List[FloatTensor]
+    gt_boxes: FloatTensor,
+    predicted_boxes: List[FloatTensor],
+    gt_offsets: Optional[IntTensor] = None
 ) -> FloatTensor:
     """Calculate difference between predictions count and gt count.
 
     Parameters
     ----------
     gt_boxes : FloatTensor
-        The ground truth bounding boxes.
+        The ground truth bounding boxes. They are padded with -1
+        or, in the ragged mode, flat.
     predicted_boxes : List[FloatTensor]
         The predicted bounding boxes.
+    gt_offsets : Optional[IntTensor], optional
+        Offsets of images' ground truth boxes with shape `(n_img + 1,)`
+        that enable the ragged mode.
 
     Returns
     -------
@@ -60,7 +96,11 @@ def calculate_prediction_count_diff(
         Mean difference between counts of predicts and ground truth bboxes.
     """
     # TODO сделать описание получше
-    gt_objs = (gt_boxes >= 0).any(dim=2).sum(dim=1, dtype=torch.float32)
+    if gt_offsets is not None:
+        gt_objs = torch.diff(gt_offsets).to(dtype=torch.float32)
+    else:
+        gt_objs = (gt_boxes >= 0).any(dim=2).sum(
+            dim=1, dtype=torch.float32)
     pred_objs = torch.tensor(list(map(len, predicted_boxes)),
                              dtype=torch.float32, device=gt_objs.device)
     diff = torch.mean(torch.abs(gt_objs - pred_objs))